@@ -0,0 +1,140 @@
+"""
+ADC bus manager, the single owner of the ADCPi board and so of its I2C bus. The ADCPi library
+keeps the channel, bit rate and conversion mode in the object and updates them as it reads, so
+two threads reading through the same object can corrupt each other's conversions. Every reader
+goes through ADCManagerClass instead: each transaction (setting the bit rate, selecting the
+channel and reading the conversion) runs as one critical section under the bus lock.
+
+Concurrent requests for the same channel at the same bit rate share one conversion: the first
+request runs the conversion and any request that arrives while it is running waits for it and
+receives the same result, so a second reader never triggers a duplicate conversion.
+
+The ADCPi library raises its own TimeoutError, which is not the builtin one. The manager is
+given the library's class and raises a builtin TimeoutError in its place, so every reader
+handles a timeout from the board and from the simulation the same way.
+"""
+
+from threading import Lock, Event
+from time import monotonic
+import metrics
+
+
+class ConversionClass:
+    """
+    One conversion in progress, shared by every request for the same channel and bit rate.
+
+    Attributes:
+        done: Event set when the conversion has finished.
+        voltage: The result, or None if the conversion failed.
+        error: The exception raised by the conversion, or None.
+        waiters: Number of requests sharing the conversion.
+    """
+    def __init__(self):
+        self.done = Event()
+        self.voltage = None
+        self.error = None
+        self.waiters = 1
+
+
+class ADCManagerClass:
+    """
+    Serialises access to an ADCPi board and fans out conversions to concurrent requests.
+
+    Attributes:
+        adc: The ADCPi board, replaced by setadc() when the board is opened again.
+        defaultbitrate: The bit rate used when a read does not ask for one.
+        timeouterror: The exception class the board raises when a conversion times out.
+        bitrate: The bit rate the board is currently set to.
+        buslock: Lock held for each transaction on the bus.
+        pendinglock: Lock protecting pending.
+        pending: Dictionary mapping (channel, bit rate) to the ConversionClass in progress.
+    """
+    def __init__(self, adc, bitrate=12, timeouterror=TimeoutError):
+        self.adc = adc
+        self.timeouterror = timeouterror
+        self.defaultbitrate = bitrate
+        self.bitrate = bitrate
+        self.buslock = Lock()
+        self.pendinglock = Lock()
+        self.pending = {}
+
+    def setadc(self, adc, bitrate=12):
+        """Replaces the board after it has been opened again, waiting for any transaction to finish"""
+        with self.buslock:
+            self.adc = adc
+            self.defaultbitrate = bitrate
+            self.bitrate = bitrate
+
+    def read(self, channel, bitrate=None):
+        """
+        Returns the voltage on a channel. If a conversion of the channel at the same bit rate
+        is already running the request waits for it and returns its result.
+
+        Args:
+            channel (int): ADC channel 1 to 8.
+            bitrate (int): Bit rate for the conversion, 12, 14, 16 or 18, None for the
+                default bit rate.
+
+        Returns:
+            float: The voltage.
+
+        Raises:
+            TimeoutError: If the conversion timed out.
+            OSError: If the I2C transfer failed or there is no board.
+        """
+        key = (channel, bitrate or self.defaultbitrate)
+        with self.pendinglock:
+            conversion = self.pending.get(key)
+            if conversion is not None:
+                conversion.waiters += 1
+                owner = False
+            else:
+                conversion = self.pending[key] = ConversionClass()
+                owner = True
+        if owner:
+            try:
+                conversion.voltage = self.convert(*key)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                conversion.error = err
+            finally:
+                with self.pendinglock:
+                    del self.pending[key]
+                conversion.done.set()
+            if conversion.waiters > 1:
+                metrics.ADC_SHARED.inc(channel, amount=conversion.waiters - 1)
+        else:
+            conversion.done.wait()
+        if conversion.error is not None:
+            raise conversion.error
+        return conversion.voltage
+
+    def convert(self, channel, bitrate):
+        """
+        Runs one conversion as a single transaction on the bus: sets the bit rate if it has
+        changed, then selects the channel and reads it, and records it in the metrics. A
+        timeout raised by the board library is raised again as the builtin TimeoutError.
+
+        Raises:
+            TimeoutError: If the conversion timed out.
+            OSError: If the I2C transfer failed or there is no board.
+        """
+        with self.buslock:
+            if self.adc is None:
+                raise OSError('no ADCPi board')
+            starttime = monotonic()
+            try:
+                if bitrate != self.bitrate:
+                    self.adc.set_bit_rate(bitrate)
+                    self.bitrate = bitrate
+                voltage = self.adc.read_voltage(channel)
+            except (self.timeouterror, TimeoutError) as err:
+                metrics.ADC_TIMEOUTS.inc(channel)
+                if isinstance(err, TimeoutError):
+                    raise
+                raise TimeoutError('channel %s: %s' % (channel, err)) from err
+            except OSError:
+                metrics.ADC_ERRORS.inc(channel)
+                raise
+        metrics.ADC_SECONDS.observe(monotonic() - starttime, channel)
+        metrics.ADC_CONVERSIONS.inc(channel)
+        return voltage
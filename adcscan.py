@@ -0,0 +1,204 @@
+"""
+ADC scan scheduler, samples the spare channels of the ADCPi board (stage temperature, supply
+voltage, a second position pot and so on) at their own rates and bit depths, and keeps the
+recent samples of every channel in a ring buffer for the API.
+
+The channels are set in the 'adcscan' setting, keyed by channel number:
+
+    "adcscan": {"2": {"name": "stage temperature", "rate": 0.2, "bits": 16, "buffer": 720},
+                "3": {"name": "24v supply", "rate": 1, "bits": 12}}
+
+rate is in samples per second, bits is 12, 14, 16 or 18 and buffer is the number of samples
+kept (DEFAULT_BUFFER if not given). The position channels of the axes, 1 and 5 unless set
+otherwise in 'axes', are read by the position reader, every position sample is recorded in
+their buffers so they cost no extra conversions. A channel with a bad setting is left out
+and the reason written to the log, the other channels are still scanned.
+
+Position tracking comes first. All conversions go through the ADC bus manager, and a scan
+conversion is only started if it will finish before the position reader next needs the bus.
+A channel that has waited a whole period for a gap is read anyway, so a slow high resolution
+channel delays a position sample at most once per period rather than never being read.
+"""
+
+from collections import deque
+from threading import Thread, Event, Lock
+from time import monotonic, time
+from logmanager import logger
+
+CONVERSION_TIME = {12: 1 / 240, 14: 1 / 60, 16: 1 / 15, 18: 1 / 3.75}
+CONVERSION_MARGIN = 1.25
+DEFAULT_BUFFER = 600
+
+
+class ChannelClass:
+    """
+    One scanned channel and its ring buffer of samples.
+
+    Attributes:
+        channel: ADC channel 1 to 8.
+        name: Description of what is wired to the channel.
+        rate: Samples per second, 0 for the position channels which are filled by the
+            position reader.
+        bits: Bit rate for the conversions.
+        due: time.monotonic() the next sample is due.
+        samples: Ring buffer of [time.time(), voltage] samples.
+        errors: Number of failed conversions.
+        lock: Lock protecting the samples.
+    """
+    def __init__(self, channel, name, rate, bits, buffer):
+        self.channel = channel
+        self.name = name
+        self.rate = rate
+        self.bits = bits
+        self.due = monotonic()
+        self.samples = deque(maxlen=buffer)
+        self.errors = 0
+        self.lock = Lock()
+
+    def record(self, voltage):
+        """Adds a sample to the ring buffer"""
+        with self.lock:
+            self.samples.append([round(time(), 3), voltage])
+
+    def status(self, count=None):
+        """
+        Returns the channel settings and its samples.
+
+        Args:
+            count (int): Number of the most recent samples to return, None for all of them.
+        """
+        with self.lock:
+            samples = list(self.samples)
+        if count is not None:
+            samples = samples[-count:] if count else []
+        return {'name': self.name, 'rate': self.rate, 'bits': self.bits, 'errors': self.errors,
+                'samples': samples}
+
+
+def checkchannel(key, item, positionchannels):
+    """
+    Checks the entry of one channel in the 'adcscan' setting.
+
+    Args:
+        key: The channel number, as a string in settings.json.
+        item: The channel settings.
+        positionchannels: Channel numbers read by the position reader.
+
+    Returns:
+        tuple: (channel, name, rate, bits, buffer) for ChannelClass.
+
+    Raises:
+        ValueError: If a setting is not valid.
+    """
+    try:
+        channel = int(key)
+    except (TypeError, ValueError):
+        raise ValueError('channel must be a number 1 to 8') from None
+    if channel in positionchannels or not 1 <= channel <= 8:
+        raise ValueError('channel cannot be scanned')
+    if not isinstance(item, dict):
+        raise ValueError('expected {"name": ..., "rate": ..., "bits": ..., "buffer": ...}')
+    rate, bits, buffer = item.get('rate'), item.get('bits', 12), item.get('buffer', DEFAULT_BUFFER)
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not rate > 0:
+        raise ValueError('rate must be a number above 0, got %r' % (rate,))
+    if isinstance(bits, bool) or bits not in CONVERSION_TIME:
+        raise ValueError('bits must be 12, 14, 16 or 18, got %r' % (bits,))
+    if isinstance(buffer, bool) or not isinstance(buffer, int) or buffer < 1:
+        raise ValueError('buffer must be a whole number above 0, got %r' % (buffer,))
+    return channel, str(item.get('name', 'channel %s' % channel)), rate, bits, buffer
+
+
+class ScanClass:
+    """
+    Schedules the conversions of the scanned channels on one thread, 'ADC Scan'.
+
+    Attributes:
+        manager: The ADCManagerClass all conversions go through.
+        positionchannels: Dictionary mapping channel number to the name of the axis whose
+            position it reads.
+        nextread: Function returning the time.monotonic() the position reader next needs the bus.
+        channels: Dictionary mapping channel number to its ChannelClass.
+        running: True until shutdown() is called.
+        stopevent: Event set by shutdown() to wake the scan thread.
+        thread: The scan thread, or None if no channels are scanned.
+    """
+    def __init__(self, manager, config, positionbuffer, nextread, positionchannels):
+        self.manager = manager
+        self.nextread = nextread
+        self.positionchannels = positionchannels
+        self.channels = {}
+        for channel, axis in positionchannels.items():
+            self.channels[channel] = ChannelClass(channel, '%s position' % axis, 0, manager.defaultbitrate,
+                                                  positionbuffer)
+        if not isinstance(config, dict):
+            logger.error('ADC scan: setting ignored, expected {"channel": {"rate": ...}}')
+            config = {}
+        for key, item in config.items():
+            try:
+                channel = checkchannel(key, item, positionchannels)
+            except ValueError as err:
+                logger.error('ADC scan: channel %s ignored, %s', key, err)
+                continue
+            self.channels[channel[0]] = ChannelClass(*channel)
+        self.running = True
+        self.stopevent = Event()
+        self.thread = None
+        if any(channel.rate for channel in self.channels.values()):
+            self.thread = Thread(target=self.run, name='ADC Scan', daemon=True)
+            self.thread.start()
+
+    def record(self, channel, voltage):
+        """Records a sample taken elsewhere, used by the position reader for the position channels"""
+        self.channels[channel].record(voltage)
+
+    def run(self):
+        """
+        Scan loop. Of the channels that are due, reads the most overdue one whose conversion
+        will finish before the next position read, or any channel that has waited a whole
+        period. If none can be read it waits for the next gap in the position reads.
+        """
+        scanned = [channel for channel in self.channels.values() if channel.rate]
+        while self.running:
+            now = monotonic()
+            due = [channel for channel in scanned if channel.due <= now]
+            if not due:
+                self.stopevent.wait(min(channel.due for channel in scanned) - now)
+                continue
+            gap = self.nextread() - now
+            candidates = [channel for channel in due if now - channel.due > 1 / channel.rate] or \
+                         [channel for channel in due if CONVERSION_TIME[channel.bits] * CONVERSION_MARGIN <= gap]
+            if not candidates:
+                self.stopevent.wait(max(gap, 0) + CONVERSION_TIME[self.manager.defaultbitrate] * 2 * CONVERSION_MARGIN)
+                continue
+            channel = min(candidates, key=lambda item: item.due)
+            try:
+                channel.record(self.manager.read(channel.channel, channel.bits))
+            except (TimeoutError, OSError) as err:
+                channel.errors += 1
+                if channel.errors == 1:
+                    logger.error('ADC scan: channel %s (%s) read failed: %s', channel.channel, channel.name, err)
+            channel.due = max(channel.due + 1 / channel.rate, now)
+
+    def status(self, channel='all', count=None):
+        """
+        Returns the settings and samples of one channel or of all of them.
+
+        Args:
+            channel: Channel number or 'all'.
+            count (int): Number of the most recent samples to return, None for all of them.
+
+        Returns:
+            dict: Channel number to the channel settings and samples.
+        """
+        if channel == 'all':
+            return {number: item.status(count) for number, item in sorted(self.channels.items())}
+        if channel not in self.channels:
+            return {channel: None}
+        return {channel: self.channels[channel].status(count)}
+
+    def shutdown(self):
+        """Stops the scan thread"""
+        self.running = False
+        self.stopevent.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(2)
@@ -15,22 +15,37 @@ but can also be run directly for development purposes.
 
 Routes:
   - / : Main status page
-  - /api : API endpoint for programmatic control (POST, requires API key)
+  - /api : API endpoint for programmatic control, one command or a batch (POST, requires API key)
+  - /wait : Blocks until an axis stops or reaches a target (POST, requires API key)
+  - /metrics : Counters and histograms in the Prometheus text format
+  - /profile : Sampling profile of all threads as collapsed stacks (requires API key)
+  - /raster : Rows of the last raster scan as CSV or NumPy .npy (requires API key)
   - /selftest : Runs a system self-test
   - /pylog : Displays application logs
   - /guaccesslog : Displays Gunicorn access logs
   - /guerrorlog : Displays Gunicorn error logs
   - /syslog : Displays system logs
 
-Configuration is managed through settings imported from app_control.
+Configuration is managed through settings imported from app_control. If 'motionprocess'
+is set the hardware is run by motionprocess.py and the app passes commands to it through
+motionclient, otherwise the hardware is run in the gunicorn worker by steppercontrol.
 """
 
 import subprocess
-from threading import enumerate as enumerate_threads
+from time import perf_counter
+from threading import Thread, enumerate as enumerate_threads
 from flask import Flask, render_template, jsonify, request
-from steppercontrol import httpstatus, parsecontrol, apistatus, runselftest
 from app_control import VERSION, settings
 from logmanager import logger
+from commands import CommandError
+import profiler
+import metrics
+if settings['motionprocess']:
+    from motionclient import httpstatus, parsecontrol, parsebatch, apistatus, runselftest, waitfor, rasterdata
+    from motionclient import profile as motionprofile
+    from motionclient import metrics as motionmetrics
+else:
+    from steppercontrol import httpstatus, parsecontrol, parsebatch, apistatus, runselftest, waitfor, rasterdata
 
 app = Flask(__name__)
 logger.info('Starting X-Y Controller web app version %s', VERSION)
@@ -103,7 +118,8 @@ def index():
     """
     Handles the root route of the application, retrieves CPU temperature, and renders
     the main index page with relevant data such as locations, application version,
-    CPU temperature, and active threads.
+    CPU temperature, and active threads. In motion process mode the page is still shown
+    when the motion process is down, with the positions marked unavailable.
 
     Returns:
         str: Rendered HTML template for the index page.
@@ -112,7 +128,11 @@ def index():
         log = f.readline()
     f.close()
     cputemperature = round(float(log)/1000, 1)
-    return render_template('index.html', locations=httpstatus(), version=VERSION,
+    try:
+        locations, unavailable = httpstatus(), False
+    except ConnectionError:
+        locations, unavailable = {}, True
+    return render_template('index.html', locations=locations, unavailable=unavailable, version=VERSION,
                            cputemperature=cputemperature, threads=threadlister())
 
 
@@ -126,11 +146,19 @@ def api():
     the required parameters from the JSON payload (item and command), processes the command, and returns the API
     status. If the key is missing or invalid, it logs the attempt and returns an appropriate HTTP response.
 
-    The function also handles malformed JSON messages gracefully by returning an error response.
+    The function also handles malformed JSON messages gracefully by returning an error response. Commands that
+    fail the checks in the command table are rejected with a 400 response describing the problem.
+
+    Several commands can be sent in one request as a JSON array of item/command objects, or as
+    {"commands": [...], "stoponerror": true}, they are run in order by parsebatch() and the status is returned
+    once with the result of each command under 'results'. A stoponerror batch is rejected with a 400 response if
+    any command is invalid, and stops at the first command that fails with a 400 response listing the results of
+    the commands that were run. A batch is not a transaction, commands that ran are not undone.
 
     Returns:
-        JSONResponse: A JSON-formatted response containing the API status with a status code of 201 if the request
-        is processed successfully.
+        JSONResponse: A JSON-formatted response containing the API status and the checked command under 'result',
+        or the results of a batch under 'results', with a status code of 201 if the request is processed
+        successfully.
         String: An error message with an appropriate HTTP status code if the API key is missing, invalid, or the
         request JSON is malformed.
     """
@@ -139,18 +167,179 @@ def api():
         logger.debug('API request: %s', request.json)
         if 'Api-Key' in request.headers.keys():  # check api key exists
             if request.headers['Api-Key'] == settings['api-key']:  # check for correct API key
-                item = request.json['item']
-                command = request.json['command']
-                parsecontrol(item, command)
-                return jsonify(apistatus()), 201
+                message = request.json
+                if isinstance(message, list) or 'commands' in message:
+                    return apibatch(message)
+                item = message['item']
+                command = message['command']
+                starttime = perf_counter()
+                try:
+                    result = parsecontrol(item, command)
+                except CommandError as err:
+                    return jsonify({'error': str(err)}), 400
+                status = apistatus()
+                status['result'] = result
+                metrics.API_SECONDS.observe(perf_counter() - starttime, 'http', item)
+                return jsonify(status), 201
             logger.warning('API: access attempt using an invalid token from %s', request.headers[''])
             return 'access token(s) unuthorised', 401
         logger.warning('API: access attempt without a token from  %s', request.headers['X-Forwarded-For'])
         return 'access token(s) incorrect', 401
-    except KeyError:
+    except (KeyError, TypeError):
         return "badly formed json message", 401
 
 
+def apibatch(message):
+    """
+    Runs a batch of commands for /api, given as a list of item/command objects or as a
+    dictionary holding the list under 'commands' and optionally 'stoponerror'.
+
+    Returns:
+        JSONResponse: The API status with the results of the batch under 'results', with a
+        status code of 201, or 400 with 'error' if the batch was rejected or a stoponerror
+        batch stopped.
+    """
+    commands, stoponerror = (message, False) if isinstance(message, list) else \
+        (message['commands'], message.get('stoponerror') is True)
+    starttime = perf_counter()
+    try:
+        batch = parsebatch(commands, stoponerror)
+    except CommandError as err:
+        return jsonify({'error': str(err)}), 400
+    status = apistatus()
+    status.update(batch)
+    metrics.API_SECONDS.observe(perf_counter() - starttime, 'http', 'batch')
+    return jsonify(status), 400 if 'error' in batch else 201
+
+
+@app.route('/wait', methods=['POST'])
+def wait():
+    """
+    Long-poll endpoint that holds the request until an axis, or both, has stopped, a single
+    axis is within tolerance of a target, or the timeout passes, so a client sequencing moves
+    needs one request per move rather than polling /api. The API key is checked as for /api.
+
+    The JSON body holds 'axis' (the name of an axis or 'all') and optionally 'target', 'tolerance' and
+    'timeout' in seconds, the timeout is capped by the 'waittimeout' setting.
+
+    Returns:
+        JSONResponse: The API status with 'wait' holding the axis, the reason the wait ended
+        ('idle', 'arrived' or 'timeout') and the seconds waited, with a status code of 200.
+        String: An error message with an appropriate HTTP status code if the API key is missing,
+        invalid, or the request JSON is malformed, or a JSON error with 400 if an argument is invalid.
+    """
+    try:
+        if 'Api-Key' in request.headers.keys():  # check api key exists
+            if request.headers['Api-Key'] == settings['api-key']:  # check for correct API key
+                message = request.json
+                try:
+                    status = waitfor(message['axis'], message.get('target'), message.get('tolerance'),
+                                     message.get('timeout'))
+                except CommandError as err:
+                    return jsonify({'error': str(err)}), 400
+                return jsonify(status), 200
+            logger.warning('API: wait attempt using an invalid token from %s', request.headers[''])
+            return 'access token(s) unuthorised', 401
+        logger.warning('API: wait attempt without a token from  %s', request.headers['X-Forwarded-For'])
+        return 'access token(s) incorrect', 401
+    except (KeyError, AttributeError):
+        return "badly formed json message", 401
+
+
+@app.route('/metrics')
+def showmetrics():
+    """
+    Returns the counters and histograms in the Prometheus text format for scraping: ADC
+    conversions, timeouts and conversion time per channel, steps per axis, moveto overruns,
+    move durations, API command time by item and the number of threads. In motion process
+    mode the motion process metrics are fetched and merged with those of the web process.
+
+    Returns:
+        Response: The metrics text.
+    """
+    snapshots = [metrics.snapshot('web')]
+    if settings['motionprocess']:
+        try:
+            snapshots.append(motionmetrics())
+        except (RuntimeError, ConnectionError) as err:
+            logger.error('metrics: cannot read the motion process metrics: %s', err)
+    return metrics.render(*snapshots), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/profile')
+def profile():
+    """
+    Takes a sampling profile of every thread for a number of seconds and returns it as
+    collapsed stacks, ready for flamegraph.pl or speedscope. The API key is checked as for
+    /api, the query string sets 'seconds' (default 5, capped by the 'profilemaxseconds'
+    setting) and 'interval' between samples (default 0.005). Each stack starts with the
+    thread name shown on the index page. In motion process mode the motion process is
+    profiled at the same time and the stacks are prefixed 'motion' or 'web'.
+
+    Returns:
+        Response: Collapsed stack text with the sample count, time sampled and profiler
+        overhead in the X-Profile-Samples, X-Profile-Seconds and X-Profile-Overhead headers.
+        String: An error message with an appropriate HTTP status code if the API key is
+        missing or invalid, or a JSON error with 400 if the arguments are invalid.
+    """
+    if request.headers.get('Api-Key') != settings['api-key']:
+        logger.warning('API: profile attempt without a valid token from %s', request.headers.get('X-Forwarded-For'))
+        return 'access token(s) incorrect', 401
+    seconds = request.args.get('seconds', 5)
+    interval = request.args.get('interval', profiler.SAMPLE_INTERVAL)
+    try:
+        if settings['motionprocess']:
+            remote = {}
+
+            def profilemotion():
+                try:
+                    remote.update(motionprofile(seconds, interval))
+                except (CommandError, RuntimeError, ConnectionError) as err:
+                    logger.error('API: motion process profile failed: %s', err)
+            remotethread = Thread(target=profilemotion, name='Profile Client')
+            remotethread.start()
+            local = profiler.profile(seconds, interval, settings['profilemaxseconds'])
+            remotethread.join()
+            if not remote:
+                return 'motion process profile failed', 502
+            result = profiler.merge(('motion', remote), ('web', local))
+        else:
+            result = profiler.profile(seconds, interval, settings['profilemaxseconds'])
+    except CommandError as err:
+        return jsonify({'error': str(err)}), 400
+    logger.info('API: profiled %s samples over %s seconds', result['samples'], result['seconds'])
+    return profiler.folded(result), 200, {'Content-Type': 'text/plain; charset=utf-8',
+                                          'X-Profile-Samples': str(result['samples']),
+                                          'X-Profile-Seconds': str(result['seconds']),
+                                          'X-Profile-Overhead': str(result['overhead'])}
+
+
+@app.route('/raster')
+def rasterdownload():
+    """
+    Downloads the rows recorded by the last raster scan, started with the 'raster' API item,
+    so far if the scan is still running. The API key is checked as for /api and the query
+    string 'format' is 'csv' (the default) or 'npy' for a NumPy .npy file of doubles.
+
+    Returns:
+        Response: The rows as an attachment, raster.csv or raster.npy.
+        String: An error message with an appropriate HTTP status code if the API key is
+        missing or invalid, the format is not recognised or no scan has been run.
+    """
+    if request.headers.get('Api-Key') != settings['api-key']:
+        logger.warning('API: raster download attempt without a valid token from %s',
+                       request.headers.get('X-Forwarded-For'))
+        return 'access token(s) incorrect', 401
+    form = request.args.get('format', 'csv')
+    if form not in ('csv', 'npy'):
+        return jsonify({'error': "raster: format must be 'csv' or 'npy'"}), 400
+    data = rasterdata(form)
+    if data is None:
+        return 'no raster scan has been run', 404
+    mimetype = 'application/octet-stream' if form == 'npy' else 'text/csv; charset=utf-8'
+    return data, 200, {'Content-Type': mimetype, 'Content-Disposition': 'attachment; filename=raster.%s' % form}
+
+
 @app.route('/selftest')
 def selftest():
     """
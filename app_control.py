@@ -6,7 +6,7 @@ import random
 import json
 from datetime import datetime
 
-VERSION = '2.1.3'
+VERSION = '2.26.0'
 
 def initialise():
     """Setup the settings structure with default values"""
@@ -17,10 +17,61 @@ def initialise():
                  'logappname': 'XY-Control-Py',
                  'loglevel': 'INFO',
                  'gunicornpath': './logs/',
-                 'cputemp': '/sys/class/thermal/thermal_zone0/temp'}
+                 'cputemp': '/sys/class/thermal/thermal_zone0/temp',
+                 'axes': [{'name': 'x', 'pins': [18, 24, 23, 9], 'channel': 1},
+                          {'name': 'y', 'pins': [17, 22, 27, 13], 'channel': 5}],
+                 'xlimitswitches': [11, 16],
+                 'ylimitswitches': [20, 21],
+                 'homebackoff': 40,
+                 'homeslowdelay': 0.3,
+                 'xenergise': 'pulse',
+                 'xidletime': 0.5,
+                 'yenergise': 'pulse',
+                 'yidletime': 0.5,
+                 'xstepmode': 'half',
+                 'ystepmode': 'half',
+                 'xvoltsperstep': 0.0005,
+                 'yvoltsperstep': 0.0005,
+                 'xcalibration': [],
+                 'ycalibration': [],
+                 'waittolerance': 0.01,
+                 'waittimeout': 60,
+                 'simulate': False,
+                 'profilemaxseconds': 60,
+                 'positionstaletime': 2.0,
+                 'adcscan': {},
+                 'positionbuffer': 1200,
+                 'statefile': './stagestate.json',
+                 'rastermaxpoints': 100000,
+                 'commandlog': '',
+                 'motionpriority': 0,
+                 'motioncpu': None,
+                 'motionprocess': False,
+                 'motionsocket': '/tmp/xymotion.sock',
+                 'positionshare': False,
+                 'positionshm': 'xycontrol-positions',
+                 'controlsocket': '',
+                 'controlhost': '127.0.0.1',
+                 'controlport': 0}
     return isettings
 
 
+def axissetting(axis, key, default=None):
+    """
+    Returns a setting of an axis, from its entry in the 'axes' setting if it is there, otherwise
+    from the '<name><key>' setting such as 'xlimitswitches' that the x and y axes have always
+    had, otherwise the default.
+
+    Args:
+        axis (dict): The entry of the axis in 'axes'.
+        key (str): Name of the setting, such as 'limitswitches'.
+        default: Value returned if the axis has no such setting.
+    """
+    if key in axis:
+        return axis[key]
+    return settings.get(axis['name'] + key, default)
+
+
 def generate_api_key(key_len):
     """generate a new api key"""
     allowed_characters = "ABCDEFGHJKLMNPQRSTUVWXYZ-+~abcdefghijkmnopqrstuvwxyz123456789"
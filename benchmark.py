@@ -0,0 +1,339 @@
+"""
+Benchmark suite for the motion and ADC hot paths and the web endpoints, run against the
+simulated hardware in simhardware so it can be run anywhere. The results are written as
+JSON so a change to the motion code can be compared with a saved baseline:
+
+    python3 benchmark.py --output baseline.json
+    ... change the code ...
+    python3 benchmark.py --baseline baseline.json
+
+Benchmarks:
+    steps   steps per second of StepperClass.movenext / moveprevious for each pulse width,
+            with the number of steps the simulated rotor did not follow.
+    moveto  time, step count, predicted time and final error of moveto over a grid of
+            distances, out from the centre and back.
+    adc     ADCPi.read_raw samples per second for each bit rate, of the ADCPi library itself
+            reading the simulated converters through its SMBus, which is replaced by
+            simhardware.SimSMBusClass. With --adc board the library is measured on the real
+            board. The benchmark is skipped if the ADCPi library is not installed.
+    web     latency of / and /api (getxystatus) under concurrent requests from the Flask
+            test client.
+
+The settings are taken from settings.json with 'simulate' switched on for the run. The stage
+state and the stand-in CPU temperature file are kept in a temporary directory that is removed
+at the end, and no command log is written, so a run never touches the state or the command
+log of the real stage.
+"""
+
+import os
+import sys
+import shutil
+import json
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+from threading import Thread
+from time import perf_counter, sleep
+from app_control import settings, VERSION
+
+
+def summarise(samples):
+    """
+    Summarises a list of times in seconds.
+
+    Returns:
+        dict: count, mean, p50, p95, p99 and max in milliseconds.
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def percentile(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 4)
+    return {'count': len(samples), 'mean': round(sum(samples) / len(samples) * 1000, 4),
+            'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99),
+            'max': round(samples[-1] * 1000, 4)}
+
+
+def benchsteps(steppercontrol, simhardware, count, pulsewidths):
+    """
+    Measures steps per second of movenext and moveprevious on the x axis.
+
+    Args:
+        steppercontrol: The started steppercontrol module.
+        simhardware: The simhardware module, used to check the rotor followed each step.
+        count (int): Steps per measurement.
+        pulsewidths (list): Pulse widths in seconds to measure at.
+
+    Returns:
+        dict: Results keyed by 'pulsewidth method'.
+    """
+    stepper = steppercontrol.steppers['x']
+    stage = simhardware.GPIO.stages['x']
+    savedwidth = stepper.pulsewidth
+    results = {}
+    for pulsewidth in pulsewidths:
+        stepper.pulsewidth = pulsewidth
+        for method in (stepper.movenext, stepper.moveprevious):
+            startsteps = stage.halfsteps
+            stepper.beginmove()
+            starttime = perf_counter()
+            for _ in range(count):
+                method(False)
+            elapsed = perf_counter() - starttime
+            stepper.endmove()
+            stepper.stop()
+            results['%s %s' % (pulsewidth, method.__name__)] = {
+                'steps': count, 'seconds': round(elapsed, 4),
+                'stepspersecond': round(count / elapsed, 1),
+                'microsecondsperstep': round(elapsed / count * 1e6, 1),
+                'missed': count - abs(stage.halfsteps - startsteps)}
+    stepper.pulsewidth = savedwidth
+    return results
+
+
+def benchmoveto(steppercontrol, simhardware, distances, pulsewidth):
+    """
+    Measures moveto on the x axis out from the centre to each distance and back again.
+
+    Args:
+        steppercontrol: The started steppercontrol module.
+        simhardware: The simhardware module, used for the true stage position.
+        distances (list): Distances in volts.
+        pulsewidth (float): Pulse width in seconds for the moves.
+
+    Returns:
+        list: One result per move.
+    """
+    stepper = steppercontrol.steppers['x']
+    stage = simhardware.GPIO.stages['x']
+    savedwidth = stepper.pulsewidth
+    stepper.pulsewidth = pulsewidth
+    results = []
+    stepper.moveto(0.0)
+    for distance in distances:
+        for target in (distance, 0.0):
+            startsteps = stepper.stepcount
+            starttime = perf_counter()
+            stepper.moveto(target)
+            elapsed = perf_counter() - starttime
+            results.append({'distance': distance, 'target': target, 'seconds': round(elapsed, 3),
+                            'predicted': round(stepper.estimator.predicted, 3),
+                            'steps': abs(stepper.stepcount - startsteps),
+                            'error': round(steppercontrol.positions.location('x') - target, 5),
+                            'stageerror': round(stage.position() - target, 5)})
+    stepper.pulsewidth = savedwidth
+    return results
+
+
+def sampleadc(adc, duration):
+    """
+    Reads channel 1 of an ADC for the given time, and at least three times.
+
+    Returns:
+        tuple: The time in seconds of each read and the total time taken.
+    """
+    samples = []
+    starttime = perf_counter()
+    while perf_counter() - starttime < duration or len(samples) < 3:
+        readtime = perf_counter()
+        adc.read_raw(1)
+        samples.append(perf_counter() - readtime)
+    return samples, perf_counter() - starttime
+
+
+def benchadc(adcclass, duration, busclass=None):
+    """
+    Measures ADCPi.read_raw samples per second for each bit rate, in one-shot and
+    continuous conversion modes.
+
+    Args:
+        adcclass: The ADCPi class of the ADCPi library.
+        duration (float): Seconds to sample for at each setting, at least three samples are
+            always taken.
+        busclass: Optional callable returning a simulated bus. When given, the SMBus the
+            library opens is replaced by a new simulated bus for each setting and the
+            number of bus reads per sample is reported.
+
+    Returns:
+        dict: Results keyed by 'bitrate mode'.
+    """
+    library = sys.modules[adcclass.__module__]
+    smbus = getattr(library, 'SMBus', None)
+    results = {}
+    try:
+        for bitrate in (12, 14, 16, 18):
+            for mode, name in ((0, 'oneshot'), (1, 'continuous')):
+                if busclass is not None:
+                    bus = busclass()
+                    library.SMBus = lambda number, bus=bus: bus
+                    adc = adcclass(0x68, 0x69, bitrate, 1)
+                else:
+                    adc = adcclass(0x68, 0x69, bitrate)
+                adc.set_conversion_mode(mode)
+                adc.read_raw(1)
+                samples, elapsed = sampleadc(adc, duration)
+                result = {'samplespersecond': round(len(samples) / elapsed, 2), 'latency': summarise(samples)}
+                if busclass is not None:
+                    result['busreadspersample'] = round(bus.reads / (len(samples) + 1), 2)
+                results['%s %s' % (bitrate, name)] = result
+    finally:
+        if busclass is not None:
+            library.SMBus = smbus
+    return results
+
+
+def webclient(client, call, requests, samples, failures):
+    """
+    Makes the requests of one web benchmark thread.
+
+    Args:
+        client: The Flask test client of the thread.
+        call: Function making one request with the client.
+        requests (int): Number of requests to make.
+        samples (list): The latency of each request is appended to it.
+        failures (list): The status of each failed request is appended to it.
+    """
+    for _ in range(requests):
+        starttime = perf_counter()
+        response = call(client)
+        samples.append(perf_counter() - starttime)
+        if response.status_code >= 400:
+            failures.append(response.status_code)
+
+
+def benchweb(threads, requests):
+    """
+    Measures the latency of / and /api under concurrent load, each thread uses its own
+    Flask test client.
+
+    Args:
+        threads (int): Number of concurrent client threads.
+        requests (int): Requests per thread for each endpoint.
+
+    Returns:
+        dict: Results for each endpoint.
+    """
+    import app  # pylint: disable=import-outside-toplevel
+    headers = {'Api-Key': settings['api-key']}
+    calls = {'/': lambda client: client.get('/'),
+             '/api': lambda client: client.post('/api', json={'item': 'getxystatus', 'command': ''},
+                                                headers=headers)}
+    results = {}
+    for route, call in calls.items():
+        samples = []
+        failures = []
+        workers = [Thread(target=webclient, args=(app.app.test_client(), call, requests, samples, failures),
+                          name='Benchmark Client') for _ in range(threads)]
+        starttime = perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = perf_counter() - starttime
+        results[route] = {'threads': threads, 'requestspersecond': round(len(samples) / elapsed, 1),
+                          'failures': len(failures), 'latency': summarise(samples)}
+    return results
+
+
+def flatten(results, prefix=''):
+    """Returns a dictionary of the numeric values in nested results keyed by their path"""
+    values = {}
+    items = results.items() if isinstance(results, dict) else enumerate(results)
+    for key, value in items:
+        path = '%s/%s' % (prefix, key) if prefix else str(key)
+        if isinstance(value, (dict, list)):
+            values.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[path] = value
+    return values
+
+
+def compare(results, baseline):
+    """Prints each result against the baseline with the percentage change"""
+    before = flatten(baseline)
+    for path, value in flatten(results).items():
+        if path in before and before[path]:
+            change = (value - before[path]) / abs(before[path]) * 100
+            print('%-50s %12s -> %-12s %+7.1f%%' % (path, before[path], value, change), file=sys.stderr)
+
+
+def arguments():
+    """Returns the command line arguments"""
+    parser = argparse.ArgumentParser(description='X-Y controller benchmarks on the simulated hardware')
+    parser.add_argument('--only', default='steps,moveto,adc,web',
+                        help='comma separated benchmarks to run: steps, moveto, adc, web')
+    parser.add_argument('--steps', type=int, default=400, help='steps per movenext/moveprevious run')
+    parser.add_argument('--pulsewidths', default='0,0.001,0.025', help='pulse widths for the steps benchmark')
+    parser.add_argument('--distances', default='0.02,0.1,0.5', help='moveto distances in volts')
+    parser.add_argument('--pulsewidth', type=float, default=0.005, help='pulse width for the moveto benchmark')
+    parser.add_argument('--adc', choices=('sim', 'board'), default='sim', help='ADC to measure')
+    parser.add_argument('--adcduration', type=float, default=0.5, help='seconds per ADC setting')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent web clients')
+    parser.add_argument('--requests', type=int, default=50, help='requests per web client')
+    parser.add_argument('--output', help='write the results to this file as well as stdout')
+    parser.add_argument('--baseline', help='results file to compare against')
+    return parser.parse_args()
+
+
+def run():
+    """Runs the selected benchmarks and writes the results"""
+    args = arguments()
+    selected = args.only.split(',')
+
+    settings['simulate'] = True
+    settings['motionprocess'] = False
+    settings['positionshare'] = False
+    settings['controlsocket'] = ''
+    settings['controlport'] = 0
+    settings['commandlog'] = ''
+    workdir = tempfile.mkdtemp(prefix='xycontrol-benchmark-')
+    settings['statefile'] = os.path.join(workdir, 'stagestate.json')
+    settings['cputemp'] = os.path.join(workdir, 'cputemp')
+    with open(settings['cputemp'], 'w', encoding='utf-8') as f:
+        f.write('45000\n')
+    import simhardware  # pylint: disable=import-outside-toplevel
+    import steppercontrol  # pylint: disable=import-outside-toplevel
+
+    results = {'version': VERSION, 'python': platform.python_version(), 'machine': platform.machine(),
+               'time': datetime.now().isoformat(timespec='seconds')}
+    steppercontrol.start()
+    sleep(0.5)  # let the position thread take its first readings
+    try:
+        if 'steps' in selected:
+            results['steps'] = benchsteps(steppercontrol, simhardware, args.steps,
+                                          [float(width) for width in args.pulsewidths.split(',')])
+        if 'moveto' in selected:
+            results['moveto'] = {'pulsewidth': args.pulsewidth,
+                                 'moves': benchmoveto(steppercontrol, simhardware,
+                                                      [float(distance) for distance in args.distances.split(',')],
+                                                      args.pulsewidth)}
+        if 'adc' in selected:
+            try:
+                from ADCPi import ADCPi  # pylint: disable=import-outside-toplevel
+            except ImportError:
+                print('benchmark: the ADCPi library is not installed, adc skipped', file=sys.stderr)
+            else:
+                if args.adc == 'board':
+                    results['adc'] = {'board': benchadc(ADCPi, args.adcduration)}
+                else:
+                    results['adc'] = {'sim': benchadc(ADCPi, args.adcduration,
+                                                      lambda: simhardware.SimSMBusClass(simhardware.stages))}
+        if 'web' in selected:
+            results['web'] = benchweb(args.threads, args.requests)
+    finally:
+        steppercontrol.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    run()
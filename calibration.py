@@ -0,0 +1,110 @@
+"""
+Position calibration, maps the ADC position of an axis in volts to millimetres and back. The
+position potentiometers are not perfectly linear, so each axis has a lookup table of
+calibration points, a position in volts and the position in millimetres measured there, and
+positions in between are interpolated along the straight line between the two nearest
+points, found by binary search. Beyond the end points the end segments are extended.
+
+The table is stored compactly as two arrays of doubles and is set from the 'xcalibration'
+and 'ycalibration' settings, a list of [volts, mm] pairs. Points are added at the current
+position with the xcalibrate / ycalibrate API commands.
+"""
+
+from array import array
+from bisect import bisect_right
+
+MIN_SPACING = 0.005
+
+
+def interpolate(keys, values, key):
+    """
+    Interpolates a value in a table sorted by increasing key, extending the end segments
+    beyond the table.
+
+    Args:
+        keys: Sequence of keys in increasing order, at least two.
+        values: Sequence of the value at each key.
+        key (float): Key to interpolate at.
+
+    Returns:
+        float: The interpolated value.
+    """
+    index = min(max(bisect_right(keys, key), 1), len(keys) - 1)
+    lowkey = keys[index - 1]
+    lowvalue = values[index - 1]
+    return lowvalue + (key - lowkey) * (values[index] - lowvalue) / (keys[index] - lowkey)
+
+
+class CalibrationClass:
+    """
+    Calibration table of one axis.
+
+    Attributes:
+        volts: array of the calibration point positions in volts, increasing.
+        mm: array of the position in millimetres at each point, increasing or decreasing.
+        mmkeys: mm in increasing order, negated if mm decreases, for binary search.
+        sign: 1 if mm increases with volts, -1 if it decreases.
+    """
+    def __init__(self, points=()):
+        self.volts = array('d')
+        self.mm = array('d')
+        self.mmkeys = array('d')
+        self.sign = 1
+        self.load(points)
+
+    def load(self, points):
+        """
+        Replaces the table.
+
+        Args:
+            points: List of [volts, mm] pairs in any order.
+
+        Raises:
+            ValueError: If two points are closer than MIN_SPACING volts or the millimetres do
+                not increase or decrease steadily with the volts.
+        """
+        points = sorted((float(volts), float(mm)) for volts, mm in points)
+        for (lowvolts, lowmm), (highvolts, highmm) in zip(points, points[1:]):
+            if highvolts - lowvolts < MIN_SPACING:
+                raise ValueError('calibration points at %s and %s volts are too close' % (lowvolts, highvolts))
+            if (highmm - lowmm) * (points[-1][1] - points[0][1]) <= 0:
+                raise ValueError('calibration millimetres must increase or decrease steadily')
+        self.volts = array('d', (volts for volts, _ in points))
+        self.mm = array('d', (mm for _, mm in points))
+        self.sign = -1 if len(points) > 1 and points[-1][1] < points[0][1] else 1
+        self.mmkeys = array('d', (mm * self.sign for mm in self.mm))
+
+    def calibrated(self):
+        """Returns True if the table has enough points to convert positions"""
+        return len(self.volts) >= 2
+
+    def points(self):
+        """Returns the table as a list of [volts, mm] pairs, as stored in the settings"""
+        return [[volts, mm] for volts, mm in zip(self.volts, self.mm)]
+
+    def addpoint(self, volts, mm):
+        """
+        Adds a calibration point, replacing any point within MIN_SPACING volts of it.
+
+        Raises:
+            ValueError: If the point does not fit the rest of the table.
+        """
+        points = [point for point in self.points() if abs(point[0] - volts) >= MIN_SPACING]
+        self.load(points + [[volts, mm]])
+
+    def tomm(self, volts):
+        """Converts a position in volts to millimetres"""
+        return interpolate(self.volts, self.mm, volts)
+
+    def tovolts(self, mm):
+        """Converts a position in millimetres to volts"""
+        return interpolate(self.mmkeys, self.volts, mm * self.sign)
+
+    def slope(self, volts):
+        """Returns the millimetres per volt of the table at a position in volts"""
+        index = min(max(bisect_right(self.volts, volts), 1), len(self.volts) - 1)
+        return (self.mm[index] - self.mm[index - 1]) / (self.volts[index] - self.volts[index - 1])
+
+    def meanslope(self):
+        """Returns the millimetres per volt over the whole table"""
+        return (self.mm[-1] - self.mm[0]) / (self.volts[-1] - self.volts[0])
@@ -0,0 +1,57 @@
+"""
+Command recorder, writes every command the controller runs to a JSON lines file so a
+production command stream can be replayed later against the simulated hardware with
+replay.py. Enabled by setting 'commandlog' in settings.json to the file to write, each
+command is one line:
+
+    {"time": 1760875701.123, "item": "xmoveto", "command": 1.2}
+
+time is the Unix time the command was run. Commands from /api, batches and the control
+server are all recorded as they reach steppercontrol, /wait requests are recorded with the
+item 'wait' and the wait arguments as the command, so a replay holds back the commands a
+client sent only after its wait returned.
+"""
+
+import json
+from threading import Lock
+from time import time
+from logmanager import logger
+
+
+class CommandLogClass:
+    """
+    Appends commands to a JSON lines file.
+
+    Attributes:
+        path: The file the commands are written to.
+        file: The open file, None once closed or after a write has failed.
+        lock: Lock held while a line is written, commands arrive from several threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        try:
+            self.file = open(path, 'a', encoding='utf-8', buffering=1)  # pylint: disable=consider-using-with
+            logger.info('Recording commands to %s', path)
+        except OSError as err:
+            logger.error('Cannot record commands to %s: %s', path, err)
+            self.file = None
+
+    def record(self, item, command):
+        """Writes a command, a write that fails stops the recording"""
+        line = json.dumps({'time': round(time(), 3), 'item': item, 'command': command})
+        with self.lock:
+            if self.file is None:
+                return
+            try:
+                self.file.write(line + '\n')
+            except OSError as err:
+                logger.error('Command recording to %s stopped: %s', self.path, err)
+                self.file = None
+
+    def close(self):
+        """Closes the file"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
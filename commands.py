@@ -0,0 +1,446 @@
+"""
+Control commands, the table of API items with the schema each command argument must match.
+Commands are checked here once, where they enter the application (the /api endpoint, the
+control server or the motion client), so a malformed command is rejected with an error in
+the response rather than failing later in a motion thread. The checked and converted
+argument is what is passed on to the handler registered in steppercontrol.
+
+The axes are configured in the 'axes' setting. Items for an axis are the axis name followed
+by the action, 'xmoveto' or 'zhome', and are checked against AXIS_SCHEMAS, so a new axis
+needs no new entries here. The setting is checked once by checkaxes(), the web app, the motion
+process and the simulator all use the axes it accepts so they agree on which axes exist.
+
+This module has no hardware dependencies so the motion client can check commands before
+they are sent to the motion process.
+"""
+
+import math
+from app_control import settings, axissetting
+from calibration import CalibrationClass
+
+STEP_MODES = ('half', 'full', 'wave', 'auto')
+ENERGISE_POLICIES = ('pulse', 'move', 'idle')
+BATCH_MAX_COMMANDS = 100
+axescheck = None  # ('axes' setting, checkaxes() result) kept by checkedaxes()
+
+
+class CommandError(ValueError):
+    """Raised when a control item is not recognised or its command argument is invalid"""
+
+
+def anything(value):
+    """Schema for commands whose argument is ignored"""
+    return value
+
+
+def integer(value):
+    """
+    Schema for a whole number of steps, accepts an int or a string holding an int.
+
+    Raises:
+        CommandError: If the value is not a whole number.
+    """
+    if isinstance(value, bool):
+        raise CommandError('expected a whole number, got %r' % value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    raise CommandError('expected a whole number, got %r' % value)
+
+
+def number(value):
+    """
+    Schema for a position, accepts an int, float or a string holding a number.
+
+    Raises:
+        CommandError: If the value is not a finite number.
+    """
+    if not isinstance(value, bool) and isinstance(value, (int, float, str)):
+        try:
+            converted = float(value)
+        except ValueError:
+            converted = math.nan
+        if math.isfinite(converted):
+            return converted
+    raise CommandError('expected a number, got %r' % value)
+
+
+def choice(*options):
+    """
+    Returns a schema that accepts only the given values.
+
+    Args:
+        *options: The allowed values.
+    """
+    def check(value):
+        if isinstance(value, bool) or value not in options:
+            raise CommandError('expected one of %s, got %r' % (', '.join(str(option) for option in options), value))
+        return value
+    return check
+
+
+def withmode(schema, key):
+    """
+    Returns a schema for a move command that may choose the step mode for that move alone,
+    either the plain argument, or a dictionary holding the argument under key and the mode
+    under 'mode', {"position": 1.2, "mode": "full"}. The axis step mode is left as it is.
+
+    Args:
+        schema: Schema for the plain argument.
+        key (str): Name of the argument in the dictionary form.
+    """
+    def check(value):
+        if not isinstance(value, dict):
+            return schema(value)
+        if key not in value or not set(value) <= {key, 'mode'}:
+            raise CommandError('expected {"%s": ..., "mode": ...}, got %r' % (key, value))
+        checked = {key: schema(value[key])}
+        if value.get('mode') is not None:
+            checked['mode'] = choice(*STEP_MODES)(value['mode'])
+        return checked
+    return check
+
+
+def moveargument(command, key):
+    """
+    Splits a command checked by a withmode() schema into its argument and step mode.
+
+    Args:
+        command: The checked command.
+        key (str): Name of the argument in the dictionary form.
+
+    Returns:
+        tuple: (argument, mode), mode None to use the axis step mode.
+    """
+    if isinstance(command, dict):
+        return command[key], command.get('mode')
+    return command, None
+
+
+def calibrationpoint(value):
+    """
+    Schema for a calibration command, a position in millimetres or 'clear'.
+
+    Raises:
+        CommandError: If the value is neither.
+    """
+    if value == 'clear':
+        return value
+    try:
+        return number(value)
+    except CommandError:
+        raise CommandError("expected a number or 'clear', got %r" % (value,)) from None
+
+
+def checkaxis(config):
+    """
+    Checks one entry of the 'axes' setting on its own, every setting the stepper of the axis
+    is built from, see steppercontrol.newstepper().
+
+    Args:
+        config (dict): The entry of the axis.
+
+    Returns:
+        list: The GPIO pins the axis uses, its four coil pins and any limit switches.
+
+    Raises:
+        CommandError: If a setting of the axis is invalid.
+    """
+    if not isinstance(config, dict):
+        raise CommandError('expected a dictionary, got %r' % (config,))
+
+    def check(key, schema, default=None):
+        try:
+            return schema(axissetting(config, key, default))
+        except CommandError as err:
+            raise CommandError('%s: %s' % (key, err)) from None
+
+    def pinlist(count):
+        def schema(value):
+            if not isinstance(value, (list, tuple)) or len(value) != count:
+                raise CommandError('expected a list of %s GPIO pins, got %r' % (count, value))
+            return [pin if pin is None else integer(pin) for pin in value]
+        return schema
+
+    def atleast(minimum, inclusive=True):
+        def schema(value):
+            value = number(value)
+            if value < minimum or (value == minimum and not inclusive):
+                raise CommandError('expected a number %s %s, got %r' % ('from' if inclusive else 'above', minimum, value))
+            return value
+        return schema
+
+    name = config.get('name')
+    if not isinstance(name, str) or not name.isalnum() or name == 'all':
+        raise CommandError('name %r is not a name of letters and digits' % (name,))
+    pins = [pin for pin in check('pins', pinlist(4)) if pin is not None]
+    if len(pins) != 4:
+        raise CommandError('pins: expected four GPIO pins')
+    pins.extend(pin for pin in check('limitswitches', pinlist(2), [None, None]) if pin is not None)
+    if len(set(pins)) != len(pins):
+        raise CommandError('a GPIO pin is used twice in %s' % pins)
+    check('channel', choice(1, 2, 3, 4, 5, 6, 7, 8))
+    check('energise', choice(*ENERGISE_POLICIES), 'pulse')
+    check('stepmode', choice(*STEP_MODES), 'half')
+    check('idletime', atleast(0), 0)
+    check('pulsewidth', atleast(0, False), 1)
+    check('voltsperstep', atleast(0, False), 1)
+    if check('lowerlimit', number, -2.1) >= check('upperlimit', number, 2.1):
+        raise CommandError('lowerlimit must be below upperlimit')
+    try:
+        CalibrationClass(axissetting(config, 'calibration', []))
+    except (ValueError, TypeError) as err:
+        raise CommandError('calibration: %s' % err) from None
+    return pins
+
+
+def checkaxes(axes):
+    """
+    Checks the 'axes' setting. An axis with a bad setting, a name already taken or a GPIO pin
+    or ADC channel used by an axis before it is left out.
+
+    Args:
+        axes (list): The 'axes' setting.
+
+    Returns:
+        tuple: (accepted, rejected), the entries of the axes that can be used in order, and
+        (entry, reason) for each axis left out.
+    """
+    accepted, rejected = [], []
+    names, pins, channels = set(), set(), set()
+    for config in axes:
+        try:
+            axispins = checkaxis(config)
+            if config['name'] in names:
+                raise CommandError('the name %s is already used' % config['name'])
+            if pins & set(axispins):
+                raise CommandError('GPIO pins %s are used by another axis' % sorted(pins & set(axispins)))
+            if config['channel'] in channels:
+                raise CommandError('ADC channel %s is used by another axis' % config['channel'])
+        except CommandError as err:
+            rejected.append((config, str(err)))
+            continue
+        names.add(config['name'])
+        pins.update(axispins)
+        channels.add(config['channel'])
+        accepted.append(config)
+    return accepted, rejected
+
+
+def checkedaxes():
+    """
+    Returns checkaxes() of the 'axes' setting. The setting is checked the first time it is
+    needed and the result kept, so the item lookups made for every command do not check it
+    again. It is only checked again if the setting is replaced by another list.
+
+    Returns:
+        tuple: (accepted, rejected) as returned by checkaxes().
+    """
+    global axescheck
+    axes = settings['axes']
+    if axescheck is None or axescheck[0] is not axes:
+        axescheck = (axes, checkaxes(axes))
+    return axescheck[1]
+
+
+def configuredaxes():
+    """Returns the entries of the 'axes' setting that checkaxes() accepts, in order"""
+    return checkedaxes()[0]
+
+
+def axisnames():
+    """Returns the names of the configured axes in the order they are set in 'axes'"""
+    return [axis['name'] for axis in configuredaxes()]
+
+
+def axisorall(value):
+    """
+    Schema for the name of an axis or 'all'.
+
+    Raises:
+        CommandError: If the value is neither.
+    """
+    return choice(*axisnames(), 'all')(value)
+
+
+def rastergrid(value):
+    """
+    Schema for a raster scan command, 'status', 'stop' or a scan definition holding two axes
+    by name with [start, end] positions, such as 'x' and 'y', 'pitch' as the distance between
+    points on both axes or a [pitch, pitch] pair in the order the axes are configured, and
+    optionally 'fast' the axis scanned along each line (the first axis), 'serpentine' (true),
+    'closedloop' (true) to finish each move with moveto, 'dwell' seconds at each point (0) and
+    'channels' a list of extra ADC channels read at each point. The scan definition returned
+    lists the two axes under 'axes'.
+
+    Returns:
+        The command, or the scan definition with every key filled in.
+
+    Raises:
+        CommandError: If the command is none of these or a value is invalid.
+    """
+    if value in ('status', 'stop'):
+        return value
+    if not isinstance(value, dict):
+        raise CommandError("expected 'status', 'stop' or a scan definition, got %r" % (value,))
+    axes = [name for name in axisnames() if name in value]
+    unknown = set(value) - set(axes) - {'axes', 'pitch', 'fast', 'serpentine', 'closedloop', 'dwell', 'channels'}
+    if unknown:
+        raise CommandError('unknown scan keys %s' % ', '.join(sorted(unknown)))
+    if len(axes) != 2:
+        raise CommandError('a scan needs [start, end] for two of the axes %s' % ', '.join(axisnames()))
+    scan = {'axes': axes}
+    for axis in axes:
+        span = value.get(axis)
+        if not isinstance(span, (list, tuple)) or len(span) != 2:
+            raise CommandError('%s must be [start, end], got %r' % (axis, span))
+        scan[axis] = [number(span[0]), number(span[1])]
+    pitch = value.get('pitch')
+    pitch = list(pitch) if isinstance(pitch, (list, tuple)) and len(pitch) == 2 else [pitch, pitch]
+    scan['pitch'] = [number(pitch[0]), number(pitch[1])]
+    if min(scan['pitch']) <= 0:
+        raise CommandError('pitch must be greater than 0')
+    scan['fast'] = choice(*axes)(value.get('fast', axes[0]))
+    for key in ('serpentine', 'closedloop'):
+        scan[key] = value.get(key, True)
+        if not isinstance(scan[key], bool):
+            raise CommandError('%s must be true or false' % key)
+    scan['dwell'] = number(value.get('dwell', 0))
+    if scan['dwell'] < 0:
+        raise CommandError('dwell must not be negative')
+    channels = value.get('channels', [])
+    if not isinstance(channels, (list, tuple)):
+        raise CommandError('channels must be a list, got %r' % (channels,))
+    scan['channels'] = [choice(1, 2, 3, 4, 5, 6, 7, 8)(channel) for channel in channels]
+    return scan
+
+
+SCHEMAS = {'getxystatus': anything,
+           'estop': axisorall,
+           'adcscan': choice('all', 1, 2, 3, 4, 5, 6, 7, 8),
+           'raster': rastergrid,
+           'restart': choice('pi')}
+
+AXIS_SCHEMAS = {'move': withmode(integer, 'steps'),
+                'moveto': withmode(number, 'position'),
+                'movetomm': withmode(number, 'position'),
+                'calibrate': calibrationpoint,
+                'home': choice(-1, 1),
+                'stepmode': choice(*STEP_MODES)}
+
+
+def splititem(item):
+    """
+    Splits a control item into the axis it is for and its action, 'xmoveto' is ('x', 'moveto').
+
+    Returns:
+        tuple: (axis, action), or (None, item) for an item that is not for an axis.
+    """
+    if isinstance(item, str) and item not in SCHEMAS:
+        for name in axisnames():
+            if item.startswith(name) and item[len(name):] in AXIS_SCHEMAS:
+                return name, item[len(name):]
+    return None, item
+
+
+def knownitem(item):
+    """Returns True if the item is in the command table or is an action of a configured axis"""
+    axis, action = splititem(item)
+    return action in SCHEMAS if axis is None else True
+
+
+def validate(item, command):
+    """
+    Checks a control item and its command argument against the command table.
+
+    Args:
+        item (str): The control item, such as 'xmove'.
+        command: The command argument from the request.
+
+    Returns:
+        The command argument converted to the type the handler expects.
+
+    Raises:
+        CommandError: If the item is not recognised or the argument is invalid.
+    """
+    axis, action = splititem(item)
+    schema = SCHEMAS.get(action) if axis is None else AXIS_SCHEMAS[action]
+    if schema is None:
+        raise CommandError('unknown item %r' % (item,))
+    try:
+        return schema(command)
+    except CommandError as err:
+        raise CommandError('%s: %s' % (item, err)) from None
+
+
+def validatewait(axis, target=None, tolerance=None, timeout=None):
+    """
+    Checks the arguments of a wait request.
+
+    Args:
+        axis: Name of an axis or 'all'.
+        target: Optional position the axis must reach, only for a single axis.
+        tolerance: Optional distance from the target that counts as arrived.
+        timeout: Optional seconds to wait before giving up.
+
+    Returns:
+        tuple: (axis, target, tolerance, timeout) converted, with None for any not given.
+
+    Raises:
+        CommandError: If an argument is invalid.
+    """
+    try:
+        axis = axisorall(axis)
+        if target is not None:
+            if axis == 'all':
+                raise CommandError('a target needs a single axis')
+            target = number(target)
+        if tolerance is not None:
+            tolerance = number(tolerance)
+            if tolerance <= 0:
+                raise CommandError('tolerance must be greater than 0')
+        if timeout is not None:
+            timeout = number(timeout)
+            if timeout < 0:
+                raise CommandError('timeout must not be negative')
+    except CommandError as err:
+        raise CommandError('wait: %s' % err) from None
+    return axis, target, tolerance, timeout
+
+
+def validatebatch(commands, stoponerror=False):
+    """
+    Checks a batch of commands, each a dictionary holding 'item' and 'command'.
+
+    Args:
+        commands: List of commands, at most BATCH_MAX_COMMANDS.
+        stoponerror (bool): True if the batch must be rejected when any command is invalid.
+
+    Returns:
+        list: (item, command, error) for each command, the command converted and error None
+        if it is valid, otherwise command None and error the reason it is invalid.
+
+    Raises:
+        CommandError: If commands is not a list of 1 to BATCH_MAX_COMMANDS entries, or with
+            stoponerror if any command is invalid.
+    """
+    if not isinstance(commands, list) or not 1 <= len(commands) <= BATCH_MAX_COMMANDS:
+        raise CommandError('batch: expected a list of 1 to %s commands' % BATCH_MAX_COMMANDS)
+    checked = []
+    for index, entry in enumerate(commands):
+        item = entry.get('item') if isinstance(entry, dict) else None
+        try:
+            if not isinstance(entry, dict) or 'item' not in entry or 'command' not in entry:
+                raise CommandError('expected {"item": ..., "command": ...}, got %r' % (entry,))
+            checked.append((item, validate(item, entry['command']), None))
+        except CommandError as err:
+            if stoponerror:
+                raise CommandError('batch command %s: %s' % (index, err)) from None
+            checked.append((item, None, str(err)))
+    return checked
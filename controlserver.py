@@ -0,0 +1,239 @@
+"""
+Control server, an asyncio alternative to the Flask /api endpoint for automation clients
+that need lower latency per command or many commands in flight. It runs in the process
+that owns the hardware (the gunicorn worker, or the motion process in motion process mode)
+on its own thread, listening on a Unix socket and/or a TCP port set in settings.json.
+
+The protocol is one JSON object per line in each direction. The first message on a
+connection must carry the api key, commands use the same item/command pairs as /api and
+are run through parsecontrol in the order they arrive. Clients can send commands without
+waiting for the replies, each reply echoes the request id:
+
+    {"api-key": "...", "id": 1, "item": "xmoveto", "command": 1.2}
+    {"id": 1, "status": {...}}
+
+{"item": "wait", "command": {"axis": "x", "target": 1.2}} holds the connection's command
+queue until the wait ends, as the /wait endpoint does, so a client can pipeline a move, a
+wait and the next move without waiting for each reply. An estop is the exception, it is run
+as soon as it arrives rather than in turn, so it is never held behind a wait, and the
+messages still queued on the connection are dropped with an error reply so a queued move
+cannot start after the estop.
+
+Commands, waits and estops run on three separate thread pools, so clients holding long
+waits cannot use up the threads the commands of other clients need, and an estop is never
+queued behind either.
+
+{"item": "subscribe", "command": 0.25} streams {"event": "status", "status": {...}} every
+0.25 seconds until {"item": "unsubscribe"} is sent or the connection closes.
+"""
+
+import json
+import asyncio
+from time import perf_counter
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from steppercontrol import parsecontrol, apistatus, waitfor
+from commands import CommandError
+import metrics
+from app_control import settings
+from logmanager import logger
+
+MIN_SUBSCRIBE_INTERVAL = 0.05
+COMMAND_THREADS = 4
+WAIT_THREADS = 32
+ESTOP_THREADS = 2
+commandpool = ThreadPoolExecutor(COMMAND_THREADS, thread_name_prefix='Control Command')
+waitpool = ThreadPoolExecutor(WAIT_THREADS, thread_name_prefix='Control Wait')
+estoppool = ThreadPoolExecutor(ESTOP_THREADS, thread_name_prefix='Control Estop')
+
+
+class ControlConnection:
+    """
+    Handles one client connection: authentication, running commands in order and any
+    status subscription.
+
+    Attributes:
+        reader: The asyncio StreamReader for the connection.
+        writer: The asyncio StreamWriter for the connection.
+        authorised: True once the client has sent the correct api key.
+        subscription: The task streaming status to the client, or None.
+        queue: asyncio Queue of the messages waiting to be run in order, None ends the worker.
+        estops: The tasks running estop commands, held so they are not garbage collected.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.authorised = False
+        self.subscription = None
+        self.queue = asyncio.Queue()
+        self.estops = set()
+
+    async def send(self, message):
+        """Writes one JSON message to the client"""
+        self.writer.write(json.dumps(message).encode() + b'\n')
+        await self.writer.drain()
+
+    async def run(self):
+        """
+        Reads messages until the client disconnects. Each message is passed to the worker
+        task which runs them in order, except an estop which is run straight away. Once the
+        client has disconnected the worker finishes the messages already read.
+        """
+        worker = asyncio.create_task(self.work())
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                    requestid = message.get('id')
+                except (ValueError, AttributeError):
+                    await self.send({'error': 'badly formed json message'})
+                    continue
+                if not self.authorised:
+                    if message.get('api-key') != settings['api-key']:
+                        logger.warning('Control server: access attempt with an invalid token')
+                        await self.send({'id': requestid, 'error': 'access token(s) unuthorised'})
+                        break
+                    self.authorised = True
+                if message.get('item') == 'estop':
+                    await self.dropqueued()
+                    task = asyncio.create_task(self.handle(message))
+                    self.estops.add(task)
+                    task.add_done_callback(self.estops.discard)
+                else:
+                    await self.queue.put(message)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            await self.queue.put(None)
+            await asyncio.gather(worker, *self.estops, return_exceptions=True)
+            self.unsubscribe()
+            self.writer.close()
+
+    async def dropqueued(self):
+        """Drops the messages waiting in the queue, replying to each that it was not run"""
+        while not self.queue.empty():
+            message = self.queue.get_nowait()
+            await self.send({'id': message.get('id'), 'error': '%s not run, dropped by estop' % message.get('item')})
+
+    async def work(self):
+        """Runs the queued messages in the order they arrived"""
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            try:
+                await self.handle(message)
+            except ConnectionError:
+                pass
+
+    async def handle(self, message):
+        """Runs one message from the client and sends the reply"""
+        loop = asyncio.get_running_loop()
+        requestid = message.get('id')
+        item = message.get('item')
+        if item is None:
+            await self.send({'id': requestid, 'status': 'authorised'})
+        elif item == 'subscribe':
+            try:
+                interval = max(float(message.get('command', 0.25)), MIN_SUBSCRIBE_INTERVAL)
+            except (TypeError, ValueError):
+                await self.send({'id': requestid, 'error': 'subscribe interval must be a number'})
+                return
+            self.unsubscribe()
+            self.subscription = asyncio.create_task(self.stream(interval))
+            await self.send({'id': requestid, 'status': 'subscribed'})
+        elif item == 'unsubscribe':
+            self.unsubscribe()
+            await self.send({'id': requestid, 'status': 'unsubscribed'})
+        else:
+            try:
+                if item == 'wait':
+                    status = await loop.run_in_executor(waitpool, self.wait, message.get('command'))
+                else:
+                    pool = estoppool if item == 'estop' else commandpool
+                    status = await loop.run_in_executor(pool, self.control, item, message.get('command'))
+            except CommandError as err:
+                await self.send({'id': requestid, 'error': str(err)})
+                return
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logger.exception('Control server: %s failed', item)
+                await self.send({'id': requestid, 'error': str(err)})
+                return
+            await self.send({'id': requestid, 'status': status})
+
+    @staticmethod
+    def control(item, command):
+        """
+        Runs a command through parsecontrol on a worker thread and returns the api status
+        with the checked command under 'result'.
+        """
+        starttime = perf_counter()
+        result = parsecontrol(item, command)
+        status = apistatus()
+        status['result'] = result
+        metrics.API_SECONDS.observe(perf_counter() - starttime, 'control', item)
+        return status
+
+    @staticmethod
+    def wait(arguments):
+        """
+        Runs waitfor on a worker thread, the arguments are a dictionary with 'axis' and
+        optionally 'target', 'tolerance' and 'timeout'.
+
+        Raises:
+            CommandError: If the arguments are not a dictionary with an axis or are invalid.
+        """
+        if not isinstance(arguments, dict) or 'axis' not in arguments:
+            raise CommandError('wait: expected {"axis": ...}')
+        return waitfor(arguments['axis'], arguments.get('target'), arguments.get('tolerance'),
+                       arguments.get('timeout'))
+
+    async def stream(self, interval):
+        """Sends the api status to the client every interval seconds"""
+        loop = asyncio.get_running_loop()
+        while True:
+            status = await loop.run_in_executor(commandpool, apistatus)
+            await self.send({'event': 'status', 'status': status})
+            await asyncio.sleep(interval)
+
+    def unsubscribe(self):
+        """Cancels the status subscription, if there is one"""
+        if self.subscription is not None:
+            self.subscription.cancel()
+            self.subscription = None
+
+
+async def handleconnection(reader, writer):
+    """asyncio server callback, one per client connection"""
+    await ControlConnection(reader, writer).run()
+
+
+async def serve():
+    """Starts the configured listeners and serves until the loop is stopped"""
+    servers = []
+    if settings['controlsocket']:
+        servers.append(await asyncio.start_unix_server(handleconnection, settings['controlsocket']))
+        logger.info('Control server listening on %s', settings['controlsocket'])
+    if settings['controlport']:
+        servers.append(await asyncio.start_server(handleconnection, settings['controlhost'],
+                                                  settings['controlport']))
+        logger.info('Control server listening on %s:%s', settings['controlhost'], settings['controlport'])
+    try:
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    finally:
+        for server in servers:
+            server.close()
+
+
+def start():
+    """
+    Starts the control server on its own thread if a socket or port is set in settings.json.
+    Does nothing if neither is set.
+    """
+    if not settings['controlsocket'] and not settings['controlport']:
+        return
+    serverthread = Thread(target=asyncio.run, args=(serve(),), name='Control Server', daemon=True)
+    serverthread.start()
@@ -0,0 +1,216 @@
+"""
+Move time estimates for the XY table. Each stepper has an EstimatorClass that predicts
+how long a move will take when it is queued, refines the prediction as the move runs and
+learns the volts and millimetres per half-step of the axis from the moves it makes.
+"""
+
+from time import monotonic
+from logmanager import logger
+from app_control import settings
+import metrics
+
+AUTO_HALFSTEP_RANGE = 0.2
+FINE_RANGE = 0.05
+SETTLE_TIME = 0.3
+REFINE_MIN_STEPS = 5
+REFINE_MIN_TIME = 0.5
+CALIBRATE_MIN_STEPS = 50
+CALIBRATE_MIN_DISTANCE = 0.02
+CALIBRATE_WEIGHT = 0.3
+
+
+class EstimatorClass:
+    """
+    Predicts how long a move will take and refines the prediction as the move runs, so
+    clients can wait until the expected completion time instead of polling.
+
+    Predictions use the step period from the stepper's pulse width and energise policy,
+    the step mode, the calibrated volts per half-step and the moveto profile, where steps
+    within FINE_RANGE of the target each wait SETTLE_TIME for the ADC. Once a move has
+    made progress the remaining time is scaled by how the move has run against the
+    prediction so far. At the end of each move the volts per half-step calibration is
+    updated from the distance actually travelled.
+
+    When the axis has a position calibration table the step counts are worked out in
+    millimetres, which are linear in steps, so the local slope of the potentiometer is
+    taken into account and the estimate is as good at the ends of the travel as in the
+    middle.
+
+    Attributes:
+        stepper: The StepperClass this estimator belongs to.
+        voltsperstep: Calibrated change in ADC volts per half-step.
+        mmperstep: Calibrated millimetres per half-step, 0 until learned, used when the
+            axis has a position calibration table.
+        kind: Type of the active or queued move, 'move', 'moveto' or 'home', None when idle.
+        argument: The steps, target or direction of the move.
+        mode: Step mode of the active or queued move.
+        starttime: time.monotonic() when the active move started.
+        predicted: Predicted duration in seconds of the active move.
+        eta: time.monotonic() the move is expected to finish, 0 when idle.
+        startposition: ADC position when the active move started.
+        startsteps: The stepper's step count when the active move started.
+        samplesteps: The stepper's step count when startposition was sampled.
+    """
+    def __init__(self, stepper, voltsperstep):
+        self.stepper = stepper
+        self.voltsperstep = voltsperstep
+        self.mmperstep = 0.0
+        self.kind = None
+        self.argument = 0
+        self.mode = 'half'
+        self.starttime = 0.0
+        self.predicted = 0.0
+        self.eta = 0.0
+        self.startposition = 0.0
+        self.startsteps = 0
+        self.samplesteps = 0
+
+    def period(self):
+        """
+        Returns the time in seconds the motion loop takes per step in the current energise
+        policy, pulse mode adds the pulse width the coils are held for.
+        """
+        if self.stepper.energise == 'pulse':
+            return self.stepper.pulsewidth * 3
+        return self.stepper.pulsewidth * 2
+
+    def halfsteps(self, start, end):
+        """
+        Returns the number of half-steps between two ADC positions, through the calibration
+        table if the axis has one.
+        """
+        calibration = self.stepper.calibration
+        if calibration.calibrated():
+            mmperstep = self.mmperstep or self.voltsperstep * abs(calibration.meanslope())
+            return abs(calibration.tomm(end) - calibration.tomm(start)) / mmperstep
+        return abs(end - start) / self.voltsperstep
+
+    def traveltime(self, start, target, mode):
+        """
+        Predicts the time for moveto to travel from one position to another.
+
+        Args:
+            start (float): Starting position in ADC volts.
+            target (float): Target position in ADC volts.
+            mode (str): Step mode for the move.
+
+        Returns:
+            float: Predicted time in seconds.
+        """
+        period = self.period()
+        direction = 1 if target >= start else -1
+        fineedge = target - direction * min(abs(target - start), FINE_RANGE)
+        coarse = self.halfsteps(start, fineedge)
+        if mode in ('full', 'wave'):
+            coarse = coarse / 2
+        elif mode == 'auto':
+            bulkedge = target - direction * min(abs(target - start), AUTO_HALFSTEP_RANGE)
+            coarse = coarse - self.halfsteps(start, bulkedge) / 2
+        return coarse * period + self.halfsteps(fineedge, target) * (period + SETTLE_TIME)
+
+    def predict(self, kind, argument):
+        """
+        Predicts the duration of a move.
+
+        Args:
+            kind (str): 'move', 'moveto' or 'home'.
+            argument: Steps for 'move', target for 'moveto', direction for 'home'.
+
+        Returns:
+            float: Predicted time in seconds.
+        """
+        position = self.stepper.positions.location(self.stepper.axis)
+        if kind == 'move':
+            return abs(argument) * self.period()
+        if kind == 'moveto':
+            return self.traveltime(position, argument, self.mode)
+        limit = self.stepper.lowerlimit if argument < 0 else self.stepper.upperlimit
+        seek = self.halfsteps(position, limit) * self.stepper.pulsewidth * 2
+        backoff = settings['homebackoff'] * self.stepper.pulsewidth * 2
+        return seek + backoff + settings['homebackoff'] * (settings['homeslowdelay'] + self.period())
+
+    def queue(self, kind, argument, delay, mode=None):
+        """
+        Sets the ETA for a move that has been accepted and will start after a delay.
+
+        Args:
+            kind (str): 'move', 'moveto' or 'home'.
+            argument: Steps, target or direction.
+            delay (float): Seconds before the move starts.
+            mode (str): Step mode for the move, None for the axis step mode.
+
+        Returns:
+            float: Predicted seconds until the move completes.
+        """
+        self.mode = mode or self.stepper.stepmode
+        duration = delay + self.predict(kind, argument)
+        self.kind = kind
+        self.argument = argument
+        self.eta = monotonic() + duration
+        return duration
+
+    def begin(self, kind, argument, mode=None):
+        """Records the start of a move in the given step mode and predicts its completion time"""
+        self.mode = mode or self.stepper.stepmode
+        self.kind = kind
+        self.argument = argument
+        self.starttime = monotonic()
+        self.predicted = self.predict(kind, argument)
+        self.eta = self.starttime + self.predicted
+        self.startposition = self.stepper.positions.location(self.stepper.axis)
+        self.startsteps = self.stepper.stepcount
+        self.samplesteps = self.stepper.positions.stepcounts.get(self.stepper.axis, self.startsteps)
+
+    def remaining(self):
+        """
+        Returns the refined estimate of the time left for the active or queued move.
+
+        Returns:
+            float: Seconds until the move is expected to complete, 0 when idle.
+        """
+        if self.kind is None:
+            return 0.0
+        now = monotonic()
+        if not self.stepper.moving or self.starttime == 0:
+            return max(self.eta - now, 0.0)
+        elapsed = now - self.starttime
+        if self.kind == 'move':
+            done = abs(self.stepper.stepcount - self.startsteps)
+            todo = abs(self.argument) - done
+            perstep = elapsed / done if done > REFINE_MIN_STEPS else self.period()
+            return max(todo * perstep, 0.0)
+        if self.kind == 'moveto':
+            left = self.traveltime(self.stepper.positions.location(self.stepper.axis), self.argument, self.mode)
+            expected = self.predicted - left
+            if expected > REFINE_MIN_TIME:
+                return left * min(max(elapsed / expected, 0.5), 3.0)
+            return left
+        return max(self.eta - now, 0.0)
+
+    def finish(self):
+        """
+        Ends the move, clears the ETA, records the move duration in the metrics and updates
+        the volts per half-step calibration from the distance travelled if the move was long
+        enough to measure. The position can be one position reader interval old when a move
+        ends, so the distance is divided by the steps taken between the two position samples
+        rather than by the steps of the whole move.
+        """
+        if self.kind is not None and self.starttime:
+            positions = self.stepper.positions
+            steps = abs(positions.stepcounts.get(self.stepper.axis, self.stepper.stepcount) - self.samplesteps)
+            distance = abs(positions.location(self.stepper.axis) - self.startposition)
+            if steps >= CALIBRATE_MIN_STEPS and distance >= CALIBRATE_MIN_DISTANCE:
+                self.voltsperstep += (distance / steps - self.voltsperstep) * CALIBRATE_WEIGHT
+                logger.debug('%s calibration %.6f volts per half-step', self.stepper.axis, self.voltsperstep)
+                calibration = self.stepper.calibration
+                if calibration.calibrated():
+                    mm = abs(calibration.tomm(positions.location(self.stepper.axis)) -
+                             calibration.tomm(self.startposition)) / steps
+                    self.mmperstep += (mm - self.mmperstep) * (CALIBRATE_WEIGHT if self.mmperstep else 1)
+            elapsed = monotonic() - self.starttime
+            metrics.MOVE_SECONDS.observe(elapsed, self.stepper.axis, self.kind)
+            logger.debug('%s %s took %.2f seconds, predicted %.2f', self.stepper.axis, self.kind,
+                         elapsed, self.predicted)
+        self.kind = None
+        self.starttime = 0.0
+        self.eta = 0.0
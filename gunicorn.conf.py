@@ -0,0 +1,29 @@
+"""
+Gunicorn configuration hooks for the X-Y Controller. Gunicorn reads this file from the
+working directory when it starts, the hooks tie the hardware lifecycle in steppercontrol
+to the worker lifecycle so the GPIO and ADC are set up once the worker is running and
+released cleanly when the worker exits. When 'motionprocess' is set the hardware belongs to
+the motion process instead and the hooks do nothing, so any number of workers can be run.
+"""
+
+from app_control import settings
+
+
+def post_worker_init(worker):
+    """Initialise the stepper hardware and the control server once the worker has loaded the app"""
+    if settings['motionprocess']:
+        return
+    from steppercontrol import start  # pylint: disable=import-outside-toplevel
+    import controlserver  # pylint: disable=import-outside-toplevel
+    worker.log.info('Starting xy controller hardware')
+    start()
+    controlserver.start()
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Stop the steppers and the position thread when the worker exits"""
+    if settings['motionprocess']:
+        return
+    from steppercontrol import shutdown  # pylint: disable=import-outside-toplevel
+    worker.log.info('Shutting down xy controller hardware')
+    shutdown()
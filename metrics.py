@@ -0,0 +1,161 @@
+"""
+Metrics, counters and histograms for the motion, ADC and web code, served in the Prometheus
+text format by the /metrics endpoint.
+
+Counting has to cost next to nothing on the step path. A counter label can be written by more
+than one thread, a new move on an axis starts its motion loop before the old loop has exited
+and the ADC counters are written by every thread that reads the ADC, so counters and
+histograms each hold a lock while a value is added. The lock is uncontended almost all the
+time and costs far less than a step.
+
+In motion process mode the motion and ADC metrics are in the motion process, the web
+process fetches a snapshot() from it and merges it with its own before rendering.
+"""
+
+from bisect import bisect_left
+from threading import Lock, active_count
+
+REGISTRY = []
+
+
+class CounterClass:
+    """
+    A counter with labels, only ever increases.
+
+    Attributes:
+        name: Metric name.
+        description: Help text for the metric.
+        labelnames: Tuple of label names.
+        values: Dictionary mapping a tuple of label values to the count.
+        lock: Lock held while the count is added to.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount=1):
+        """Adds to the count for the label values"""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """Returns a list of (suffix, labels dictionary, value) samples"""
+        with self.lock:
+            values = list(self.values.items())
+        return [('', dict(zip(self.labelnames, labels)), value) for labels, value in values]
+
+
+class HistogramClass:
+    """
+    A histogram with labels, counts observations into cumulative buckets.
+
+    Attributes:
+        name: Metric name.
+        description: Help text for the metric.
+        labelnames: Tuple of label names.
+        buckets: Tuple of bucket upper bounds in increasing order.
+        values: Dictionary mapping a tuple of label values to [bucket counts, sum, count].
+        lock: Lock held while an observation is added.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        """Adds an observation for the label values"""
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        """Returns a list of (suffix, labels dictionary, value) samples"""
+        result = []
+        with self.lock:
+            values = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in self.values.items()]
+        for labels, counts, total, count in values:
+            names = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, bucketcount in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucketcount
+                result.append(('_bucket', dict(names, le='+Inf' if bound == float('inf') else repr(bound)),
+                               cumulative))
+            result.append(('_sum', names, total))
+            result.append(('_count', names, count))
+        return result
+
+
+def snapshot(process):
+    """
+    Returns every metric in this process with its current samples, including the thread count
+    labelled with the process name. The snapshot can be sent between processes and rendered
+    with the snapshots of other processes.
+
+    Args:
+        process (str): Name of this process, 'web' or 'motion'.
+
+    Returns:
+        list: (name, type, help, samples) tuples.
+    """
+    metrics = [(metric.name, metric.kind, metric.description, metric.samples()) for metric in REGISTRY]
+    metrics.append(('xycontrol_threads', 'gauge', 'Number of active threads',
+                    [('', {'process': process}, active_count())]))
+    return metrics
+
+
+def render(*snapshots):
+    """
+    Renders snapshots in the Prometheus text format, samples of a metric that appears in more
+    than one snapshot are listed under the one HELP and TYPE line.
+
+    Returns:
+        str: The metrics text.
+    """
+    merged = {}
+    for metrics in snapshots:
+        for name, kind, description, samples in metrics:
+            if name not in merged:
+                merged[name] = (kind, description, [])
+            merged[name][2].extend(samples)
+    lines = []
+    for name, (kind, description, samples) in merged.items():
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for suffix, labels, value in samples:
+            text = ','.join('%s="%s"' % (key, str(label).replace('"', '\\"')) for key, label in labels.items())
+            lines.append('%s%s%s %s' % (name, suffix, '{%s}' % text if text else '', value))
+    return '\n'.join(lines) + '\n'
+
+
+ADC_CONVERSIONS = CounterClass('xycontrol_adc_conversions_total', 'ADC conversions read', ('channel',))
+ADC_TIMEOUTS = CounterClass('xycontrol_adc_timeouts_total', 'ADC conversions that timed out', ('channel',))
+ADC_SECONDS = HistogramClass('xycontrol_adc_conversion_seconds', 'Time to read an ADC conversion', ('channel',),
+                             (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0))
+ADC_ERRORS = CounterClass('xycontrol_adc_errors_total', 'ADC reads that failed on the I2C bus', ('channel',))
+ADC_SHARED = CounterClass('xycontrol_adc_shared_total', 'ADC reads served from a conversion already running',
+                          ('channel',))
+ADC_REOPENS = CounterClass('xycontrol_adc_reopens_total', 'Times the ADC has been opened again')
+STEPS = CounterClass('xycontrol_steps_total', 'Steps written to the coils', ('axis',))
+MOVETO_OVERRUNS = CounterClass('xycontrol_moveto_overruns_total', 'moveto stopped by the step counter guard',
+                               ('axis',))
+MOVE_SECONDS = HistogramClass('xycontrol_move_seconds', 'Duration of moves', ('axis', 'kind'),
+                              (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600))
+API_SECONDS = HistogramClass('xycontrol_api_request_seconds', 'Time to run an API command', ('interface', 'item'),
+                             (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
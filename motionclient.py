@@ -0,0 +1,193 @@
+"""
+Motion client, used by the Flask app in place of steppercontrol when 'motionprocess' is
+set in settings.json. It provides the same httpstatus, apistatus, parsecontrol, parsebatch,
+runselftest, waitfor and rasterdata functions, each call is passed to the motion process over its Unix socket.
+Positions for the web pages are read straight from the shared memory segment the motion
+process publishes. Each request thread keeps its own connection to the motion process.
+A restarted motion process creates a new segment, so the segment is opened again when a
+connection to the motion process is lost or the positions in it stop updating.
+"""
+
+from threading import local
+from multiprocessing.connection import Client
+from positionshare import PositionShareClass
+from commands import CommandError, validate, validatewait, validatebatch, axisnames
+from app_control import settings
+from logmanager import logger
+
+connections = local()
+share = None
+IDEMPOTENT_FUNCTIONS = ('httpstatus', 'apistatus', 'waitfor', 'rasterdata', 'metrics')
+SHARE_STALE_AGE = 2.0
+
+
+def retryable(name, args):
+    """
+    Checks if a call can safely be sent again after the connection broke while waiting for
+    the reply, when the motion process may already have run it. Reads and waits can be
+    repeated, as can an estop, but a move or any other command must not run twice.
+
+    Args:
+        name (str): Name of the function.
+        args (tuple): Arguments for the function.
+
+    Returns:
+        bool: True if running the call twice does no harm.
+    """
+    if name == 'parsecontrol':
+        return args[0] == 'estop'
+    return name in IDEMPOTENT_FUNCTIONS
+
+
+def call(name, *args):
+    """
+    Calls a function in the motion process and returns its result. If the connection is
+    broken when the call is sent, usually because the motion process has restarted, it is
+    reopened and the call sent once more. If it breaks while waiting for the reply the call
+    may already have run, so it is only sent again if retryable() allows it.
+
+    Args:
+        name (str): Name of the function, one of motionprocess.REMOTE_FUNCTIONS.
+        *args: Arguments for the function.
+
+    Returns:
+        The value returned by the function in the motion process.
+
+    Raises:
+        CommandError: If the motion process rejected a command.
+        RuntimeError: If the function raised any other exception in the motion process.
+        ConnectionError: If the motion process cannot be reached, or the connection broke
+            after a call that cannot be repeated was sent.
+    """
+    global share
+    for attempt in range(2):
+        try:
+            if getattr(connections, 'connection', None) is None:
+                connections.connection = Client(settings['motionsocket'], 'AF_UNIX',
+                                                authkey=settings['api-key'].encode())
+            connections.connection.send((name, args))
+        except (EOFError, OSError) as err:
+            connections.connection = None
+            share = None
+            if attempt:
+                logger.error('motion client: cannot reach the motion process: %s', err)
+                raise ConnectionError('motion process is not running') from err
+            continue
+        try:
+            status, result = connections.connection.recv()
+            break
+        except (EOFError, OSError) as err:
+            connections.connection = None
+            share = None
+            if attempt or not retryable(name, args):
+                logger.error('motion client: connection lost waiting for %s: %s', name, err)
+                raise ConnectionError('connection to the motion process lost, %s may have run' % name) from err
+    if status == 'invalid':
+        raise CommandError(result)
+    if status == 'error':
+        raise RuntimeError(result)
+    return result
+
+
+def positionshare(count):
+    """
+    Returns the reader of the shared memory positions, opened the first time it is needed.
+    It is opened again if the latest sample is older than SHARE_STALE_AGE, as it is when the
+    motion process has restarted and this mapping is still on the segment it removed, or if
+    the sample cannot be read because the motion process died part way through writing it. The
+    old reader is left for any thread still reading it to drop.
+
+    Args:
+        count (int): Number of axes in each sample.
+
+    Returns:
+        PositionShareClass: The reader, or None if the segment does not exist.
+    """
+    global share
+    reader = share
+    try:
+        if reader is not None and reader.age() > SHARE_STALE_AGE:
+            reader = None
+    except TimeoutError:
+        reader = None
+    if reader is None:
+        try:
+            reader = PositionShareClass(settings['positionshm'], count=count)
+        except FileNotFoundError:
+            reader = None
+        share = reader
+    return reader
+
+
+def httpstatus():
+    """
+    Returns the rounded position of each axis for the status page, read from shared memory.
+
+    Returns:
+        dict: A dictionary with a `<axis>pos` key for each axis, `xpos` and `ypos` by default,
+        rounded to four decimal points.
+
+    Raises:
+        ConnectionError: If there is no segment and the motion process cannot be reached.
+    """
+    names = axisnames()
+    reader = positionshare(len(names))
+    if reader is not None:
+        try:
+            values = reader.read()[1:]
+            return {'%spos' % axis: round(value, 4) for axis, value in zip(names, values)}
+        except TimeoutError:
+            pass
+    return call('httpstatus')
+
+
+def apistatus():
+    """Returns steppercontrol.apistatus() from the motion process"""
+    return call('apistatus')
+
+
+def parsecontrol(item, command):
+    """
+    Runs steppercontrol.parsecontrol(item, command) in the motion process. The command is
+    checked here first so a malformed command is rejected without a round trip.
+    """
+    validate(item, command)
+    return call('parsecontrol', item, command)
+
+
+def parsebatch(commands, stoponerror=False):
+    """
+    Runs steppercontrol.parsebatch(commands, stoponerror) in the motion process, the whole batch
+    in one round trip. The commands are checked here first.
+    """
+    validatebatch(commands, stoponerror)
+    return call('parsebatch', commands, stoponerror)
+
+
+def runselftest():
+    """Runs steppercontrol.runselftest() in the motion process"""
+    return call('runselftest')
+
+
+def waitfor(axis, target=None, tolerance=None, timeout=None):
+    """
+    Runs steppercontrol.waitfor() in the motion process, the request thread's connection is
+    held until the wait ends. The arguments are checked here first.
+    """
+    validatewait(axis, target, tolerance, timeout)
+    return call('waitfor', axis, target, tolerance, timeout)
+
+
+def rasterdata(form):
+    """Returns steppercontrol.rasterdata(form) from the motion process"""
+    return call('rasterdata', form)
+
+
+def profile(seconds, interval):
+    """Runs profiler.profile() in the motion process and returns the profile"""
+    return call('profile', seconds, interval, settings['profilemaxseconds'])
+
+
+def metrics():
+    """Returns the metrics snapshot of the motion process"""
+    return call('metrics')
@@ -0,0 +1,93 @@
+"""
+Motion process, runs the stepper hardware and motion loops in their own process, away
+from the gunicorn workers. Enabled by setting 'motionprocess' to true in settings.json and
+running this module as its own service (see raspberry-pi/etc/systemd/system/xymotion.service).
+
+The Flask app talks to this process through motionclient over a Unix socket, the socket is
+authenticated with the api key. steppercontrol also publishes the latest positions in shared
+memory in this mode so the web pages can read them without a round trip. Because only this
+process drives the GPIOs it is safe to run gunicorn with more than one worker.
+"""
+
+import os
+import signal
+from threading import Thread, Event
+from multiprocessing.connection import Listener
+import steppercontrol
+import profiler
+import metrics
+import controlserver
+from commands import CommandError
+from app_control import settings
+from logmanager import logger
+
+REMOTE_FUNCTIONS = {'parsecontrol': steppercontrol.parsecontrol,
+                    'parsebatch': steppercontrol.parsebatch,
+                    'apistatus': steppercontrol.apistatus,
+                    'httpstatus': steppercontrol.httpstatus,
+                    'runselftest': steppercontrol.runselftest,
+                    'waitfor': steppercontrol.waitfor,
+                    'rasterdata': steppercontrol.rasterdata,
+                    'profile': profiler.profile,
+                    'metrics': lambda: metrics.snapshot('motion')}
+
+
+def serveconnection(connection):
+    """
+    Serves requests from one client connection until the client closes it. Each request
+    is a (function name, arguments) tuple, the reply is ('ok', result), ('invalid', message)
+    for a rejected command or ('error', message) for any other failure.
+
+    Args:
+        connection: The multiprocessing Connection to the client.
+    """
+    try:
+        while True:
+            name, args = connection.recv()
+            try:
+                connection.send(('ok', REMOTE_FUNCTIONS[name](*args)))
+            except CommandError as err:
+                connection.send(('invalid', str(err)))
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logger.exception('motion process: %s%s failed', name, args)
+                connection.send(('error', '%s: %s' % (type(err).__name__, err)))
+    except (EOFError, OSError):
+        pass
+    finally:
+        connection.close()
+
+
+def run():
+    """
+    Starts the hardware and the control server, then serves motion client connections
+    until the process is sent SIGTERM or SIGINT, then shuts the hardware down cleanly.
+    """
+    stopping = Event()
+    steppercontrol.start()
+    controlserver.start()
+    if os.path.exists(settings['motionsocket']):
+        os.remove(settings['motionsocket'])
+    listener = Listener(settings['motionsocket'], 'AF_UNIX', authkey=settings['api-key'].encode())
+    os.chmod(settings['motionsocket'], 0o660)
+
+    def stop(signum, frame):  # pylint: disable=unused-argument
+        stopping.set()
+        listener.close()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info('motion process listening on %s', settings['motionsocket'])
+    while not stopping.is_set():
+        try:
+            connection = listener.accept()
+        except OSError:
+            if stopping.is_set():
+                break
+            logger.exception('motion process: connection failed')
+            continue
+        Thread(target=serveconnection, args=(connection,), name='Motion Client', daemon=True).start()
+    logger.info('motion process stopping')
+    steppercontrol.shutdown()
+
+
+if __name__ == '__main__':
+    run()
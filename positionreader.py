@@ -0,0 +1,253 @@
+"""
+Position reader for the XY table, samples the ADC position channel of every axis every
+POSITION_INTERVAL seconds on its own thread and supervises the reads with a watchdog, so
+the steppers, the waiting API calls and the ADC scan all work from the same samples.
+
+The reader is created and started by steppercontrol.start(), the ADC, the steppers and
+the callback that wakes the waiting callers are handed to it there.
+"""
+
+from time import monotonic
+from threading import Timer, Event
+from logmanager import logger
+from app_control import settings
+import metrics
+
+POSITION_INTERVAL = 0.25
+READ_RETRY_DELAY = 0.05
+READ_RETRY_MAX = 2.0
+REOPEN_FAILURES = 3
+WATCHDOG_INTERVAL = 0.1
+
+
+class PositionClass:
+    """
+    Manages the axis positions obtained from ADC readings.
+
+    The class periodically reads position values from ADC inputs and
+    provides the location data along specified axes. It initializes
+    a timer thread to fetch the positional data continuously, started by
+    start() once the steppers are set up. The thread runs until shutdown()
+    is called. If share is set to a PositionShareClass each sample is also
+    published in shared memory.
+
+    The reader is supervised: a failed read is retried with an increasing delay and after
+    REOPEN_FAILURES failures in a row the ADC is opened again, so an I2C error or timeout
+    no longer ends the thread. A separate watchdog thread marks the positions stale if no
+    sample has arrived within the 'positionstaletime' setting and emergency stops any axis
+    that is moving, while the positions are stale atlimit() refuses every step.
+
+    Attributes:
+        channels: Dictionary mapping axis to the ADC channel of its position.
+        manager: ADCManagerClass every read of the ADC goes through.
+        steppers: Dictionary mapping axis to its StepperClass, read for the step counts and
+            emergency stopped by the watchdog.
+        openadc: Function that opens the ADC again and returns it, or None if it cannot.
+        onchange: Function called after every sample and when the positions go stale or
+            recover, wakes the callers waiting for motion.
+        scanner: ScanClass the position samples are recorded in, or None.
+        values: Dictionary mapping axis to its position in volts from the centre.
+        stepcounts: Dictionary mapping axis to its step count when the positions were
+            sampled, so a distance travelled can be matched to the steps taken to travel it.
+        share: PositionShareClass the samples are published to, or None.
+        running: True until shutdown() is called.
+        stopevent: Event set by shutdown() to wake the reader and watchdog threads.
+        timerthread: The position reader thread.
+        watchdog: The watchdog thread.
+        lastsample: time.monotonic() of the last good sample.
+        stale: True while the positions are older than the stale time.
+        failures: Number of failed reads in a row.
+        errors: Total number of failed reads.
+        reopens: Number of times the ADC has been opened again.
+        lasterror: Description of the last failed read, or ''.
+    """
+    def __init__(self, channels, manager, steppers, openadc, onchange):
+        self.channels = channels
+        self.manager = manager
+        self.steppers = steppers
+        self.openadc = openadc
+        self.onchange = onchange
+        self.scanner = None
+        self.values = {axis: 0 for axis in channels}
+        self.stepcounts = {}
+        self.share = None
+        self.running = True
+        self.stopevent = Event()
+        self.lastsample = monotonic()
+        self.stale = False
+        self.failures = 0
+        self.errors = 0
+        self.reopens = 0
+        self.lasterror = ''
+        self.timerthread = Timer(0.5, self.getpositions)
+        self.timerthread.name = 'Postition Thread'
+        self.watchdog = Timer(0.5, self.watch)
+        self.watchdog.name = 'Position Watchdog'
+
+    def start(self):
+        """Starts the position reader and watchdog threads"""
+        self.timerthread.start()
+        self.watchdog.start()
+
+    def getpositions(self):
+        """
+        Reads positional voltage data from an ADC and calculates the position of each axis
+        relative to a 2.5V reference. This is a continuous process that updates the
+        object's values every POSITION_INTERVAL seconds until shutdown() is called. Each
+        update wakes any waitfor() callers and is recorded in the ADC scan ring buffers of
+        the position channels. A failed read is retried after a delay that
+        doubles with each failure up to READ_RETRY_MAX, and the ADC is opened again after
+        REOPEN_FAILURES failures in a row or if there is no ADC.
+        """
+        while self.running:
+            try:
+                if self.manager.adc is None or (self.failures and self.failures % REOPEN_FAILURES == 0):
+                    self.reopen()
+                stepcounts = {stepper.axis: stepper.stepcount for stepper in self.steppers.values()}
+                volts = {axis: self.readchannel(channel) for axis, channel in self.channels.items()}
+            except (TimeoutError, OSError) as err:
+                self.failed(err)
+                continue
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logger.exception('Position reader failed')
+                self.failed(err)
+                continue
+            if self.failures:
+                logger.warning('Position reader recovered after %s failed reads', self.failures)
+            self.failures = 0
+            self.stepcounts = stepcounts
+            self.values = {axis: voltage - 2.5 for axis, voltage in volts.items()}
+            self.lastsample = monotonic()
+            if self.scanner is not None:
+                for axis, channel in self.channels.items():
+                    self.scanner.record(channel, volts[axis])
+            if self.share is not None:
+                self.share.write(*self.values.values())
+            self.onchange()
+            # print('Read position')
+            self.stopevent.wait(POSITION_INTERVAL)
+
+    def failed(self, err):
+        """
+        Records a failed read and waits before the next attempt, the delay doubles with each
+        failure in a row up to READ_RETRY_MAX.
+
+        Args:
+            err: The exception raised by the read.
+        """
+        self.failures += 1
+        self.errors += 1
+        self.lasterror = '%s: %s' % (type(err).__name__, err)
+        if self.failures == 1:
+            logger.error('Position reader: %s', self.lasterror)
+        self.stopevent.wait(min(READ_RETRY_DELAY * 2 ** (self.failures - 1), READ_RETRY_MAX))
+
+    def reopen(self):
+        """
+        Opens the ADC again after repeated failures, or when there is no ADC.
+
+        Raises:
+            OSError: If the ADC board cannot be opened.
+        """
+        self.reopens += 1
+        metrics.ADC_REOPENS.inc()
+        if self.failures <= REOPEN_FAILURES:
+            logger.warning('Position reader: opening the ADC again')
+        if self.openadc() is None:
+            raise OSError('no ADCPi board found')
+
+    def readchannel(self, channel):
+        """
+        Reads the voltage on an ADC channel through the bus manager, so the read cannot
+        interfere with any other reader of the ADC.
+
+        Args:
+            channel (int): ADC channel 1 to 8.
+
+        Returns:
+            float: The voltage.
+
+        Raises:
+            TimeoutError: If the conversion timed out.
+            OSError: If the I2C transfer failed.
+        """
+        return self.manager.read(channel)
+
+    def nextread(self):
+        """Returns the time.monotonic() the next position sample is due, used by the ADC scan"""
+        return self.lastsample + POSITION_INTERVAL
+
+    def age(self):
+        """Returns the seconds since the last good sample"""
+        return monotonic() - self.lastsample
+
+    def watch(self):
+        """
+        Watchdog loop, run on its own thread so it still runs if a read hangs. Marks the
+        positions stale when no sample has arrived within the 'positionstaletime' setting and
+        emergency stops any axis that is moving, the stale flag is cleared when samples
+        arrive again.
+        """
+        while self.running:
+            stale = self.age() > settings['positionstaletime']
+            if stale != self.stale:
+                self.stale = stale
+                if stale:
+                    logger.error('Position watchdog: no position sample for %.1f seconds, motion halted',
+                                 self.age())
+                else:
+                    logger.warning('Position watchdog: positions updating again')
+                self.onchange()
+            if stale:
+                for stepper in list(self.steppers.values()):
+                    if stepper.moving:
+                        stepper.estop()
+            self.stopevent.wait(WATCHDOG_INTERVAL)
+
+    def health(self):
+        """
+        Returns the state of the position reader for the API status.
+
+        Returns:
+            dict: 'state' ('ok', 'retrying' or 'stale'), 'age' of the last sample in seconds,
+            the consecutive and total 'failures' and 'errors', the number of 'reopens' and
+            the 'lasterror'.
+        """
+        if self.stale:
+            state = 'stale'
+        elif self.failures:
+            state = 'retrying'
+        else:
+            state = 'ok'
+        return {'state': state, 'age': round(self.age(), 3), 'failures': self.failures,
+                'errors': self.errors, 'reopens': self.reopens, 'lasterror': self.lasterror}
+
+    def shutdown(self):
+        """
+        Stops the position reading and watchdog threads and waits for them to finish. The
+        wait on the stop event means the threads exit immediately rather than after their
+        next sleep.
+        """
+        self.running = False
+        self.stopevent.set()
+        for thread in (self.timerthread, self.watchdog):
+            thread.cancel()
+            if thread.is_alive():
+                thread.join(2)
+
+    def location(self, table_axis):
+        """
+        Determines and returns the location value along a specified axis.
+
+        This method evaluates the given table axis ('x', 'y' or any other
+        configured axis) and returns the corresponding coordinate value. If
+        the provided axis is invalid, a default value of -99.99 is returned.
+
+        Args:
+            table_axis: A string indicating the axis, its name in 'axes'.
+
+        Returns:
+            float: The coordinate value for the specified axis, or -99.99
+            if the axis is invalid.
+        """
+        return self.values.get(table_axis, -99.99)
@@ -0,0 +1,232 @@
+"""
+Position share, publishes the latest axis positions in a named shared memory segment so
+that other processes on the Pi can read them without a round trip through the web server.
+The segment holds a sequence number followed by the time of the sample and the position of
+each axis, in the order the axes are set in the 'axes' setting, x then y by default. The
+writer makes the sequence odd while it updates the values and even again when it has
+finished (a seqlock), readers retry until they see the same even sequence before and after
+reading the values, so a reader never sees positions from different samples. A writer that
+died part way through an update leaves the sequence odd, so a reader gives up after
+READ_TIMEOUT seconds and raises TimeoutError rather than retrying for ever.
+
+This module has no dependencies on the rest of the application so it can be copied next
+to any program that wants to read the positions, reading is a memory access with no system
+calls. For example:
+
+    from positionshare import PositionShareClass
+    share = PositionShareClass('xycontrol-positions')
+    sampletime, x, y = share.read()
+
+A reader of a stage with more than two axes gives the number of axes, count=3 for x, y, z.
+Run it as a script to print the positions, or with --benchmark to measure the cost of a
+read and the time from a sample being published to a reader seeing it:
+
+    python3 positionshare.py [--name xycontrol-positions] [--count 2] [--benchmark]
+"""
+
+import sys
+import json
+import struct
+import argparse
+import multiprocessing
+from time import monotonic, perf_counter_ns, sleep
+from multiprocessing import shared_memory, resource_tracker
+
+SEQUENCE = struct.Struct('<Q')
+DEFAULT_COUNT = 2
+READ_TIMEOUT = 0.1
+
+
+def samplestruct(count):
+    """Returns the Struct of a sample, the monotonic time of the sample then count positions"""
+    return struct.Struct('<%dd' % (count + 1))
+
+
+def writesample(buf, sample, sequence, *values):
+    """
+    Writes a sample into a segment buffer using the seqlock protocol.
+
+    Args:
+        buf: The shared memory buffer.
+        sample (Struct): The sample layout from samplestruct().
+        sequence (int): The current, even, sequence number.
+        values (float): The position of each axis.
+
+    Returns:
+        int: The new sequence number.
+    """
+    SEQUENCE.pack_into(buf, 0, sequence + 1)
+    sample.pack_into(buf, SEQUENCE.size, monotonic(), *values)
+    SEQUENCE.pack_into(buf, 0, sequence + 2)
+    return sequence + 2
+
+
+class PositionShareClass:
+    """
+    Writer or reader for the shared memory position segment.
+
+    Attributes:
+        name: Name of the shared memory segment.
+        owner: True if this object created the segment and will remove it on close.
+        count: Number of positions in each sample.
+        sample: The Struct of a sample.
+        sequence: The writer's sequence number, even when no update is in progress.
+        memory: The SharedMemory object.
+    """
+    def __init__(self, name, create=False, count=DEFAULT_COUNT):
+        self.name = name
+        self.owner = create
+        self.count = count
+        self.sample = samplestruct(count)
+        self.sequence = 0
+        size = SEQUENCE.size + self.sample.size
+        if create:
+            try:
+                self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                # left behind by a process that did not exit cleanly, reuse it if it is big enough
+                self.memory = shared_memory.SharedMemory(name)
+                if self.memory.size < size:
+                    self.memory.close()
+                    self.memory.unlink()
+                    self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+            SEQUENCE.pack_into(self.memory.buf, 0, 0)
+            self.sample.pack_into(self.memory.buf, SEQUENCE.size, *[0.0] * (count + 1))
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+            # a reader must not remove the segment when it exits
+            resource_tracker.unregister(self.memory._name, 'shared_memory')  # pylint: disable=protected-access
+
+    def write(self, *values):
+        """
+        Publishes a new position sample.
+
+        Args:
+            values (float): The position of each axis, count of them.
+        """
+        self.sequence = writesample(self.memory.buf, self.sample, self.sequence, *values)
+
+    def read(self):
+        """
+        Reads the latest position sample.
+
+        Returns:
+            tuple: (time, x, y, ...) where time is the time.monotonic() time the sample was
+            taken, 0 if nothing has been published yet, followed by the position of each axis.
+
+        Raises:
+            TimeoutError: If the writer stopped part way through an update, see readsample().
+        """
+        return self.readsample()[1:]
+
+    def readsample(self):
+        """
+        Reads the latest position sample along with its sequence number, a reader can poll
+        this and compare the sequence number to see when a new sample has been published.
+
+        Returns:
+            tuple: (sequence, time, x, y, ...).
+
+        Raises:
+            TimeoutError: If no consistent sample could be read within READ_TIMEOUT seconds,
+                the writer stopped part way through an update.
+        """
+        buf = self.memory.buf
+        deadline = None
+        while True:
+            before = SEQUENCE.unpack_from(buf, 0)[0]
+            if not before & 1:
+                sample = self.sample.unpack_from(buf, SEQUENCE.size)
+                if SEQUENCE.unpack_from(buf, 0)[0] == before:
+                    return (before,) + sample
+            if deadline is None:
+                deadline = monotonic() + READ_TIMEOUT
+            elif monotonic() > deadline:
+                raise TimeoutError('position share %s: no complete sample within %s seconds, sequence %s' %
+                                   (self.name, READ_TIMEOUT, before))
+
+    def age(self):
+        """
+        Returns the age of the latest sample in seconds, time.monotonic() is the same clock
+        in every process so this works across processes.
+
+        Returns:
+            float: Seconds since the latest sample was taken.
+        """
+        return monotonic() - self.read()[0]
+
+    def close(self):
+        """Detaches from the segment, the owner also removes it"""
+        self.memory.close()
+        if self.owner:
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def benchmarkwriter(name, count, interval):
+    """Writer process for the benchmark, publishes count samples interval seconds apart"""
+    memory = shared_memory.SharedMemory(name)
+    sample = samplestruct(DEFAULT_COUNT)
+    sequence = SEQUENCE.unpack_from(memory.buf, 0)[0]
+    for i in range(count):
+        sequence = writesample(memory.buf, sample, sequence, i * 0.001, -i * 0.001)
+        sleep(interval)
+    memory.close()
+
+
+def benchmark(name, reads=100000, samples=1000, interval=0.001):
+    """
+    Measures the cost of a read and the latency from a sample being written by one process
+    to it being seen by another process that is polling the segment.
+
+    Args:
+        name (str): Name to use for a temporary segment.
+        reads (int): Number of reads to time.
+        samples (int): Number of samples the writer process publishes.
+        interval (float): Seconds between samples.
+
+    Returns:
+        dict: Read cost and publish to read latency percentiles in microseconds.
+    """
+    share = PositionShareClass(name, create=True)
+    try:
+        starttime = perf_counter_ns()
+        for _ in range(reads):
+            share.read()
+        readcost = (perf_counter_ns() - starttime) / reads / 1000
+        writer = multiprocessing.Process(target=benchmarkwriter, args=(name, samples, interval))
+        writer.start()
+        latencies = []
+        last = share.readsample()[0]
+        while writer.is_alive() or share.readsample()[0] != last:
+            sequence, sampletime = share.readsample()[:2]
+            if sequence != last:
+                latencies.append((monotonic() - sampletime) * 1000000)
+                last = sequence
+        writer.join()
+    finally:
+        share.close()
+    latencies.sort()
+    return {'reads': reads, 'read_us': round(readcost, 3), 'samples_seen': len(latencies),
+            'latency_us_p50': round(latencies[len(latencies) // 2], 1),
+            'latency_us_p99': round(latencies[int(len(latencies) * 0.99)], 1),
+            'latency_us_max': round(latencies[-1], 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read or benchmark the shared memory positions')
+    parser.add_argument('--name', default='xycontrol-positions', help='shared memory segment name')
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT, help='number of axes in each sample')
+    parser.add_argument('--benchmark', action='store_true', help='measure read cost and latency')
+    arguments = parser.parse_args()
+    if arguments.benchmark:
+        print(json.dumps(benchmark(arguments.name + '-benchmark')))
+        sys.exit(0)
+    reader = PositionShareClass(arguments.name, count=arguments.count)
+    while True:
+        readtime, *values = reader.read()
+        print('  '.join('axis %d = %.4f' % (number + 1, value) for number, value in enumerate(values)) +
+              '  age = %.3f s' % (monotonic() - readtime))
+        sleep(0.5)
@@ -0,0 +1,281 @@
+"""
+Raster scan, moves the stage over a rectangular grid of points and records the position
+reached at each one, so a client can scan a region with one command instead of a moveto
+and a status request for every point.
+
+The grid is given as [start, end] positions in volts for two of the axes, x and y or any
+other pair set in 'axes', and the pitch between points. The points are visited a line at a
+time along the fast axis, and with serpentine order every other line is scanned backwards so
+the slow axis is the only one that moves between lines. Only the axes whose target changes are moved to reach a point, an axis that
+stays put is never restarted, and when both have to move they move at the same time.
+
+Each move is made in two parts. The position reader only samples every quarter second, so
+moveto settles after every step near its target, which is far too slow for a pitch of a
+few tens of steps. Instead most of the distance is covered first by a counted move at full
+speed, using the volts per half-step the axis has learned and stopping short by
+APPROACH_ERROR of the distance or APPROACH_MARGIN half-steps, whichever is more. Once the
+position reader has a sample from after the counted move, moveto makes the last few steps.
+With 'closedloop' set false the counted move covers the whole distance and the point is
+recorded wherever the axis stopped.
+
+At each point, after the optional dwell, the position of each axis and any extra ADC channels
+asked for are read straight from the ADC through the bus manager, rather than waiting for
+the next sample of the position reader. Each point is one row of doubles in an array:
+
+    xindex, yindex, xtarget, ytarget, x, y, seconds, channel2, ...
+
+where seconds is the time since the scan started. A scan of other axes names its columns
+after them in the same way, zindex, ztarget, z and so on. The rows can be downloaded as CSV
+or as a NumPy .npy file, written here without needing numpy installed.
+"""
+
+import math
+import struct
+import sys
+from array import array
+from threading import Thread, Event, Lock
+from time import monotonic
+from logmanager import logger
+
+STOP_TIMEOUT = 2.0
+APPROACH_ERROR = 0.05
+APPROACH_MARGIN = 2
+SAMPLE_POLL = 0.01
+
+
+def axispoints(start, end, pitch):
+    """
+    Returns the positions along one axis from start towards end, pitch apart. The end is
+    included if it falls on the pitch, a start equal to the end gives a single point.
+    """
+    count = int(math.floor(abs(end - start) / pitch + 1e-9)) + 1
+    direction = 1 if end >= start else -1
+    return [round(start + direction * pitch * index, 6) for index in range(count)]
+
+
+def grid(points, fast, serpentine):
+    """
+    Generates the grid points in scan order.
+
+    Args:
+        points (dict): Axis to the list of its positions, for the two axes scanned.
+        fast (str): Axis scanned along each line.
+        serpentine (bool): True to scan every other line backwards.
+
+    Yields:
+        dict: Axis to (index, position) for each point.
+    """
+    slow = [axis for axis in points if axis != fast][0]
+    for line, slowposition in enumerate(points[slow]):
+        indices = range(len(points[fast]))
+        if serpentine and line % 2:
+            indices = reversed(indices)
+        for index in indices:
+            yield {fast: (index, points[fast][index]), slow: (line, slowposition)}
+
+
+def npy(data, width):
+    """
+    Returns an array of doubles as the bytes of a version 1.0 .npy file of shape
+    (len(data) / width, width), the format numpy.load() reads.
+    """
+    header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, %d), }" % (len(data) // width, width)
+    header += ' ' * (63 - (len(header) + 10) % 64) + '\n'
+    if sys.byteorder != 'little':
+        data = array('d', data)
+        data.byteswap()
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1') + data.tobytes()
+
+
+class RasterClass:
+    """
+    Runs one raster scan on its own thread, 'Raster Scan'.
+
+    Attributes:
+        scan: The checked scan definition from commands.rastergrid().
+        axes: The two axes scanned, in the order of their columns.
+        steppers: Dictionary mapping each scanned axis to its StepperClass.
+        manager: The ADCManagerClass the positions and channels are read through.
+        positions: The PositionClass, a scan stops if the positions go stale, its channels
+            give the ADC channel each axis position is read on.
+        onfinish: Function called when the scan has ended.
+        points: Dictionary mapping axis to the list of its positions.
+        columns: Names of the columns of each row.
+        total: Number of points in the grid.
+        data: array of doubles, one row of len(columns) values per point scanned.
+        datalock: Lock protecting data.
+        state: 'running', 'done', 'stopped' or 'failed'.
+        message: Why the scan stopped or failed.
+        starttime: time.monotonic() the scan started.
+        elapsed: Seconds the scan took, once it has ended.
+        running: True until the scan ends or stop() is called.
+        stopevent: Event set by stop() to end a dwell.
+        thread: The scan thread.
+    """
+    def __init__(self, scan, steppers, manager, positions, onfinish):
+        self.scan = scan
+        self.axes = scan['axes']
+        self.steppers = steppers
+        self.manager = manager
+        self.positions = positions
+        self.onfinish = onfinish
+        self.points = {axis: axispoints(scan[axis][0], scan[axis][1], scan['pitch'][number])
+                       for number, axis in enumerate(self.axes)}
+        self.columns = tuple(['%sindex' % axis for axis in self.axes] + ['%starget' % axis for axis in self.axes] +
+                             list(self.axes) + ['seconds'] + ['channel%s' % channel for channel in scan['channels']])
+        self.total = len(self.points[self.axes[0]]) * len(self.points[self.axes[1]])
+        self.data = array('d')
+        self.datalock = Lock()
+        self.state = 'running'
+        self.message = ''
+        self.starttime = monotonic()
+        self.elapsed = None
+        self.running = True
+        self.stopevent = Event()
+        self.thread = Thread(target=self.run, name='Raster Scan', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Scan loop, moves to each point in turn and records it. A failed ADC read, stale
+        positions or any other error fail the scan with the reason, the rows recorded so far
+        are kept. A scan that ends any other way before the last point was stopped.
+        """
+        logger.info('Raster scan of %s points started, %s, pitch %s', self.total,
+                    ', '.join('%s %s' % (axis, self.scan[axis]) for axis in self.axes), self.scan['pitch'])
+        targets = {axis: None for axis in self.axes}
+        try:
+            for point in grid(self.points, self.scan['fast'], self.scan['serpentine']):
+                moves = [(self.steppers[axis], point[axis][1]) for axis in self.axes
+                         if point[axis][1] != targets[axis]]
+                self.moveaxes(moves)
+                if not self.running:
+                    break
+                if self.positions.stale:
+                    self.finish('failed', 'positions stale at point %s' % (len(self.data) // len(self.columns)))
+                    break
+                targets = {axis: point[axis][1] for axis in self.axes}
+                if self.scan['dwell'] and self.stopevent.wait(self.scan['dwell']):
+                    break
+                self.record(point)
+            else:
+                self.finish('done', '')
+        except (TimeoutError, OSError) as err:
+            self.finish('failed', 'ADC read failed: %s' % err)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logger.exception('Raster scan failed')
+            self.finish('failed', '%s: %s' % (type(err).__name__, err))
+        finally:
+            self.finish('stopped', 'stopped by request')
+            logger.info('Raster scan %s after %s of %s points, %s', self.state, len(self.data) // len(self.columns),
+                        self.total, self.message)
+            self.onfinish()
+
+    def moveaxes(self, moves):
+        """
+        Moves each axis to its target, the first on this thread and any other on a helper
+        thread at the same time, and returns when they have all finished.
+
+        Args:
+            moves: List of (StepperClass, target) pairs.
+        """
+        helpers = [Thread(target=self.moveaxis, args=move, name='Raster %s move' % move[0].axis)
+                   for move in moves[1:]]
+        for helper in helpers:
+            helper.start()
+        if moves:
+            self.moveaxis(*moves[0])
+        for helper in helpers:
+            helper.join()
+
+    def moveaxis(self, stepper, target):
+        """
+        Moves one axis to a target, a counted move in half steps for the bulk of the
+        distance then moveto for the final approach, unless the scan is open loop.
+
+        Args:
+            stepper (StepperClass): The axis to move.
+            target (float): Target position in volts.
+        """
+        position = self.positions.location(stepper.axis)
+        steps = stepper.estimator.halfsteps(position, target)
+        if self.scan['closedloop']:
+            steps -= max(steps * APPROACH_ERROR, APPROACH_MARGIN)
+        steps = int(steps)
+        if steps > 0:
+            stepper.move(steps if target > position else -steps, 'half')
+            moved = monotonic()
+            while self.positions.lastsample < moved and not self.positions.stale and self.running:
+                self.stopevent.wait(SAMPLE_POLL)
+        if self.scan['closedloop'] and self.running:
+            stepper.moveto(target)
+
+    def record(self, point):
+        """
+        Reads the position of each axis and the extra channels and adds the row for a point.
+
+        Raises:
+            TimeoutError: If a conversion timed out.
+            OSError: If the I2C transfer failed.
+        """
+        row = [point[axis][0] for axis in self.axes] + [point[axis][1] for axis in self.axes]
+        row.extend(self.manager.read(self.positions.channels[axis]) - 2.5 for axis in self.axes)
+        row.append(monotonic() - self.starttime)
+        row.extend(self.manager.read(channel) for channel in self.scan['channels'])
+        with self.datalock:
+            self.data.extend(row)
+
+    def finish(self, state, message):
+        """Marks the scan as ended, the first reason given is kept"""
+        if self.state == 'running':
+            self.state = state
+            self.message = message
+            self.elapsed = monotonic() - self.starttime
+            self.running = False
+
+    def stop(self):
+        """
+        Stops the scan, emergency stopping any axis it is moving, and waits for the scan
+        thread to finish.
+        """
+        self.running = False
+        self.stopevent.set()
+        for _ in range(2):
+            for stepper in self.steppers.values():
+                if stepper.busy():
+                    stepper.estop()
+            self.thread.join(STOP_TIMEOUT)
+            if not self.thread.is_alive():
+                break
+
+    def status(self):
+        """
+        Returns the progress of the scan.
+
+        Returns:
+            dict: 'state', 'message', the number of 'points' in the grid and 'done', the
+            'seconds' taken so far, the 'columns' of each row and the 'scan' definition.
+        """
+        elapsed = self.elapsed if self.elapsed is not None else monotonic() - self.starttime
+        return {'state': self.state, 'message': self.message, 'points': self.total,
+                'done': len(self.data) // len(self.columns), 'seconds': round(elapsed, 3),
+                'columns': list(self.columns), 'scan': self.scan}
+
+    def rows(self):
+        """Returns a copy of the data recorded so far"""
+        with self.datalock:
+            return array('d', self.data)
+
+    def csv(self):
+        """Returns the rows recorded so far as CSV text with a header line of the column names"""
+        data = self.rows()
+        width = len(self.columns)
+        lines = [','.join(self.columns)]
+        for start in range(0, len(data), width):
+            row = data[start:start + width]
+            lines.append(','.join(['%d' % row[0], '%d' % row[1]] + ['%.6f' % value for value in row[2:]]))
+        return '\n'.join(lines) + '\n'
+
+    def npy(self):
+        """Returns the rows recorded so far as a .npy file of doubles, one row per point"""
+        return npy(self.rows(), len(self.columns))
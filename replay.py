@@ -0,0 +1,240 @@
+"""
+Replays a recorded command stream against the simulated hardware in simhardware, so a change
+to the motion code can be checked against a real workload before it is deployed to the stage.
+The commands are run through steppercontrol.parsecontrol() as they were in production and
+the report is written as JSON, in the same way as benchmark.py:
+
+    python3 replay.py commands.jsonl --output before.json
+    ... change the code ...
+    python3 replay.py commands.jsonl --baseline before.json
+
+The recording is either a commandlog.py JSON lines file, made by setting 'commandlog' in
+settings.json, or the application log, whose 'item : command' lines record every command
+run (the log has no /wait requests). 'restart' commands are never replayed.
+
+The gaps between commands are kept, divided by --speed, 0 runs the commands back to back.
+A client waits for an axis to stop before its next move, so unless --overlap is given each
+move command is held until its axis is idle. The simulated ADC noise is seeded with --seed
+so two replays of the same recording make the same moves.
+
+Report:
+    seconds    time from the first command until every axis had stopped after the last.
+    latency    time from each move command (move, moveto, movetomm, home) until its axis
+               stopped, in milliseconds, in total and for each kind of move.
+    error      distance from the target where each moveto stopped, in millivolts.
+    final      position of each axis at the end and its distance from the last moveto target.
+"""
+
+import os
+import re
+import ast
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+from threading import Thread, Lock
+from time import perf_counter, sleep, mktime, strptime
+from app_control import settings, VERSION
+from commands import CommandError, splititem, knownitem, moveargument
+from benchmark import summarise, compare
+
+MOVE_KINDS = ('move', 'moveto', 'movetomm', 'home')
+SKIPPED_ITEMS = ('restart',)
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}), [^,]*, INFO : (\w+) : (.*?) ?$')
+WAIT_LIMIT = 3600
+
+
+def readrecording(path, known):
+    """
+    Reads a recording, a commandlog.py JSON lines file or an application log.
+
+    Args:
+        path (str): The recording.
+        known: Function returning True for a control item that can be replayed, log lines for
+            any other item are ignored.
+
+    Returns:
+        list: (time, item, command) for each command in the order recorded.
+    """
+    commands = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('{'):
+                try:
+                    entry = json.loads(line)
+                    commands.append((float(entry['time']), entry['item'], entry['command']))
+                except (ValueError, KeyError, TypeError):
+                    pass
+                continue
+            match = LOG_LINE.match(line)
+            if match is None or not known(match.group(3)):
+                continue
+            try:
+                command = ast.literal_eval(match.group(4))
+            except (ValueError, SyntaxError):
+                command = match.group(4)
+            recorded = mktime(strptime(match.group(1), '%Y-%m-%d %H:%M:%S')) + int(match.group(2)) / 1000
+            commands.append((recorded, match.group(3), command))
+    return commands
+
+
+class ReplayClass:
+    """
+    Replays commands and measures the moves they make.
+
+    Attributes:
+        steppercontrol: The started steppercontrol module.
+        overlap: True to send move commands without waiting for the axis to stop.
+        moves: List of the measured moves, each a dictionary of kind, axis, seconds, error.
+        lock: Lock protecting moves.
+        waiters: Threads timing the moves in progress.
+        targets: Dictionary mapping axis to the last moveto target sent to it.
+        skipped: Number of commands not replayed.
+        rejected: Number of commands the controller rejected.
+    """
+    def __init__(self, steppercontrol, overlap):
+        self.steppercontrol = steppercontrol
+        self.overlap = overlap
+        self.moves = []
+        self.lock = Lock()
+        self.waiters = []
+        self.targets = {}
+        self.skipped = 0
+        self.rejected = 0
+
+    def timemove(self, kind, axis, target, issued):
+        """Waits for an axis to stop after a move command and records the move"""
+        status = self.steppercontrol.waitfor(axis, timeout=WAIT_LIMIT)
+        move = {'kind': kind, 'axis': axis, 'seconds': perf_counter() - issued}
+        if target is not None:
+            move['error'] = status['%spos' % axis] - target
+        with self.lock:
+            self.moves.append(move)
+
+    def send(self, item, command):
+        """Runs one command, holding a move until its axis is idle unless overlap is set"""
+        if item in SKIPPED_ITEMS:
+            self.skipped += 1
+            return
+        if item == 'wait':
+            self.steppercontrol.waitfor(command['axis'], command.get('target'), command.get('tolerance'),
+                                        command.get('timeout'))
+            return
+        axis, kind = splititem(item)
+        if kind in MOVE_KINDS and not self.overlap:
+            self.steppercontrol.waitfor(axis, timeout=WAIT_LIMIT)
+        issued = perf_counter()
+        try:
+            result = self.steppercontrol.parsecontrol(item, command)
+        except CommandError as err:
+            print('replay: %s %s rejected: %s' % (item, command, err), file=sys.stderr)
+            self.rejected += 1
+            return
+        if kind not in MOVE_KINDS:
+            return
+        target = None
+        if kind == 'moveto':
+            target = moveargument(result['command'], 'position')[0]
+        elif kind == 'movetomm':
+            target = result['result']['target']
+        if target is not None:
+            self.targets[axis] = target
+        waiter = Thread(target=self.timemove, args=(kind, axis, target, issued), name='Replay Timer')
+        waiter.start()
+        self.waiters.append(waiter)
+
+    def run(self, commands, speed):
+        """
+        Replays the commands, keeping the recorded gaps between them divided by speed.
+
+        Returns:
+            float: Seconds from the first command until every axis had stopped.
+        """
+        starttime = perf_counter()
+        due = starttime
+        for index, (recorded, item, command) in enumerate(commands):
+            if speed and index:
+                due += (recorded - commands[index - 1][0]) / speed
+                delay = due - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            due = max(due, perf_counter())
+            self.send(item, command)
+        for waiter in self.waiters:
+            waiter.join()
+        self.steppercontrol.waitfor('all', timeout=WAIT_LIMIT)
+        return perf_counter() - starttime
+
+    def report(self):
+        """Returns the latency and error of the moves and the final positions"""
+        latency = {'all': summarise([move['seconds'] for move in self.moves])}
+        for kind in MOVE_KINDS:
+            samples = [move['seconds'] for move in self.moves if move['kind'] == kind]
+            if samples:
+                latency[kind] = summarise(samples)
+        errors = [abs(move['error']) for move in self.moves if 'error' in move]
+        status = self.steppercontrol.apistatus()
+        final = {}
+        for axis in self.steppercontrol.steppers:
+            final[axis] = {'position': round(status['%spos' % axis], 5)}
+            if axis in self.targets:
+                final[axis]['error'] = round(status['%spos' % axis] - self.targets[axis], 5)
+        return {'latency': latency, 'error': summarise(errors), 'final': final}
+
+
+def run():
+    """Replays a recording and writes the report"""
+    parser = argparse.ArgumentParser(description='Replay a recorded command stream on the simulated hardware')
+    parser.add_argument('recording', help='commandlog JSON lines file or application log')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, 1 as recorded, 10 ten times faster, 0 back to back')
+    parser.add_argument('--overlap', action='store_true', help='send moves without waiting for the axis to stop')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the simulated ADC noise')
+    parser.add_argument('--output', help='write the report to this file as well as stdout')
+    parser.add_argument('--baseline', help='report file to compare against')
+    args = parser.parse_args()
+
+    settings['simulate'] = True
+    settings['motionprocess'] = False
+    settings['positionshare'] = False
+    settings['controlsocket'] = ''
+    settings['controlport'] = 0
+    settings['commandlog'] = ''
+    settings['waittimeout'] = WAIT_LIMIT
+    settings['statefile'] = os.path.join(tempfile.mkdtemp(), 'stagestate.json')
+    random.seed(args.seed)
+    import steppercontrol  # pylint: disable=import-outside-toplevel
+
+    commands = readrecording(args.recording, knownitem)
+    if not commands:
+        sys.exit('replay: no commands found in %s' % args.recording)
+    results = {'version': VERSION, 'python': platform.python_version(), 'machine': platform.machine(),
+               'time': datetime.now().isoformat(timespec='seconds'), 'recording': args.recording,
+               'speed': args.speed, 'overlap': args.overlap, 'commands': len(commands)}
+    steppercontrol.start()
+    sleep(0.5)  # let the position thread take its first readings
+    try:
+        replay = ReplayClass(steppercontrol, args.overlap)
+        results['seconds'] = round(replay.run(commands, args.speed), 3)
+        results['skipped'] = replay.skipped
+        results['rejected'] = replay.rejected
+        results['moves'] = len(replay.moves)
+        results.update(replay.report())
+    finally:
+        steppercontrol.shutdown()
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    run()
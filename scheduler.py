@@ -0,0 +1,151 @@
+"""
+Scheduler, runs short callbacks at a set time on a single background thread. This is the
+motion clock shared by every axis: steppercontrol submits every coil write to it against an
+absolute deadline taken from time.monotonic_ns, and it also de-energises the coils once an
+axis has been idle. The thread can optionally run with SCHED_FIFO priority and be pinned to
+one CPU so step timing is not disturbed by the web and ADC threads. Callbacks must be quick
+as they all share the one thread.
+"""
+
+import os
+import heapq
+from itertools import count
+from threading import Thread, Condition
+from time import monotonic_ns
+from logmanager import logger
+
+
+class SchedulerClass:
+    """
+    Runs callbacks at a given time on a single named thread. Each task can be given a key,
+    scheduling a new task with the same key replaces the pending one, which is how an
+    idle timeout is pushed back each time the axis steps.
+
+    The thread waits on a condition until shortly before the deadline then spins on
+    monotonic_ns for the last few hundred microseconds, so tasks run within a few
+    microseconds of their deadline rather than with the scheduling jitter of a sleep.
+
+    Attributes:
+        name: Name of the scheduler thread as shown on the index page.
+        priority: SCHED_FIFO priority for the thread, 0 leaves the normal scheduler.
+        cpu: CPU number to pin the thread to, None leaves it free to run on any CPU.
+        spin: Nanoseconds before a deadline at which the thread stops waiting and spins.
+        tasks: Heap of pending tasks as [deadline, id, key, callback] lists, deadlines in
+            monotonic_ns time.
+        keys: Dictionary mapping a task key to the id of its current task.
+        condition: Condition used to wake the thread when a task is added or on shutdown.
+        running: True while the scheduler thread is running.
+    """
+    def __init__(self, name, priority=0, cpu=None, spin=200000):
+        self.name = name
+        self.priority = priority
+        self.cpu = cpu
+        self.spin = spin
+        self.tasks = []
+        self.keys = {}
+        self.ids = count()
+        self.condition = Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Starts the scheduler thread"""
+        self.running = True
+        self.thread = Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def setrealtime(self):
+        """
+        Applies the SCHED_FIFO priority and CPU affinity to the calling thread. Both need
+        privileges the service may not have, so a failure is logged and the thread carries
+        on with the normal scheduler.
+        """
+        if self.priority > 0:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+                logger.info('%s running at SCHED_FIFO priority %s', self.name, self.priority)
+            except (AttributeError, OSError) as err:
+                logger.warning('%s could not set SCHED_FIFO priority: %s', self.name, err)
+        if self.cpu is not None:
+            try:
+                os.sched_setaffinity(0, {self.cpu})
+                logger.info('%s pinned to CPU %s', self.name, self.cpu)
+            except (AttributeError, OSError) as err:
+                logger.warning('%s could not set CPU affinity: %s', self.name, err)
+
+    def schedule(self, delay, callback, key=None):
+        """
+        Schedules a callback to run after a delay.
+
+        Args:
+            delay (float): Seconds from now to run the callback.
+            callback: Function to run, called with no arguments.
+            key: Optional key, a pending task with the same key is cancelled.
+        """
+        self.scheduleat(monotonic_ns() + int(delay * 1000000000), callback, key)
+
+    def scheduleat(self, deadline, callback, key=None):
+        """
+        Schedules a callback to run at an absolute time.
+
+        Args:
+            deadline (int): Time to run the callback, in time.monotonic_ns nanoseconds.
+            callback: Function to run, called with no arguments.
+            key: Optional key, a pending task with the same key is cancelled.
+        """
+        with self.condition:
+            taskid = next(self.ids)
+            if key is not None:
+                self.keys[key] = taskid
+            heapq.heappush(self.tasks, [deadline, taskid, key, callback])
+            self.condition.notify()
+
+    def cancel(self, key):
+        """
+        Cancels the pending task with the given key, if there is one.
+
+        Args:
+            key: The key the task was scheduled with.
+        """
+        with self.condition:
+            self.keys.pop(key, None)
+
+    def run(self):
+        """
+        Scheduler thread, waits for the earliest deadline and runs the task. Tasks that
+        have been cancelled or replaced by a newer task with the same key are discarded.
+        """
+        self.setrealtime()
+        while self.running:
+            with self.condition:
+                while self.running:
+                    if not self.tasks:
+                        self.condition.wait()
+                        continue
+                    remaining = self.tasks[0][0] - monotonic_ns()
+                    if remaining <= self.spin:
+                        break
+                    self.condition.wait((remaining - self.spin) / 1000000000)
+                if not self.running:
+                    return
+                deadline, taskid, key, callback = heapq.heappop(self.tasks)
+                if key is not None:
+                    if self.keys.get(key) != taskid:
+                        continue
+                    del self.keys[key]
+            while monotonic_ns() < deadline:
+                pass
+            try:
+                callback()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception('%s task failed', self.name)
+
+    def shutdown(self):
+        """Stops the scheduler thread, pending tasks are discarded"""
+        with self.condition:
+            self.running = False
+            self.tasks.clear()
+            self.keys.clear()
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(2)
@@ -0,0 +1,326 @@
+"""
+Simulated hardware, stands in for RPi.GPIO and the ADCPi board when 'simulate' is set in
+settings.json so the controller can be run, benchmarked and replayed on a machine without
+the XY stage attached. steppercontrol imports GPIO and ADCPi from here instead of from the
+hardware libraries.
+
+The simulation models the stage as wired on the controller board, with an axis for each
+entry of the 'axes' setting that commands.checkaxes() accepts, on the pins, ADC channel and
+limit switches set for it:
+
+- Each axis is a stepper whose rotor follows the coil pattern written to its four GPIO
+  outputs, moving to the nearest half-step position of the energised pattern. steppercontrol
+  writes the four outputs back to back, far quicker than the rotor can respond, so the
+  pattern is taken when the last output of the four is written. The stage travel is
+  clamped at mechanical end stops.
+- The position potentiometer of each axis is read on an ADC channel as 2.5V plus
+  VOLTS_PER_STEP per half-step from the centre, with a little noise.
+- The limit switches are pulled-up inputs that read 0 while the stage is past the switch
+  position, the edge callbacks run on their own thread as they do with RPi.GPIO.
+- The ADC is modelled at the I2C register level by SimSMBusClass, an MCP3424 with the
+  conversion time of each bit rate, so read_raw polls for the ready bit as the ADCPi
+  library does.
+"""
+
+import random
+from threading import RLock, Thread
+from time import monotonic, sleep
+from app_control import axissetting
+from commands import configuredaxes
+
+VOLTS_PER_STEP = 0.0005
+NOISE = 0.0002
+SWITCH_POSITION = 2.3
+END_STOP = 2.45
+CONVERSION_TIME = {12: 1 / 240, 14: 1 / 60, 16: 1 / 15, 18: 1 / 3.75}
+HALF_STEPS = [(1, 0, 1, 0), (1, 0, 0, 0), (1, 0, 0, 1), (0, 0, 0, 1),
+              (0, 1, 0, 1), (0, 1, 0, 0), (0, 1, 1, 0), (0, 0, 1, 0)]
+
+
+class StageClass:
+    """
+    Model of one axis of the stage.
+
+    Attributes:
+        axis: Name of the axis, 'x', 'y' or any other name set in 'axes'.
+        pins: The four coil GPIO outputs in the order steppercontrol writes them.
+        channel: ADC channel the position potentiometer is read on.
+        lowerswitch: GPIO input of the lower limit switch, or None if not fitted.
+        upperswitch: GPIO input of the upper limit switch, or None if not fitted.
+        halfsteps: Rotor position in half-steps from the centre of travel.
+        phase: Index in HALF_STEPS of the last coil pattern the rotor moved to.
+        stalls: Number of coil changes the rotor could not follow.
+    """
+    def __init__(self, axis, pins, channel, lowerswitch, upperswitch):
+        self.axis = axis
+        self.pins = pins
+        self.channel = channel
+        self.lowerswitch = lowerswitch
+        self.upperswitch = upperswitch
+        self.halfsteps = 0
+        self.phase = 0
+        self.stalls = 0
+
+    def position(self):
+        """Returns the stage position in volts from the centre of travel"""
+        return self.halfsteps * VOLTS_PER_STEP
+
+    def energise(self, pattern):
+        """
+        Moves the rotor to follow a new coil pattern. Patterns that are not in the half-step
+        table, such as all coils off, leave the rotor where it is. A pattern opposite the
+        rotor cannot pull it either way and is counted as a stall.
+
+        Args:
+            pattern (tuple): The four coil states.
+        """
+        if pattern not in HALF_STEPS:
+            return
+        index = HALF_STEPS.index(pattern)
+        change = (index - self.phase) % len(HALF_STEPS)
+        if change == 4:
+            self.stalls += 1
+            return
+        if change > 4:
+            change -= len(HALF_STEPS)
+        self.phase = index
+        limit = int(END_STOP / VOLTS_PER_STEP)
+        self.halfsteps = max(-limit, min(limit, self.halfsteps + change))
+
+    def switches(self):
+        """Returns the (lower, upper) limit switch input levels, 0 when pressed"""
+        position = self.position()
+        return (0 if position <= -SWITCH_POSITION else 1,
+                0 if position >= SWITCH_POSITION else 1)
+
+
+class SimGPIOClass:
+    """
+    Stand-in for the RPi.GPIO module with the functions and constants steppercontrol uses.
+    Coil outputs are passed to the stage models and the limit switch inputs follow the
+    stage positions.
+
+    Attributes:
+        stages: Dictionary mapping axis name to its StageClass.
+        levels: Dictionary mapping GPIO channel to its current level.
+        callbacks: Dictionary mapping input channel to its edge callback.
+        lock: Lock held while the outputs and stages are updated.
+    """
+    BCM = 11
+    OUT = 0
+    IN = 1
+    PUD_UP = 22
+    FALLING = 32
+    RISING = 31
+    BOTH = 33
+
+    def __init__(self, stages):
+        self.stages = {stage.axis: stage for stage in stages}
+        self.levels = {}
+        self.callbacks = {}
+        self.lock = RLock()
+
+    def setwarnings(self, flag):
+        """Accepted for compatibility, the simulation has no warnings"""
+
+    def setmode(self, mode):
+        """Accepted for compatibility, channels are always BCM numbers"""
+
+    def setup(self, channels, direction, pull_up_down=None, initial=None):  # pylint: disable=unused-argument
+        """Sets up one channel or a list of channels, inputs read 1 until a switch is pressed"""
+        if not isinstance(channels, (list, tuple)):
+            channels = [channels]
+        with self.lock:
+            for channel in channels:
+                self.levels[channel] = 1 if direction == self.IN else (initial or 0)
+            self.updateswitches()
+
+    def output(self, channel, level):
+        """Sets an output, writing the last coil output of an axis moves the stage"""
+        with self.lock:
+            self.levels[channel] = level
+            for stage in self.stages.values():
+                if channel == stage.pins[-1]:
+                    stage.energise(tuple(self.levels.get(pin, 0) for pin in stage.pins))
+                    self.updateswitches()
+
+    def input(self, channel):
+        """Returns the level of a channel"""
+        return self.levels.get(channel, 1)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):  # pylint: disable=unused-argument
+        """Registers the edge callback for a limit switch input"""
+        self.callbacks[channel] = callback
+
+    def remove_event_detect(self, channel):
+        """Removes the edge callback for a channel"""
+        self.callbacks.pop(channel, None)
+
+    def cleanup(self, *channels):  # pylint: disable=unused-argument
+        """Removes all edge callbacks"""
+        self.callbacks.clear()
+
+    def updateswitches(self):
+        """
+        Sets the limit switch inputs from the stage positions and runs the callback of any
+        switch that has changed on its own thread.
+        """
+        for stage in self.stages.values():
+            for channel, level in zip((stage.lowerswitch, stage.upperswitch), stage.switches()):
+                if channel is not None and self.levels.get(channel, 1) != level:
+                    self.levels[channel] = level
+                    if channel in self.callbacks:
+                        Thread(target=self.callbacks[channel], args=(channel,), name='GPIO Callback',
+                               daemon=True).start()
+
+
+class SimSMBusClass:
+    """
+    Model of the two MCP3424 converters on the ADCPi board at the I2C register level, with
+    the methods of smbus2.SMBus that the ADCPi library uses. Writing a configuration byte
+    starts a conversion, reads report the conversion as not ready until the conversion time
+    for the bit rate has passed. In continuous mode conversions repeat at the conversion rate.
+
+    Attributes:
+        stages: Dictionary mapping ADC channel (1 to 8) to its StageClass.
+        config: Dictionary mapping I2C address to its last configuration byte.
+        readyat: Dictionary mapping I2C address to the monotonic time its conversion is ready.
+        reads: Number of block reads, including those that found the conversion not ready.
+    """
+    def __init__(self, stages):
+        self.stages = {stage.channel: stage for stage in stages}
+        self.config = {}
+        self.readyat = {}
+        self.reads = 0
+
+    @staticmethod
+    def bitrate(config):
+        """Returns the bit rate set in a configuration byte"""
+        return (12, 14, 16, 18)[(config >> 2) & 3]
+
+    def channel(self, address, config):
+        """Returns the board channel (1 to 8) selected by a configuration byte"""
+        return ((config >> 5) & 3) + (1 if address % 2 == 0 else 5)
+
+    def write_byte(self, address, value):
+        """Writes a configuration byte and starts a conversion"""
+        self.config[address] = value
+        self.readyat[address] = monotonic() + CONVERSION_TIME[self.bitrate(value)]
+
+    def read_i2c_block_data(self, address, register, length):  # pylint: disable=unused-argument
+        """
+        Reads the output register: the conversion result followed by the configuration byte,
+        whose bit 7 is 0 once a new result is ready.
+        """
+        self.reads += 1
+        config = self.config.get(address, 0x10)
+        bits = self.bitrate(config)
+        now = monotonic()
+        readyat = self.readyat.get(address, now)
+        ready = now >= readyat
+        if ready and config & 0x10:
+            period = CONVERSION_TIME[bits]
+            self.readyat[address] = readyat + period * (int((now - readyat) / period) + 1)
+        stage = self.stages.get(self.channel(address, config))
+        volts = 2.5 + (stage.position() if stage is not None else -2.5) + random.gauss(0, NOISE)
+        code = max(0, min(2 ** (bits - 1) - 1, round(volts / ADCPi.DIVIDER / (4.096 / 2 ** bits))))
+        status = config & 0x7f if ready else config | 0x80
+        data = list(code.to_bytes(3, 'big'))
+        if bits != 18:
+            data = data[1:]
+        return (data + [status, status])[:length]
+
+    def close(self):
+        """Accepted for compatibility"""
+
+
+class Error(Exception):
+    """Base class for the ADCPi exceptions, as defined in the ADCPi library"""
+
+
+class TimeoutError(Error):  # pylint: disable=redefined-builtin
+    """
+    Raised when a conversion is not ready in time. Like the ADCPi library's TimeoutError
+    this is not the builtin TimeoutError, so code that only catches the builtin one fails
+    in the simulation as it would on the board.
+    """
+
+
+class ADCPi:
+    """
+    Simulated ADCPi board with the interface of the ADCPi library, reading through
+    SimSMBusClass so read_raw writes the configuration and polls for the ready bit as the
+    library does.
+
+    Attributes:
+        address: I2C address of the converter for channels 1 to 4.
+        address2: I2C address of the converter for channels 5 to 8.
+        bitrate: Conversion bit rate, 12, 14, 16 or 18.
+        conversionmode: 0 for one-shot, 1 for continuous conversions.
+        bus: The SimSMBusClass the board is read through.
+        selected: Dictionary mapping I2C address to the configuration byte last written.
+    """
+    DIVIDER = 2.471
+    TIMEOUT = 1.0
+
+    def __init__(self, address=0x68, address2=0x69, rate=18, bus=None):
+        self.address = address
+        self.address2 = address2
+        self.bus = bus if bus is not None else simbus
+        self.bitrate = rate
+        self.conversionmode = 1
+        self.selected = {}
+
+    def set_bit_rate(self, rate):
+        """Sets the conversion bit rate, 12, 14, 16 or 18"""
+        if rate not in CONVERSION_TIME:
+            raise ValueError('set_bit_rate: rate out of range')
+        self.bitrate = rate
+        self.selected.clear()
+
+    def set_conversion_mode(self, mode):
+        """Sets one-shot (0) or continuous (1) conversions"""
+        self.conversionmode = mode
+        self.selected.clear()
+
+    def read_raw(self, channel):
+        """
+        Reads the raw conversion result of a channel.
+
+        Args:
+            channel (int): Channel 1 to 8.
+
+        Returns:
+            int: The conversion result.
+
+        Raises:
+            TimeoutError: If the conversion is not ready within TIMEOUT seconds.
+        """
+        address = self.address if channel < 5 else self.address2
+        config = (((channel - 1) % 4) << 5) | ((12, 14, 16, 18).index(self.bitrate) << 2) \
+            | (self.conversionmode << 4) | 0x80
+        if self.conversionmode == 0 or self.selected.get(address) != config:
+            self.bus.write_byte(address, config)
+            self.selected[address] = config
+        timeout = monotonic() + self.TIMEOUT
+        while True:
+            data = self.bus.read_i2c_block_data(address, config, 4)
+            status = data[3] if self.bitrate == 18 else data[2]
+            if not status & 0x80:
+                break
+            if monotonic() > timeout:
+                raise TimeoutError('read_raw: channel %i conversion timed out' % channel)
+            sleep(0.00001)
+        if self.bitrate == 18:
+            return ((data[0] & 0x03) << 16) | (data[1] << 8) | data[2]
+        return ((data[0] & 0x7f) << 8) | data[1]
+
+    def read_voltage(self, channel):
+        """Returns the voltage on a channel, 0 to 5.06V"""
+        return self.read_raw(channel) * (4.096 / 2 ** self.bitrate) * self.DIVIDER
+
+
+stages = [StageClass(axis['name'], tuple(axis['pins']), axis['channel'],
+                     *axissetting(axis, 'limitswitches', [None, None])) for axis in configuredaxes()]
+GPIO = SimGPIOClass(stages)
+simbus = SimSMBusClass(stages)
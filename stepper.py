@@ -0,0 +1,804 @@
+"""
+Stepper motor of one axis of the XY table. StepperClass drives the four coils of the motor
+through the GPIO pins, in half, full or wave steps, and runs the move, moveto and home
+motion loops, stopping at the software limits read from the position reader and at the
+limit switches.
+
+The steppers are created by steppercontrol.start() from the 'axes' setting, the position
+reader, the motion clock and the callbacks are handed to each one there.
+"""
+
+from time import monotonic, monotonic_ns
+from threading import Event, Lock
+from logmanager import logger
+from app_control import settings
+if settings['simulate']:
+    from simhardware import GPIO
+else:
+    from RPi import GPIO
+from calibration import CalibrationClass
+from commands import STEP_MODES, ENERGISE_POLICIES
+from estimator import EstimatorClass, AUTO_HALFSTEP_RANGE, FINE_RANGE, SETTLE_TIME
+import metrics
+
+ESTOP_TIMEOUT = 0.5
+TICK_TIMEOUT = 1.0
+SWITCH_BOUNCETIME = 5
+HOME_MAX_STEPS = 16000
+
+
+class StepperClass:  # pylint: disable=too-many-instance-attributes,too-many-public-methods
+    """
+    Represents a stepper motor controller, enabling precise control over the stepper
+    motor's movement, configuration, and operational parameters.
+
+    This class provides methods for initializing and controlling a stepper motor's
+    movement such as stepping forward, stepping backward, stopping, or moving to
+    specific self.positions. It also supports setting GPIO channels, retrieving active
+    sequences, and managing limits for motor movement. The class incorporates
+    adjustable movement speeds (full speed or slow) and ensures proper handling of
+    stepper sequences during operation.
+
+    Attributes:
+        axis: A string indicating the axis of operation for the stepper motor.
+        seq: A list of lists, defining the half-step sequence for stepper coil activations.
+            The even entries energise two phases (full-step) and the odd entries one phase
+            (wave drive), so all three modes step through the same table and sequenceindex
+            stays valid when the mode changes.
+        channela: An integer representing the GPIO channel for the first winding.
+        channelaa: An integer representing the GPIO channel for the second winding.
+        channelb: An integer representing the GPIO channel for the third winding.
+        channelbb: An integer representing the GPIO channel for the fourth winding.
+        sequenceindex: An integer representing the current sequence index of the motor.
+        upperlimit: A float defining the maximum allowed position limit for movement.
+        lowerlimit: A float defining the minimum allowed position limit for movement.
+        sequence: An integer counter for the current movement sequence.
+        pulsewidth: A float specifying the delay between steps, controlling speed.
+        moving: A boolean flag indicating whether the motor is actively moving.
+        stopevent: An Event set by stop requests, every wait in the motion loops is made on
+            this event or on tickdone so a stop wakes the motion thread immediately.
+        tickdone: An Event set by the motion clock once a submitted coil write has been made.
+        deadline: Absolute time of the next coil write in time.monotonic_ns nanoseconds.
+        idle: An Event that is set whenever no motion loop is running on this axis.
+        threads: Timer threads started for this axis by parsecontrol that may not have run yet.
+        stoplatency: The time in seconds the last emergency stop took to halt the axis.
+        lowerswitch: GPIO channel of the lower limit switch, or None if not fitted.
+        upperswitch: GPIO channel of the upper limit switch, or None if not fitted.
+        atlower: True while the lower limit switch is pressed.
+        atupper: True while the upper limit switch is pressed.
+        direction: Direction of the last step, 1 forward, -1 backward.
+        stepcount: Half-steps taken since the axis was last homed, negative below home.
+        homed: True once the axis has been homed and stepcount is referenced to a limit.
+        homing: True while a homing routine is running on this axis.
+        energise: Coil energise policy, 'pulse' de-energises after every step, 'move' holds
+            the coils energised until the move stops and 'idle' holds them energised until
+            the axis has not stepped for idletime seconds.
+        idletime: Seconds without a step before the coils are de-energised in 'idle' mode.
+        stepmode: Default step mode for moves, 'half', 'full', 'wave' or 'auto'. In 'auto'
+            mode moveto uses full steps until it is close to the target then half steps.
+        activemode: The step mode used by the next step, 'half', 'full' or 'wave'.
+        estimator: EstimatorClass predicting when the current move will finish.
+        calibration: CalibrationClass mapping the axis position in volts to millimetres.
+        positions: PositionClass the axis position and staleness are read from.
+        motionclock: SchedulerClass shared by every axis that makes the coil writes.
+        onchange: Function called when the axis stops, wakes the callers waiting for motion.
+        onidle: Function called when the last motion loop on the axis ends, saves the state.
+    """
+    def __init__(self, positions, motionclock, onchange, onidle):
+        self.positions = positions
+        self.motionclock = motionclock
+        self.onchange = onchange
+        self.onidle = onidle
+        self.axis = 'n'
+        self.seq = [[1, 0, 1, 0],
+                    [1, 0, 0, 0],
+                    [1, 0, 0, 1],
+                    [0, 0, 0, 1],
+                    [0, 1, 0, 1],
+                    [0, 1, 0, 0],
+                    [0, 1, 1, 0],
+                    [0, 0, 1, 0]
+                    ]
+        self.channela = 0
+        self.channelaa = 0
+        self.channelb = 0
+        self.channelbb = 0
+        self.sequenceindex = 0
+        self.upperlimit = 2.1
+        self.lowerlimit = -2.1
+        self.sequence = 0
+        self.pulsewidth = 0.025
+        self.moving = False
+        self.stopevent = Event()
+        self.tickdone = Event()
+        self.deadline = 0
+        self.idle = Event()
+        self.idle.set()
+        self.activeloops = 0
+        self.looplock = Lock()
+        self.threads = []
+        self.stoplatency = 0.0
+        self.lowerswitch = None
+        self.upperswitch = None
+        self.atlower = False
+        self.atupper = False
+        self.direction = 0
+        self.stepcount = 0
+        self.homed = False
+        self.homing = False
+        self.energise = 'pulse'
+        self.idletime = 0.5
+        self.stepmode = 'half'
+        self.activemode = 'half'
+        self.estimator = EstimatorClass(self, 0.0005)
+        self.calibration = CalibrationClass()
+
+    def setchannels(self, a, aa, b, bb):
+        """
+        Sets up the channel attributes and configures them as output channels.
+
+        This method assigns input values to the corresponding channel attributes of
+        the object and configures the specified GPIO channels as outputs using the
+        GPIO setup method.
+
+        Args:
+            a: The first channel to be assigned to 'channela'.
+            aa: The second channel to be assigned to 'channelaa'.
+            b: The third channel to be assigned to 'channelb'.
+            bb: The fourth channel to be assigned to 'channelbb'.
+        """
+        self.channela = a
+        self.channelaa = aa
+        self.channelb = b
+        self.channelbb = bb
+        GPIO.setup(self.listchannels(), GPIO.OUT)
+
+    def setlimitswitches(self, lower, upper):
+        """
+        Configures the limit switch inputs for this axis. The switches are wired between
+        the GPIO pin and ground so the inputs are pulled up and read 0 when pressed. Both
+        edges raise a GPIO interrupt which is handled by limitswitch(), so a switch stops
+        the axis as soon as it is pressed instead of waiting for the next ADC sample.
+
+        Args:
+            lower: GPIO channel of the lower limit switch, or None if not fitted.
+            upper: GPIO channel of the upper limit switch, or None if not fitted.
+        """
+        self.lowerswitch = lower
+        self.upperswitch = upper
+        for channel in (lower, upper):
+            if channel is not None:
+                GPIO.setup(channel, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+                GPIO.add_event_detect(channel, GPIO.BOTH, callback=self.limitswitch,
+                                      bouncetime=SWITCH_BOUNCETIME)
+        self.atlower = lower is not None and GPIO.input(lower) == 0
+        self.atupper = upper is not None and GPIO.input(upper) == 0
+
+    def limitswitch(self, channel):
+        """
+        GPIO edge callback for the limit switches. Records the switch state and, if the
+        switch has just been pressed while the axis is moving towards it, stops the axis
+        immediately, except while homing where the homing loop handles the switch. The moving
+        flag is cleared, the sequence number is bumped so moveto loops exit, the motion thread
+        is woken and the coils are de-energised.
+
+        Args:
+            channel: The GPIO channel that raised the interrupt.
+        """
+        pressed = GPIO.input(channel) == 0
+        if channel == self.lowerswitch:
+            self.atlower = pressed
+            towards = -1
+        else:
+            self.atupper = pressed
+            towards = 1
+        if pressed and self.moving and self.direction == towards and not self.homing:
+            self.moving = False
+            self.sequence = self.sequence + 1
+            self.wakeup()
+            self.output([0, 0, 0, 0])
+            logger.warning('%s limit switch on channel %s pressed, axis stopped at %s', self.axis, channel,
+                           round(self.positions.location(self.axis), 4))
+
+    def atlimit(self, direction):
+        """
+        Checks if the axis is at a limit in the given direction, either because the limit
+        switch is pressed or the ADC position has reached the software limit. While the
+        positions are stale the axis is treated as at a limit in both directions.
+
+        Args:
+            direction: 1 to check the upper limit, -1 to check the lower limit.
+
+        Returns:
+            bool: True if the axis cannot step any further in that direction.
+        """
+        if self.positions.stale:
+            return True
+        if direction > 0:
+            return self.atupper or self.positions.location(self.axis) >= self.upperlimit
+        return self.atlower or self.positions.location(self.axis) <= self.lowerlimit
+
+    def athome(self, direction):
+        """
+        Checks if the axis has reached its homing reference in the given direction. If a
+        limit switch is fitted at that end the reference is the switch alone, so the soft
+        limit, which is only as repeatable as the ADC reading, cannot end the seek early.
+        Without a switch the reference is the software limit. Stale positions are never the
+        reference, home() treats them as a failure.
+
+        Args:
+            direction: 1 to home to the upper end, -1 to home to the lower end.
+
+        Returns:
+            bool: True if the axis is at the homing reference.
+        """
+        switch = self.upperswitch if direction > 0 else self.lowerswitch
+        if switch is not None:
+            return self.atupper if direction > 0 else self.atlower
+        return not self.positions.stale and self.atlimit(direction)
+
+    def setenergise(self, policy, idletime):
+        """
+        Sets the coil energise policy for this axis.
+
+        Args:
+            policy: 'pulse', 'move' or 'idle', see the class attributes.
+            idletime: Seconds without a step before the coils are de-energised in 'idle' mode.
+
+        Raises:
+            ValueError: If the policy is not recognised.
+        """
+        if policy not in ENERGISE_POLICIES:
+            raise ValueError('energise policy must be one of %s' % ', '.join(ENERGISE_POLICIES))
+        self.energise = policy
+        self.idletime = idletime
+
+    def setstepmode(self, mode):
+        """
+        Sets the default step mode for moves on this axis. A move that is running keeps the
+        mode it started with, activemode is only set by movemode() when a move starts.
+
+        Args:
+            mode: 'half', 'full', 'wave' or 'auto'.
+
+        Raises:
+            ValueError: If the mode is not recognised.
+        """
+        if mode not in STEP_MODES:
+            raise ValueError('step mode must be one of %s' % ', '.join(STEP_MODES))
+        self.stepmode = mode
+
+    def movemode(self, mode):
+        """
+        Selects the step mode for a move and sets activemode ready for the first step.
+
+        Args:
+            mode: 'half', 'full', 'wave', 'auto' or None to use the axis default.
+
+        Returns:
+            str: The step mode selected for the move.
+
+        Raises:
+            ValueError: If the mode is not recognised.
+        """
+        if mode is None:
+            mode = self.stepmode
+        if mode not in STEP_MODES:
+            raise ValueError('step mode must be one of %s' % ', '.join(STEP_MODES))
+        self.activemode = 'half' if mode == 'auto' else mode
+        return mode
+
+    def stepsize(self):
+        """
+        Returns the number of entries in the half-step table the next step moves through.
+        Full steps use the even (two-phase) entries and wave drive the odd (one phase)
+        entries, so after a mode change the first step is a half step onto the right
+        entries and from then on every step moves two entries.
+
+        Returns:
+            int: 1 or 2.
+        """
+        if self.activemode == 'full':
+            return 1 if self.sequenceindex % 2 else 2
+        if self.activemode == 'wave':
+            return 2 if self.sequenceindex % 2 else 1
+        return 1
+
+    def listchannels(self):
+        """
+        Returns a list of available channels.
+
+        This method retrieves and returns a list of channels available
+        within the current instance. It consolidates the individual channel
+        attributes defined in the object.
+
+        Returns:
+            list: A list containing elements channela, channelaa, channelb,
+            and channelbb.
+        """
+        return [self.channela, self.channelaa, self.channelb, self.channelbb]
+
+    def current(self):
+        """
+        Returns the current element from the sequence based on the sequence index.
+        It retrieves the element at the position indicated by 'sequenceindex' from
+        the sequence stored in 'seq'.
+
+        Returns:
+            The element in the sequence located at the index defined by attribute 'sequenceindex'.
+        """
+        return self.seq[self.sequenceindex]
+
+    def movenext(self, fine=False):
+        """
+        Moves the axis motor to the next position within the defined range of movement.
+
+        This method increments the motor's sequence index to move the axis one step forward
+        in the active step mode,
+        provided the current position of the motor's axis is less than the specified upper limit
+        and the upper limit switch is not pressed. While homing only the limit switch stops
+        the step if one is fitted, see athome().
+        The movement can be divided between fine and coarse categories
+        based on whether the `fine` parameter is set to True or False.
+
+        Parameters:
+            fine (bool, optional): If True, retains output state after a movement;
+                                   otherwise the energise policy decides, see release().
+        """
+        stepincrement = self.stepsize()
+        self.direction = 1
+        if self.homing:
+            blocked = self.positions.stale or self.athome(self.direction)
+        else:
+            blocked = self.atlimit(self.direction)
+        if not blocked:
+            self.sequenceindex = (self.sequenceindex + stepincrement) % len(self.seq)
+            self.stepcount += stepincrement
+            metrics.STEPS.inc(self.axis)
+            self.tick(self.seq[self.sequenceindex])
+            self.release(fine)
+            # print('Move %s' % stepincrement)
+
+    def moveprevious(self, fine=False):
+        """
+        Moves to the previous position along a defined axis.
+
+        This function decreases the position index by one step in the active step mode and
+        updates the output according to the current sequence, provided the axis is above
+        the lower limit and the lower limit switch is not pressed, or while homing only the
+        switch if one is fitted, see athome(). The sequence index
+        is updated in a circular manner. If fine movement is not required,
+        the output is reset to neutral after the step.
+
+        Args:
+            fine (bool): If True, the movement is fine and does not reset the output
+                         to neutral after stepping. Defaults to False, in which case the
+                         energise policy decides, see release().
+        """
+        stepincrement = -self.stepsize()
+        self.direction = -1
+        if self.homing:
+            blocked = self.positions.stale or self.athome(self.direction)
+        else:
+            blocked = self.atlimit(self.direction)
+        if not blocked:
+            self.sequenceindex = (self.sequenceindex + stepincrement) % len(self.seq)
+            self.stepcount += stepincrement
+            metrics.STEPS.inc(self.axis)
+            self.tick(self.seq[self.sequenceindex])
+            self.release(fine)
+            # print('Move %s' % stepincrement)
+
+    def release(self, fine):
+        """
+        Applies the energise policy after a step has been written. In 'pulse' mode the
+        coils are held for one pulse width and then de-energised unless this is a fine
+        step. In 'move' and 'idle' modes the coils stay energised so there is no second
+        GPIO write or settle time per step, in 'idle' mode the coils are de-energised by
+        the motion clock once the axis has not stepped for idletime seconds.
+
+        Args:
+            fine (bool): If True the coils are left energised in 'pulse' mode.
+        """
+        if self.energise == 'pulse':
+            self.schedule(self.pulsewidth)
+            if not fine:
+                self.tick([0, 0, 0, 0])
+        elif self.energise == 'idle':
+            self.motionclock.schedule(self.idletime, self.deenergise, self.axis)
+
+    def deenergise(self):
+        """Switches off all four coils, run by the motion clock when the axis is idle"""
+        self.output([0, 0, 0, 0])
+
+    def stop(self):
+        """
+        Stops the current movement and updates the sequence counter.
+
+        Stops the movement of the device or component by setting its moving status to
+        False, increments the sequence number and wakes any motion thread that is waiting
+        between steps. Logs the current position of the device/component on every axis.
+        The coils are de-energised, or in 'idle' energise mode left for the motion
+        clock to de-energise once the idle time has passed. Any waitfor() callers are
+        woken to check the axis.
+        """
+        self.moving = False
+        self.sequence = self.sequence + 1
+        self.wakeup()
+        logger.info('%s stopped, %s', self.axis, ', '.join('%s = %s' % (axis.upper(), round(value, 4))
+                                                          for axis, value in self.positions.values.items()))
+        if self.energise == 'idle':
+            self.motionclock.schedule(self.idletime, self.deenergise, self.axis)
+        else:
+            self.output([0, 0, 0, 0])
+        self.onchange()
+
+    def estop(self):
+        """
+        Emergency stop. Cancels any moves that are waiting to start, wakes the motion thread
+        out of whatever wait it is in and de-energises the coils. The call waits for the
+        motion loop to exit, bounded by ESTOP_TIMEOUT, and de-energises the coils again in
+        case the loop was part way through writing a step.
+
+        Returns:
+            float: The time in seconds taken for the axis to come to a halt.
+        """
+        starttime = monotonic()
+        self.motionclock.cancel(self.axis)
+        for timerthread in self.threads:
+            timerthread.cancel()
+        self.moving = False
+        self.sequence = self.sequence + 1
+        self.wakeup()
+        self.output([0, 0, 0, 0])
+        halted = self.idle.wait(ESTOP_TIMEOUT)
+        self.output([0, 0, 0, 0])
+        self.estimator.finish()
+        self.onchange()
+        self.stoplatency = monotonic() - starttime
+        if halted:
+            logger.warning('%s emergency stop, halted in %.2f ms', self.axis, self.stoplatency * 1000)
+        else:
+            logger.error('%s emergency stop, motion loop did not exit within %s seconds', self.axis,
+                         ESTOP_TIMEOUT)
+        return self.stoplatency
+
+    def busy(self):
+        """
+        Returns True while the axis is moving or has a move that is accepted but waiting to
+        start, the estimator holds the kind of move from when it is queued until it ends.
+        """
+        return self.moving or self.activeloops > 0 or self.estimator.kind is not None
+
+    def wakeup(self):
+        """Wakes the motion thread from any wait it is in, used by all the stop paths"""
+        self.stopevent.set()
+        self.tickdone.set()
+
+    def schedule(self, seconds):
+        """
+        Moves the deadline for the next coil write on by the given time without waiting,
+        the next call to tick() waits for it. Deadlines are absolute so the time taken by
+        the motion loop between steps does not add to the step period. If the loop has
+        fallen behind the deadline is moved up to now rather than stepping in a burst to
+        catch up.
+
+        Args:
+            seconds (float): Time from the previous deadline.
+        """
+        self.deadline = max(self.deadline + int(seconds * 1000000000), monotonic_ns())
+
+    def pause(self, seconds):
+        """
+        Moves the deadline on like schedule() and then waits for it, for the places where
+        the motion loop needs the time to have passed, such as letting the ADC position
+        settle. The wait is made on the stop event rather than sleeping so that a stop
+        request ends the wait at once.
+
+        Args:
+            seconds (float): Time from the previous deadline.
+
+        Returns:
+            bool: True if the wait was ended by a stop request.
+        """
+        self.schedule(seconds)
+        return self.stopevent.wait(max(0, self.deadline - monotonic_ns()) / 1000000000)
+
+    def tick(self, channels):
+        """
+        Submits a coil write to the motion clock at the current deadline and waits for it
+        to be made. Every axis submits its writes to the same clock thread so multi-axis
+        moves share one time base, while each axis runs its motion loop on its own thread.
+        If the move has been stopped the write is skipped, and
+        a stop while waiting wakes the motion thread and cancels the pending write.
+
+        Args:
+            channels: List of the four coil states to write.
+        """
+        if self.activeloops and self.stopevent.is_set():
+            return
+        sequence = self.sequence
+        self.tickdone.clear()
+        self.motionclock.scheduleat(self.deadline, lambda: self.clocked(channels, sequence))
+        self.tickdone.wait(max(0, self.deadline - monotonic_ns()) / 1000000000 + TICK_TIMEOUT)
+
+    def clocked(self, channels, sequence):
+        """
+        Run on the motion clock thread at the deadline, makes the coil write unless the
+        move it belongs to has been stopped since it was submitted.
+
+        Args:
+            channels: List of the four coil states to write.
+            sequence: The sequence number when the write was submitted.
+        """
+        if sequence == self.sequence:
+            self.output(channels)
+        self.tickdone.set()
+
+    def beginmove(self):
+        """
+        Marks the start of a motion loop, bumps the sequence number, sets the moving flag
+        and re-arms the stop event. Every motion loop calls endmove() when it exits.
+
+        Returns:
+            int: The new sequence number for this move.
+        """
+        with self.looplock:
+            self.activeloops += 1
+            self.idle.clear()
+            self.sequence = self.sequence + 1
+            self.moving = True
+            self.stopevent.clear()
+            self.deadline = monotonic_ns()
+            return self.sequence
+
+    def endmove(self):
+        """
+        Marks the end of a motion loop, sets the idle event, finishes the move estimate and
+        saves the stage state when no loops are running.
+        """
+        with self.looplock:
+            self.activeloops -= 1
+            finished = self.activeloops <= 0
+            if finished:
+                self.activeloops = 0
+                self.estimator.finish()
+                self.idle.set()
+        self.onchange()
+        if finished:
+            self.onidle()
+
+    def move(self, steps, mode=None):
+        """
+        Moves a mechanism a specified number of steps in a defined sequence. The movement
+        can be either forward or backward depending on whether the step count is positive
+        or negative. The function halts movement if steps reach zero or if the moving
+        state becomes false. It includes a sequence update and enforces a delay between
+        steps based on a pulse width.
+
+        Parameters:
+            steps (int): The number of steps to move. Positive values indicate forward
+            movement, and negative values indicate backward movement.
+            mode (str): Step mode for this move, defaults to the axis step mode. 'auto'
+            moves in half steps.
+        """
+        mode = self.movemode(mode)
+        self.beginmove()
+        self.estimator.begin('move', steps, mode)
+        try:
+            if steps == 0:
+                self.stop()
+            while steps != 0 and self.moving:
+                if steps > 0:
+                    steps -= 1
+                    self.movenext()
+                else:
+                    steps += 1
+                    self.moveprevious()
+                self.schedule(self.pulsewidth * 2)
+            self.stop()
+        finally:
+            self.endmove()
+
+    def moveslow(self, steps):
+        """
+        Moves the object step-by-step in a specified direction. The method continues moving
+        the object one step at a time until the specified number of steps is completed or
+        movement is explicitly stopped. Movement is paused for a fixed time interval after
+        each step to simulate slow movement.
+
+        Parameters:
+            steps (int): The number of steps to move. Positive values indicate forward
+            movement; negative values indicate backward movement.
+        """
+        self.beginmove()
+        try:
+            while steps != 0 and self.moving:
+                if steps > 0:
+                    steps -= 1
+                    self.movenext(True)
+                else:
+                    steps += 1
+                    self.moveprevious(True)
+                logger.debug('%s coils %s', self.axis, self.seq[self.sequenceindex])
+                self.pause(1)
+        finally:
+            self.endmove()
+
+    def moveto(self, target, mode=None):
+        """
+        Moves the axis to the specified target position within predefined limits. The method adjusts
+        the axis position step by step until it reaches the target position or a defined condition
+        occurs, such as exceeding a step counter threshold or passing the target position.
+
+        If the target position is outside the lower and upper limits, the operation will not
+        proceed. Step adjustments are made iteratively to ensure the axis reaches the closest
+        possible location to the target. The sequence number ensures the operation is associated
+        with the intended move command and prevents interference from other simultaneous commands.
+
+        Parameters
+        ----------
+        target : float
+            The desired position to which the axis is moved.
+        mode : str
+            Step mode for this move, defaults to the axis step mode. In 'auto' mode full
+            steps are used until the axis is within AUTO_HALFSTEP_RANGE of the target and
+            half steps for the final approach.
+
+        """
+        mode = self.movemode(mode)
+        seq = self.beginmove()
+        self.estimator.begin('moveto', target, mode)
+        try:
+            if self.lowerlimit <= target <= self.upperlimit:
+                stepcounter = 0
+                direction = 1 if target - self.positions.location(self.axis) > 0 else -1
+                while self.positions.location(self.axis) != target and seq == self.sequence:
+                    stepcounter += 1
+                    if stepcounter > 8000:
+                        logger.info('step counter overrun %s', stepcounter)
+                        metrics.MOVETO_OVERRUNS.inc(self.axis)
+                        self.stop()
+                        return
+                    if mode == 'auto':
+                        if abs(target - self.positions.location(self.axis)) > AUTO_HALFSTEP_RANGE:
+                            self.activemode = 'full'
+                        else:
+                            self.activemode = 'half'
+                    if self.approach(target, direction, stepcounter):
+                        self.stop()
+                        return
+                    if abs(target - self.positions.location(self.axis)) > FINE_RANGE:
+                        self.schedule(self.pulsewidth * 2)
+                    else:
+                        self.pause(SETTLE_TIME)
+            self.moving = False
+        finally:
+            self.endmove()
+
+    def approach(self, target, direction, stepcounter):
+        """
+        Takes one step of moveto towards the target. Within 0.1 of the target the step is a
+        fine step and the position is checked again, if the step has taken the axis past the
+        target it steps back and the move is over.
+
+        Args:
+            target (float): The target position in ADC volts.
+            direction (int): 1 if the move is forward, -1 if it is backward.
+            stepcounter (int): Steps taken by the move so far, for the log.
+
+        Returns:
+            bool: True if the axis passed the target and stepped back.
+        """
+        if abs(target - self.positions.location(self.axis)) >= 0.1:
+            self.step(direction)
+            return False
+        self.step(direction, True)
+        logger.info('recheck stepper %s position %s - target %s', self.axis,
+                    round(self.positions.location(self.axis), 4), target)
+        if (self.positions.location(self.axis) - target) * direction <= 0:
+            return False
+        self.step(-direction, True)
+        logger.info('%s at %s and just passed %s so stepped %s 1. Steps = %s', self.axis,
+                    self.positions.location(self.axis), target, 'back' if direction > 0 else 'forward', stepcounter)
+        return True
+
+    def home(self, direction=-1):
+        """
+        Homes the axis against a reference, the limit switch if one is fitted at that end or
+        otherwise the ADC software limit, see athome(). The axis seeks the reference at full
+        speed with the coils held energised, backs off by the configured number of steps, then
+        re-approaches slowly so the reference is found from the same side at low speed every
+        time. Once the reference is reached the step counter is zeroed and the axis is marked
+        as homed, so later moves can be counted in steps from a known position.
+
+        Homing fails, and the axis is left not homed, if the positions go stale at any point
+        or the reference is not found within HOME_MAX_STEPS steps.
+
+        Parameters:
+            direction (int): -1 to home to the lower limit, 1 to home to the upper limit.
+        """
+        direction = -1 if direction < 0 else 1
+        seq = self.beginmove()
+        self.estimator.begin('home', direction)
+        self.homing = True
+        self.homed = False
+        try:
+            logger.info('%s homing towards %s limit', self.axis, 'lower' if direction < 0 else 'upper')
+            stepcounter = 0
+            while not self.athome(direction) and seq == self.sequence:
+                stepcounter += 1
+                if self.positions.stale or stepcounter > HOME_MAX_STEPS:
+                    self.homingfailed('seeking', 'no reference found in %s steps' % HOME_MAX_STEPS)
+                    return
+                self.step(direction, True)
+                self.schedule(self.pulsewidth)
+            for _ in range(settings['homebackoff']):
+                if seq != self.sequence:
+                    break
+                if self.positions.stale:
+                    self.homingfailed('backing off')
+                    return
+                self.step(-direction, True)
+                self.schedule(self.pulsewidth)
+            self.pause(settings['homeslowdelay'])
+            slowsteps = 0
+            while not self.athome(direction) and seq == self.sequence:
+                slowsteps += 1
+                if self.positions.stale or slowsteps > HOME_MAX_STEPS:
+                    self.homingfailed('re-approaching', 'reference not found again in %s steps' % HOME_MAX_STEPS)
+                    return
+                self.step(direction, True)
+                self.pause(settings['homeslowdelay'])
+            if self.positions.stale:
+                self.homingfailed('finishing')
+                return
+            if seq == self.sequence:
+                self.stepcount = 0
+                self.homed = True
+                logger.info('%s homed at %s after %s seek steps', self.axis,
+                            round(self.positions.location(self.axis), 4), stepcounter)
+            self.stop()
+        finally:
+            self.homing = False
+            self.endmove()
+
+    def homingfailed(self, stage, reason=None):
+        """
+        Logs why homing failed and stops the axis, which is left not homed.
+
+        Args:
+            stage (str): What homing was doing when it failed.
+            reason (str): Why it gave up, used when the positions are not stale.
+        """
+        if self.positions.stale or reason is None:
+            reason = 'the positions went stale while %s' % stage
+        logger.error('%s homing failed, %s', self.axis, reason)
+        self.stop()
+
+    def step(self, direction, fine=False):
+        """
+        Takes a single step in the given direction.
+
+        Args:
+            direction (int): Positive to step forward, negative to step backward.
+            fine (bool): If True the coils are left energised after the step.
+        """
+        if direction > 0:
+            self.movenext(fine)
+        else:
+            self.moveprevious(fine)
+
+    def output(self, channels):
+        """
+        Controls the output state of specified GPIO channels using the provided channel states.
+
+        This function takes a list or tuple of four channel states and sets the associated
+        GPIO output for each corresponding channel. Each state in the list corresponds to
+        a specific GPIO channel, and the function utilizes the `output` method of the
+        GPIO module for assigning these states.
+        """
+        GPIO.output(self.channela, channels[0])
+        GPIO.output(self.channelaa, channels[1])
+        GPIO.output(self.channelb, channels[2])
+        GPIO.output(self.channelbb, channels[3])
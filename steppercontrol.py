@@ -2,12 +2,18 @@
 Stepper Motor Control System for XY Table
 
 This module provides classes and functions to control an XY positioning table
-using stepper motors with ADC feedback for position tracking. It includes:
+using stepper motors with ADC feedback for position tracking. The axes are set in
+the 'axes' setting, x and y by default, each with its GPIO pins, ADC channel,
+limits and speed, so a Z axis or a second stage is added in settings.json. It includes:
 
 - Position tracking via ADC readings
 - Stepper motor control with multiple movement modes (step, continuous, targeted)
 - Web API endpoints for remote control
 - Self-test capabilities for system diagnostics
+- start() and shutdown() lifecycle hooks, the hardware is not touched at import time
+
+The position reader is in positionreader.py, the stepper of each axis in stepper.py and
+its move time estimates in estimator.py, this module creates them and connects them up.
 
 The system uses GPIO pins on a Raspberry Pi to control the stepper motors and
 reads position data through an ADC interface. It supports both programmatic
@@ -17,432 +23,520 @@ Dependencies:
     - RPi.GPIO: For GPIO control
     - ADCPi: For analog position reading
     - threading: For non-blocking motor control
+
+If 'simulate' is set in settings.json GPIO and ADCPi are taken from simhardware instead,
+which models the stage so the controller can be run without the hardware.
 """
 
-from time import sleep
+from time import sleep, monotonic
+from datetime import datetime
 import os
-from threading import Timer
-from RPi import GPIO
-from ADCPi import ADCPi
+import json
+from threading import Timer, Lock, Condition
 from logmanager import logger
+from app_control import settings, writesettings, axissetting
+if settings['simulate']:
+    from simhardware import GPIO, ADCPi, TimeoutError as ADCTimeoutError
+else:
+    from RPi import GPIO
+    from ADCPi import ADCPi, TimeoutError as ADCTimeoutError
+from scheduler import SchedulerClass
+from positionshare import PositionShareClass
+from adcmanager import ADCManagerClass
+from adcscan import ScanClass
+from rasterscan import RasterClass
+from commandlog import CommandLogClass
+from commands import CommandError, validate, validatewait, validatebatch, splititem, checkedaxes, moveargument
+from positionreader import PositionClass
+from stepper import StepperClass
 
 
-class PositionClass:
-    """
-    Manages the x and y positions obtained from ADC readings.
-
-    The class periodically reads position values from ADC inputs and
-    provides the location data along specified axes. It initializes
-    and starts a timer thread to fetch the positional data continuously.
-    """
-    def __init__(self):
-        self.x = 0
-        self.y = 0
-        timerthread = Timer(0.5, self.getpositions)
-        timerthread.name = 'Postition Thread'
-        timerthread.start()
-
-    def getpositions(self):
-        """
-        Reads positional voltage data from an ADC and calculates the x and y positions
-        relative to a 2.5V reference. This is a continuous process that updates the
-        object's x and y attributes every 0.25 seconds while the ADC object is valid.
-        """
-        while adc is not None:
-            self.x = adc.read_voltage(1) - 2.5
-            self.y = adc.read_voltage(5) - 2.5
-            # print('Read position')
-            sleep(0.25)
-
-    def location(self, table_axis):
-        """
-        Determines and returns the location value along a specified axis.
-
-        This method evaluates the given table axis ('x' or 'y') and
-        returns the corresponding coordinate value. If the provided axis
-        is invalid, a default value of -99.99 is returned.
-
-        Args:
-            table_axis: A string indicating the axis ('x' or 'y').
-
-        Returns:
-            float: The coordinate value for the specified axis, or -99.99
-            if the axis is invalid.
-        """
-        if table_axis == 'x':
-            return self.x
-        if table_axis == 'y':
-            return self.y
-        return -99.99
-
-class StepperClass:
-    """
-    Represents a stepper motor controller, enabling precise control over the stepper
-    motor's movement, configuration, and operational parameters.
-
-    This class provides methods for initializing and controlling a stepper motor's
-    movement such as stepping forward, stepping backward, stopping, or moving to
-    specific positions. It also supports setting GPIO channels, retrieving active
-    sequences, and managing limits for motor movement. The class incorporates
-    adjustable movement speeds (full speed or slow) and ensures proper handling of
-    stepper sequences during operation.
-
-    Attributes:
-        axis: A string indicating the axis of operation for the stepper motor.
-        seq: A list of lists, defining sequences for stepper coil activations.
-        channela: An integer representing the GPIO channel for the first winding.
-        channelaa: An integer representing the GPIO channel for the second winding.
-        channelb: An integer representing the GPIO channel for the third winding.
-        channelbb: An integer representing the GPIO channel for the fourth winding.
-        sequenceindex: An integer representing the current sequence index of the motor.
-        upperlimit: A float defining the maximum allowed position limit for movement.
-        lowerlimit: A float defining the minimum allowed position limit for movement.
-        sequence: An integer counter for the current movement sequence.
-        pulsewidth: A float specifying the delay between steps, controlling speed.
-        moving: A boolean flag indicating whether the motor is actively moving.
-    """
-    def __init__(self):
-        self.axis = 'n'
-        self.seq = [[1, 0, 1, 0],
-                    [1, 0, 0, 0],
-                    [1, 0, 0, 1],
-                    [0, 0, 0, 1],
-                    [0, 1, 0, 1],
-                    [0, 1, 0, 0],
-                    [0, 1, 1, 0],
-                    [0, 0, 1, 0]
-                    ]
-        self.channela = 0
-        self.channelaa = 0
-        self.channelb = 0
-        self.channelbb = 0
-        self.sequenceindex = 0
-        self.upperlimit = 2.1
-        self.lowerlimit = -2.1
-        self.sequence = 0
-        self.pulsewidth = 0.025
-        self.moving = False
-
-    def setchannels(self, a, aa, b, bb):
-        """
-        Sets up the channel attributes and configures them as output channels.
-
-        This method assigns input values to the corresponding channel attributes of
-        the object and configures the specified GPIO channels as outputs using the
-        GPIO setup method.
-
-        Args:
-            a: The first channel to be assigned to 'channela'.
-            aa: The second channel to be assigned to 'channelaa'.
-            b: The third channel to be assigned to 'channelb'.
-            bb: The fourth channel to be assigned to 'channelbb'.
-        """
-        self.channela = a
-        self.channelaa = aa
-        self.channelb = b
-        self.channelbb = bb
-        GPIO.setup(self.listchannels(), GPIO.OUT)
-
-    def listchannels(self):
-        """
-        Returns a list of available channels.
-
-        This method retrieves and returns a list of channels available
-        within the current instance. It consolidates the individual channel
-        attributes defined in the object.
-
-        Returns:
-            list: A list containing elements channela, channelaa, channelb,
-            and channelbb.
-        """
-        return [self.channela, self.channelaa, self.channelb, self.channelbb]
-
-    def current(self):
-        """
-        Returns the current element from the sequence based on the sequence index.
-        It retrieves the element at the position indicated by 'sequenceindex' from
-        the sequence stored in 'seq'.
-
-        Returns:
-            The element in the sequence located at the index defined by attribute 'sequenceindex'.
-        """
-        return self.seq[self.sequenceindex]
-
-    def movenext(self, fine=False):
-        """
-        Moves the axis motor to the next position within the defined range of movement.
-
-        This method increments the motor's sequence index to move the axis one step forward,
-        provided the current position of the motor's axis is less than the specified upper limit.
-        The movement can be divided between fine and coarse categories
-        based on whether the `fine` parameter is set to True or False.
-
-        Parameters:
-            fine (bool, optional): If True, retains output state after a movement;
-                                   otherwise, resets the output state to zero.
-        """
-        stepincrement = 1
-        if positions.location(self.axis) < self.upperlimit:
-            self.sequenceindex += stepincrement
-            if self.sequenceindex > 7:
-                self.sequenceindex = 0
-            self.output(self.seq[self.sequenceindex])
-            sleep(self.pulsewidth)
-            if not fine:
-                self.output([0, 0, 0, 0])
-            # print('Move %s' % stepincrement)
-
-    def moveprevious(self, fine=False):
-        """
-        Moves to the previous position along a defined axis.
-
-        This function decreases the position index by one step unit and
-        updates the output according to the current sequence. The sequence index
-        is updated in a circular manner. If fine movement is not required,
-        the output is reset to neutral after the step.
-
-        Args:
-            fine (bool): If True, the movement is fine and does not reset the output
-                         to neutral after stepping. Defaults to False.
-        """
-        stepincrement = -1
-        if positions.location(self.axis) > self.lowerlimit:
-            self.sequenceindex += stepincrement
-            if self.sequenceindex < 0:
-                self.sequenceindex = 7
-            self.output(self.seq[self.sequenceindex])
-            sleep(self.pulsewidth)
-            if not fine:
-                self.output([0, 0, 0, 0])
-            # print('Move %s' % stepincrement)
-
-    def stop(self):
-        """
-        Stops the current movement and updates the sequence counter.
-
-        Stops the movement of the device or component by setting its moving status to
-        False and increments the sequence number. Logs the current position of the
-        device/component on the x and y axes. Outputs a signal to indicate the stop
-        state.
-        """
-        self.moving = False
-        self.sequence = self.sequence + 1
-        logger.info('%s stopped, X = %s, Y = %s', self.axis, round(positions.location('x'), 4),
-                    round(positions.location('y'), 4))
-        self.output([0, 0, 0, 0])
-
-    def move(self, steps):
-        """
-        Moves a mechanism a specified number of steps in a defined sequence. The movement
-        can be either forward or backward depending on whether the step count is positive
-        or negative. The function halts movement if steps reach zero or if the moving
-        state becomes false. It includes a sequence update and enforces a delay between
-        steps based on a pulse width.
-
-        Parameters:
-            steps (int): The number of steps to move. Positive values indicate forward
-            movement, and negative values indicate backward movement.
-        """
-        self.sequence = self.sequence + 1
-        self.moving = True
-        if steps == 0:
-            self.stop()
-        while steps != 0 and self.moving:
-            if steps > 0:
-                steps -= 1
-                self.movenext()
-            else:
-                steps += 1
-                self.moveprevious()
-            sleep(self.pulsewidth * 2)
-        self.stop()
-
-    def moveslow(self, steps):
-        """
-        Moves the object step-by-step in a specified direction. The method continues moving
-        the object one step at a time until the specified number of steps is completed or
-        movement is explicitly stopped. Movement is paused for a fixed time interval after
-        each step to simulate slow movement.
-
-        Parameters:
-            steps (int): The number of steps to move. Positive values indicate forward
-            movement; negative values indicate backward movement.
-        """
-        self.sequence = self.sequence + 1
-        self.moving = True
-        while steps != 0 and self.moving:
-            if steps > 0:
-                steps -= 1
-                self.movenext(True)
-                print(self.seq[self.sequenceindex])
-            else:
-                steps += 1
-                self.moveprevious(True)
-                print(self.seq[self.sequenceindex])
-            sleep(1)
-
-    def moveto(self, target):
-        """
-        Moves the axis to the specified target position within predefined limits. The method adjusts
-        the axis position step by step until it reaches the target position or a defined condition
-        occurs, such as exceeding a step counter threshold or passing the target position.
-
-        If the target position is outside the lower and upper limits, the operation will not
-        proceed. Step adjustments are made iteratively to ensure the axis reaches the closest
-        possible location to the target. The sequence number ensures the operation is associated
-        with the intended move command and prevents interference from other simultaneous commands.
-
-        Parameters
-        ----------
-        target : float
-            The desired position to which the axis is moved.
-
-        """
-        self.moving = True
-        self.sequence = self.sequence + 1
-        seq = self.sequence
-        if self.lowerlimit <= target <= self.upperlimit:
-            stepcounter = 0
-            delta = target - positions.location(self.axis)
-            # print('delta = %s' % delta)
-            while positions.location(self.axis) != target and seq == self.sequence:
-                stepcounter += 1
-                if stepcounter > 8000:
-                    logger.info('step counter overrun %s', stepcounter)
-                    self.stop()
-                    return
-                if delta > 0:
-                    if abs(target - positions.location(self.axis)) < 0.1:
-                        self.movenext(True)
-                        logger.info('recheck stepper %s position %s - target %s', self.axis,
-                                    round(positions.location(self.axis), 4), target)
-                        if positions.location(self.axis) > target:
-                            self.moveprevious(True)
-                            logger.info('%s at %s and just passed %s so stepped back 1. Steps = %s',
-                                  self.axis, positions.location(self.axis), target, stepcounter)
-                            self.stop()
-                            return
-                    else:
-                        self.movenext()
-                else:
-                    if abs(target - positions.location(self.axis)) < 0.1:
-                        self.moveprevious(True)
-                        logger.info('recheck stepper %s position %s - target %s', self.axis,
-                                    round(positions.location(self.axis), 4), target)
-                        if positions.location(self.axis) < target:
-                            self.movenext(True)
-                            logger.info('%s at %s and just passed %s so stepped forward 1. Steps = %s',
-                                  self.axis, positions.location(self.axis), target, stepcounter)
-                            self.stop()
-                            return
-                    else:
-                        self.moveprevious()
-                difference = abs(target - positions.location(self.axis))
-                # print('difference %f' % difference )
-                if difference > 0.05:
-                    sleep(self.pulsewidth * 2)
-                else:
-                    sleep(0.3)
-        self.moving = False
-
-    def output(self, channels):
-        """
-        Controls the output state of specified GPIO channels using the provided channel states.
-
-        This function takes a list or tuple of four channel states and sets the associated
-        GPIO output for each corresponding channel. Each state in the list corresponds to
-        a specific GPIO channel, and the function utilizes the `output` method of the
-        GPIO module for assigning these states.
-        """
-        GPIO.output(self.channela, channels[0])
-        GPIO.output(self.channelaa, channels[1])
-        GPIO.output(self.channelb, channels[2])
-        GPIO.output(self.channelbb, channels[3])
 
 def httpstatus():
     """
     Provides a function to generate a list containing rounded positional status.
 
-    The `httpstatus` function creates a dictionary containing the keys `xpos` and `ypos`, where the values
-    are the rounded versions of `positions.x` and `positions.y` respectively.
+    The `httpstatus` function creates a dictionary containing a `<axis>pos` key for each axis,
+    `xpos` and `ypos` by default, where the values are the rounded positions of the axes.
     It then adds this dictionary into a list and returns it as the function output.
 
     Returns:
-        list: A list with a single dictionary containing `xpos` and `ypos` keys, with their corresponding
-        values being rounded to four decimal points.
+        list: A list with a single dictionary containing a `<axis>pos` key for each axis, with
+        their corresponding values being rounded to four decimal points.
     """
-    statuslist = ({'xpos': round(positions.x, 4), 'ypos': round(positions.y, 4)})
+    start()
+    statuslist = ({'%spos' % axis: round(positions.location(axis), 4) for axis in steppers})
     return statuslist
 
 def apistatus():
     """
     Retrieve the current status of the system including positions and movement states.
 
-    This function compiles the current x and y positions of the system, along with
-    the movement status of stepper motors for both axes, into a dictionary.
+    This function compiles the current position of each axis of the system, along with
+    the movement status of its stepper motor, into a dictionary. Every key of an axis
+    starts with the axis name, 'xpos', 'ymoving', 'zsteps' and so on.
 
     Returns:
-        dict: A dictionary containing the x and y positions, as well as movement
-        states for both stepper motors.
+        dict: A dictionary containing the position and movement state of each axis, the
+        time in seconds the last emergency stop on each axis took and
+        the [lower, upper] limit switch states, the step count from home, whether each
+        axis has been homed, the estimated seconds until the current move on each axis
+        completes, the health of the position reader and the positions in millimetres
+        (None for an axis with no calibration).
     """
-    statuslist = ({'xpos': positions.x, 'xmoving': stepperx.moving, 'ypos': positions.y, 'ymoving': steppery.moving })
+    start()
+    statuslist = {}
+    for axis, stepper in steppers.items():
+        statuslist.update({'%spos' % axis: positions.location(axis), '%smoving' % axis: stepper.moving,
+                           '%sstoplatency' % axis: stepper.stoplatency,
+                           '%sswitches' % axis: [stepper.atlower, stepper.atupper],
+                           '%ssteps' % axis: stepper.stepcount, '%shomed' % axis: stepper.homed,
+                           '%seta' % axis: round(stepper.estimator.remaining(), 2),
+                           '%sposmm' % axis: positionmm(stepper)})
+    statuslist['positionreader'] = positions.health()
     return statuslist
 
+def positionmm(stepper):
+    """Returns the position of an axis in millimetres, or None if it has no calibration"""
+    if not stepper.calibration.calibrated():
+        return None
+    return round(stepper.calibration.tomm(positions.location(stepper.axis)), 3)
+
+
 def parsecontrol(item, command):
     """
     Parses the control command and executes the corresponding action, such as
-    moving a stepper motor or issuing a system restart. The function supports
-    multiple control commands and executes them in separate timer threads when
-    required.
+    moving a stepper motor or issuing a system restart. The command is checked
+    against the command table in commands.py first, so a malformed command raises
+    straight away, then passed to the handler registered for the item. Moves are
+    run in separate timer threads.
 
     Parameters:
-    item (str): The control item indicating the action type, such as 'xmove',
-    'ymove', 'xmoveto', 'ymoveto', or 'restart'.
-    command (str): The associated command or argument required for the action.
+    item (str): The control item indicating the action type, an axis name followed by
+    'move', 'moveto', 'movetomm', 'calibrate', 'home' or 'stepmode', such as 'xmove' or
+    'zhome', or 'estop', 'adcscan', 'raster' or 'restart'.
+    command: The associated command or argument required for the action.
+
+    Returns:
+        dict: The item, the checked command and the result returned by the handler.
+
+    Raises:
+        CommandError: If the item is not recognised or the command is invalid.
+    """
+    start()
+    try:
+        command = validate(item, command)
+    except CommandError as err:
+        logger.error('rejected command %s : %s - %s', item, command, err)
+        raise
+    return runcommand(item, command)
+
+
+def runcommand(item, command):
+    """
+    Runs a command that has already been checked by the handler registered for its item,
+    and records it if the 'commandlog' setting is set.
+
+    Returns:
+        dict: The item, the command and the result returned by the handler.
+
+    Raises:
+        CommandError: If the handler rejects the command.
+    """
+    if item != 'getxystatus':
+        logger.info('%s : %s ', item, command)
+    if commandlog is not None:
+        commandlog.record(item, command)
+    result = HANDLERS[splititem(item)[1]](item, command)
+    return {'item': item, 'command': command, 'result': result}
+
+
+def parsebatch(commands, stoponerror=False):
     """
+    Runs a batch of commands in order, each a dictionary holding 'item' and 'command' as
+    for parsecontrol(), so a client can send several commands in one request. Every command
+    is checked before any is run. With stoponerror an invalid command rejects the whole
+    batch and a command rejected by its handler stops the batch, the commands after it are
+    not run. Otherwise each command that fails is reported and the rest are still run.
+
+    A batch is not a transaction. Commands that ran before a failure are not undone, other
+    clients' commands can run between the commands of a batch, and move commands only start
+    their moves and return, as they do when sent one at a time, so a move that fails part
+    way through does not stop the batch and a batch should not hold two moves of the same
+    axis.
+
+    Args:
+        commands (list): The commands.
+        stoponerror (bool): True to stop at the first command that is invalid or fails.
+
+    Returns:
+        dict: 'results' holding the parsecontrol() result of each command run, or its item
+        and 'error', and for a stoponerror batch that stopped 'error' and 'notrun', the number
+        of commands not run.
+
+    Raises:
+        CommandError: If the batch is malformed, or with stoponerror if any command is
+            invalid, nothing is run.
+    """
+    start()
     try:
-        if item != 'getxystatus':
-            logger.info('%s : %s ', item, command)
-        if item == 'xmove':
-            timerthread = Timer(1, lambda: stepperx.move(command))
-            timerthread.name = 'xmove thread'
-            timerthread.start()
-        elif item == 'ymove':
-            timerthread = Timer(1, lambda: steppery.move(command))
-            timerthread.name = 'ymove thread'
-            timerthread.start()
-        elif item == 'xmoveto':
-            timerthread = Timer(1, lambda: stepperx.moveto(command))
-            timerthread.name = 'ymove to %s thread' % command
-            timerthread.start()
-        elif item == 'ymoveto':
-            timerthread = Timer(1, lambda: steppery.moveto(command))
-            timerthread.name = 'ymove to %s thread' % command
-            timerthread.start()
-        elif item == 'restart':
-            if command == 'pi':
-                logger.warning('Restart command recieved: system will restart in 15 seconds')
-                timerthread = Timer(15, reboot)
-                timerthread.start()
-        # print('X = %s, Y = %s' % (stepperx.listlocation(), steppery.listlocation()))
-    except ValueError:
-        logger.error('incorrect json message')
-    except IndexError:
-        logger.error('bad valve number')
+        checked = validatebatch(commands, stoponerror)
+    except CommandError as err:
+        logger.error('rejected batch: %s', err)
+        raise
+    results = []
+    for index, (item, command, error) in enumerate(checked):
+        if error is None:
+            try:
+                results.append(runcommand(item, command))
+                continue
+            except CommandError as err:
+                error = str(err)
+        logger.error('batch command %s %s failed: %s', index, item, error)
+        results.append({'item': item, 'error': error})
+        if stoponerror:
+            return {'results': results, 'error': 'batch command %s: %s' % (index, error),
+                    'notrun': len(checked) - index - 1}
+    return {'results': results}
+
+
+def notifymotion():
+    """Wakes every waitfor() caller to re-check its axes, called on stops and position updates"""
+    with motionchanged:
+        motionchanged.notify_all()
+
+
+def waitfor(axis, target=None, tolerance=None, timeout=None):
+    """
+    Blocks until an axis, or every axis, has stopped, or until a single axis is within tolerance
+    of a target, or until the timeout. Callers sleep on the motionchanged condition, which
+    is notified when a stepper stops and on every position update, so a client can make one
+    request per move instead of polling the status.
+
+    Args:
+        axis (str): Name of an axis or 'all'.
+        target (float): Optional position to wait for, only for a single axis.
+        tolerance (float): Distance from the target that counts as arrived, defaults to the
+            'waittolerance' setting.
+        timeout (float): Seconds to wait, defaults to and is capped at the 'waittimeout'
+            setting.
+
+    Returns:
+        dict: The api status with 'wait' holding the axis, the reason the wait ended,
+        'idle', 'arrived' or 'timeout', and the seconds waited.
+
+    Raises:
+        CommandError: If an argument is invalid.
+    """
+    start()
+    axis, target, tolerance, timeout = validatewait(axis, target, tolerance, timeout)
+    if commandlog is not None:
+        commandlog.record('wait', {'axis': axis, 'target': target, 'tolerance': tolerance, 'timeout': timeout})
+    if tolerance is None:
+        tolerance = settings['waittolerance']
+    if timeout is None or timeout > settings['waittimeout']:
+        timeout = settings['waittimeout']
+    waiting = [stepper for stepper in steppers.values() if axis in (stepper.axis, 'all')]
+
+    def finished():
+        if target is not None and abs(positions.location(axis) - target) <= tolerance:
+            return 'arrived'
+        if not any(stepper.busy() for stepper in waiting):
+            return 'idle'
+        return None
+
+    starttime = monotonic()
+    with motionchanged:
+        reason = motionchanged.wait_for(finished, timeout)
+    statuslist = apistatus()
+    statuslist['wait'] = {'axis': axis, 'reason': reason or 'timeout',
+                          'waited': round(monotonic() - starttime, 3)}
+    return statuslist
+
+
+HANDLERS = {}  # control item or axis action -> handler, filled in by the @handles decorators below
+
+
+def handles(*items):
+    """
+    Decorator that registers a function as the handler for one or more control items, or
+    for an axis action such as 'move' which handles that action on every axis. Handlers are
+    called with the item and the checked command.
+
+    Args:
+        *items: The control items or axis actions the function handles.
+    """
+    def register(function):
+        for item in items:
+            HANDLERS[item] = function
+        return function
+    return register
+
+
+def stepperfor(item):
+    """
+    Returns the stepper for an axis item such as 'xmove'.
+
+    Args:
+        item (str): Control item, the axis name followed by the action.
+
+    Returns:
+        StepperClass: The stepper for that axis.
+
+    Raises:
+        CommandError: If the axis was left out at start because its settings are bad.
+    """
+    axis = splititem(item)[0]
+    if axis not in steppers:
+        raise CommandError('%s: the %s axis is not running, its settings were rejected, see the log' % (item, axis))
+    return steppers[axis]
+
+
+def startmotion(stepper, name, function, *args):
+    """
+    Runs a motion function in a named timer thread after MOTION_DELAY seconds and records
+    the thread on the stepper so an emergency stop can cancel it before it starts. Threads
+    that have already finished are dropped from the stepper's list.
+
+    Args:
+        stepper (StepperClass): The stepper the motion is for.
+        name (str): Name for the thread, shown on the index page.
+        function: The motion function to run.
+        *args: Arguments for the function.
+
+    Raises:
+        CommandError: If a raster scan is running.
+    """
+    if raster is not None and raster.running:
+        raise CommandError("the %s axis is in use by a raster scan, stop it with the raster command 'stop'" %
+                           stepper.axis)
+    timerthread = Timer(MOTION_DELAY, function, args)
+    timerthread.name = name
+    stepper.threads = [thread for thread in stepper.threads if thread.is_alive()]
+    stepper.threads.append(timerthread)
+    timerthread.start()
+
+
+@handles('getxystatus')
+def statuscommand(item, command):  # pylint: disable=unused-argument
+    """Nothing to do, the caller returns the status"""
+
+
+@handles('move')
+def movecommand(item, command):
+    """
+    Moves the axis the given number of steps, in the step mode given with them or otherwise
+    the axis step mode.
+
+    Returns:
+        dict: Predicted seconds until the move completes.
+    """
+    stepper = stepperfor(item)
+    steps, mode = moveargument(command, 'steps')
+    startmotion(stepper, '%s thread' % item, stepper.move, steps, mode)
+    return {'eta': stepper.estimator.queue('move', steps, MOTION_DELAY, mode)}
+
+
+@handles('moveto')
+def movetocommand(item, command):
+    """
+    Moves the axis to the given position, in the step mode given with it or otherwise the
+    axis step mode.
+
+    Returns:
+        dict: Predicted seconds until the move completes.
+
+    Raises:
+        CommandError: If the position is outside the axis limits.
+    """
+    stepper = stepperfor(item)
+    target, mode = moveargument(command, 'position')
+    if not stepper.lowerlimit <= target <= stepper.upperlimit:
+        raise CommandError('%s: position %s is outside the limits %s to %s' %
+                           (item, target, stepper.lowerlimit, stepper.upperlimit))
+    startmotion(stepper, '%s move to %s thread' % (stepper.axis, target), stepper.moveto, target, mode)
+    return {'eta': stepper.estimator.queue('moveto', target, MOTION_DELAY, mode)}
+
+
+@handles('movetomm')
+def movetommcommand(item, command):
+    """
+    Moves the axis to a position given in millimetres, converted to volts through the
+    axis calibration table.
+
+    Returns:
+        dict: The target in volts and the predicted seconds until the move completes.
+
+    Raises:
+        CommandError: If the axis is not calibrated or the position is outside the limits.
+    """
+    stepper = stepperfor(item)
+    if not stepper.calibration.calibrated():
+        raise CommandError('%s: the %s axis has no calibration, see %scalibrate' % (item, stepper.axis, stepper.axis))
+    position, mode = moveargument(command, 'position')
+    target = round(stepper.calibration.tovolts(position), 5)
+    result = movetocommand('%smoveto' % stepper.axis, target if mode is None else {'position': target, 'mode': mode})
+    result['target'] = target
+    return result
+
+
+@handles('calibrate')
+def calibratecommand(item, command):
+    """
+    Adds a calibration point at the current position of the axis, the command is the
+    measured position in millimetres, or 'clear' removes every point. The table is saved in
+    settings.json.
+
+    Returns:
+        dict: The calibration table as [volts, mm] pairs.
+
+    Raises:
+        CommandError: If the point does not fit the rest of the table.
+    """
+    stepper = stepperfor(item)
+    if command == 'clear':
+        stepper.calibration.load([])
+    else:
+        try:
+            stepper.calibration.addpoint(round(positions.location(stepper.axis), 5), command)
+        except ValueError as err:
+            raise CommandError('%s: %s' % (item, err)) from None
+    savecalibration(stepper)
+    return {'calibration': stepper.calibration.points()}
+
+
+@handles('home')
+def homecommand(item, command):
+    """
+    Homes the axis towards the lower (-1) or upper (1) limit.
+
+    Returns:
+        dict: Predicted seconds until homing completes.
+    """
+    stepper = stepperfor(item)
+    startmotion(stepper, '%s thread' % item, stepper.home, command)
+    return {'eta': stepper.estimator.queue('home', command, MOTION_DELAY)}
+
+
+@handles('stepmode')
+def stepmodecommand(item, command):
+    """
+    Sets the step mode for the axis. The mode is not changed while the axis is moving or
+    has a move queued, a mode for one move is given with the move instead.
+
+    Raises:
+        CommandError: If the axis is busy.
+    """
+    stepper = stepperfor(item)
+    if stepper.busy():
+        raise CommandError('%s: the %s axis is moving, wait for it to stop or give the mode with the move' %
+                           (item, stepper.axis))
+    stepper.setstepmode(command)
+
+
+@handles('estop')
+def estopcommand(item, command):  # pylint: disable=unused-argument
+    """
+    Emergency stops one axis or every axis.
+
+    Returns:
+        dict: The time in seconds each axis took to halt.
+    """
+    if raster is not None and raster.running:
+        raster.stop()
+    return {axis: stepper.estop() for axis, stepper in steppers.items() if command in (axis, 'all')}
+
+
+@handles('adcscan')
+def adcscancommand(item, command):  # pylint: disable=unused-argument
+    """
+    Returns the ring buffer of samples of an ADC channel, or of every channel for 'all'.
+
+    Returns:
+        dict: Channel number to its name, rate, bits, error count and [time, voltage] samples.
+    """
+    return scanner.status(command)
+
+
+@handles('raster')
+def rastercommand(item, command):  # pylint: disable=unused-argument
+    """
+    Starts a raster scan over a grid of points, or stops the scan or returns its progress
+    for 'stop' and 'status'. The rows are downloaded through rasterdata().
+
+    Returns:
+        dict: The state of the scan, 'idle' if no scan has been run.
+
+    Raises:
+        CommandError: If a scan is already running, an axis is moving, the grid is outside
+            the axis limits or has more points than the 'rastermaxpoints' setting.
+    """
+    global raster
+    if command in ('status', 'stop'):
+        if raster is None:
+            return {'state': 'idle'}
+        if command == 'stop' and raster.running:
+            raster.stop()
+        return raster.status()
+    if raster is not None and raster.running:
+        raise CommandError('raster: a scan is already running')
+    for axis in command['axes']:
+        if axis not in steppers:
+            raise CommandError('raster: the %s axis is not running, its settings were rejected, see the log' % axis)
+    scanned = {axis: steppers[axis] for axis in command['axes']}
+    for stepper in scanned.values():
+        if stepper.busy():
+            raise CommandError('raster: the %s axis is moving' % stepper.axis)
+        for position in command[stepper.axis]:
+            if not stepper.lowerlimit <= position <= stepper.upperlimit:
+                raise CommandError('raster: %s position %s is outside the limits %s to %s' %
+                                   (stepper.axis, position, stepper.lowerlimit, stepper.upperlimit))
+    points = 1
+    for number, axis in enumerate(command['axes']):
+        points *= int(abs(command[axis][1] - command[axis][0]) / command['pitch'][number] + 1e-9) + 1
+    if points > settings['rastermaxpoints']:
+        raise CommandError('raster: %s points is more than the %s allowed' % (points, settings['rastermaxpoints']))
+    raster = RasterClass(command, scanned, adcbus, positions, savestate)
+    return raster.status()
+
+
+def rasterdata(form):
+    """
+    Returns the rows recorded by the last raster scan, so far if it is still running.
+
+    Args:
+        form (str): 'csv' for CSV text or 'npy' for the bytes of a NumPy .npy file.
+
+    Returns:
+        The CSV text or .npy bytes, or None if no scan has been run.
+    """
+    start()
+    if raster is None:
+        return None
+    return raster.npy() if form == 'npy' else raster.csv()
+
+
+@handles('restart')
+def restartcommand(item, command):  # pylint: disable=unused-argument
+    """Restarts the Raspberry Pi in 15 seconds"""
+    logger.warning('Restart command recieved: system will restart in 15 seconds')
+    timerthread = Timer(15, reboot)
+    timerthread.start()
 
 
 def runselftest():
     """
-    Stops both motors and initiates a test sequence with a delay.
+    Stops every motor and initiates a test sequence with a delay.
 
     This function ensures that the motors are stopped prior to running
     the self-test, providing a safe starting point for the test. A delay
     of 10 seconds is introduced before beginning the test sequence. The
     test sequence is executed in a separate thread.
     """
-    logger.info('Stopping both motors prior to testing')
-    stepperx.stop()
-    steppery.stop()
+    start()
+    logger.info('Stopping all motors prior to testing')
+    for stepper in steppers.values():
+        stepper.stop()
     logger.info('Starting test sequence in 10 seconds')
     timerthread = Timer(10, testsequence)
     timerthread.name = 'selftest thread'
@@ -462,67 +556,280 @@ def reboot():
 
 def testsequence():
     """
-    Conducts a self-test sequence for channel x and channel y operations, verifying stepper motor
+    Conducts a self-test sequence for the channels of each axis in turn, verifying stepper motor
     behaviors through various output states and movement actions. The function performs a series
-    of tests on both channels by setting their output states, moving them in forward and backward
+    of tests on every axis by setting their output states, moving them in forward and backward
     directions, and ensuring their responses align with expected behavior.
     """
     logger.info('Self test started ************************************')
-    logger.info('Starting channel x tests')
-    logger.info('Setting all x channels to 1 for 5 seconds')
-    stepperx.output([1, 1, 1, 1])
-    sleep(5)
-    logger.info('Setting all x channels to 0 for 5 seconds')
-    stepperx.output([0, 0, 0, 0])
-    sleep(5)
-    logger.info('step x 10 steps forward')
-    stepperx.moveslow(10)
-    stepperx.output([0, 0, 0, 0])
-    sleep(5)
-    logger.info('step x 10 steps backward')
-    stepperx.moveslow(-10)
-    stepperx.output([0, 0, 0, 0])
-    sleep(5)
-    logger.info('Finished Channel x tests')
-    logger.info('Starting channel y tests')
-    logger.info('Setting all y channels to 1 for 5 seconds')
-    steppery.output([1, 1, 1, 1])
-    sleep(5)
-    logger.info('Setting all y channels to 0 for 5 seconds')
-    steppery.output([0, 0, 0, 0])
-    sleep(5)
-    logger.info('step y 10 steps forward')
-    steppery.moveslow(10)
-    steppery.output([0, 0, 0, 0])
-    sleep(5)
-    logger.info('step y 10 steps backward')
-    steppery.moveslow(-10)
-    steppery.output([0, 0, 0, 0])
-    sleep(5)
-    logger.info('Finished Channel y tests')
+    for axis, stepper in steppers.items():
+        logger.info('Starting channel %s tests', axis)
+        logger.info('Setting all %s channels to 1 for 5 seconds', axis)
+        stepper.output([1, 1, 1, 1])
+        sleep(5)
+        logger.info('Setting all %s channels to 0 for 5 seconds', axis)
+        stepper.output([0, 0, 0, 0])
+        sleep(5)
+        logger.info('step %s 10 steps forward', axis)
+        stepper.moveslow(10)
+        stepper.output([0, 0, 0, 0])
+        sleep(5)
+        logger.info('step %s 10 steps backward', axis)
+        stepper.moveslow(-10)
+        stepper.output([0, 0, 0, 0])
+        sleep(5)
+        logger.info('Finished Channel %s tests', axis)
     logger.info('Self test ended ************************************')
 
 
-logger.info("xy controller started")
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(12, GPIO.OUT)
-GPIO.setup([11, 16, 20, 21], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-GPIO.output(12, 0)
-try:
-    adc = ADCPi(0x68, 0x69, 12)
-    adc.set_conversion_mode(1)
-except OSError:
-    adc = None
-    logger.error('Error: No ADCPi Board Found')
-positions = PositionClass()
-stepperx = StepperClass()
-stepperx.axis = 'x'
-stepperx.setchannels(18, 24, 23, 9)
-stepperx.stop()
-steppery = StepperClass()
-steppery.axis = 'y'
-steppery.setchannels(17, 22, 27, 13)
-steppery.stop()
-logger.info("xy controller ready")
-GPIO.output(12, 1)  # Set ready LED
+def openadc():
+    """
+    Opens the ADCPi board on the I2C bus in continuous conversion mode at 12 bits and hands
+    it to the bus manager, adcbus, which every reader of the ADC goes through.
+
+    Returns:
+        ADCPi: The board, also stored in adc, or None if it cannot be opened.
+    """
+    global adc, adcbus
+    try:
+        adc = ADCPi(0x68, 0x69, 12)
+        adc.set_conversion_mode(1)
+    except OSError:
+        adc = None
+    if adcbus is None:
+        adcbus = ADCManagerClass(adc, 12, ADCTimeoutError)
+    else:
+        adcbus.setadc(adc, 12)
+    return adc
+
+
+def loadcalibration(stepper, config):
+    """Loads the calibration table of an axis from the settings, a bad table is logged and ignored"""
+    try:
+        stepper.calibration.load(axissetting(config, 'calibration', []))
+    except (ValueError, TypeError) as err:
+        logger.error('%s calibration in settings.json ignored: %s', stepper.axis, err)
+
+
+def savecalibration(stepper):
+    """
+    Saves the calibration table of an axis in settings.json, in its entry in 'axes' unless
+    the table is kept in the older '<axis>calibration' setting.
+    """
+    config = next(config for config in settings['axes'] if config['name'] == stepper.axis)
+    if 'calibration' in config or '%scalibration' % stepper.axis not in settings:
+        config['calibration'] = stepper.calibration.points()
+    else:
+        settings['%scalibration' % stepper.axis] = stepper.calibration.points()
+    writesettings()
+
+
+def newstepper(config, reader):
+    """
+    Creates the stepper of an axis from its entry in the 'axes' setting, already checked by
+    commands.checkaxes() so none of the settings can be refused. The pins and ADC
+    channel are set in the entry, the other settings of the axis ('limitswitches',
+    'energise', 'idletime', 'stepmode', 'voltsperstep', 'calibration', 'lowerlimit',
+    'upperlimit' and 'pulsewidth') are taken from the entry or from the '<axis><key>'
+    settings, see app_control.axissetting().
+
+    Args:
+        config (dict): The entry of the axis in 'axes'.
+        reader (PositionClass): The position reader the stepper reads its position from.
+
+    Returns:
+        StepperClass: The stepper.
+    """
+    stepper = StepperClass(reader, motionclock, notifymotion, savestate)
+    stepper.axis = config['name']
+    stepper.setchannels(*config['pins'])
+    stepper.setlimitswitches(*axissetting(config, 'limitswitches', [None, None]))
+    stepper.setenergise(axissetting(config, 'energise', stepper.energise),
+                        axissetting(config, 'idletime', stepper.idletime))
+    stepper.setstepmode(axissetting(config, 'stepmode', stepper.stepmode))
+    stepper.lowerlimit = axissetting(config, 'lowerlimit', stepper.lowerlimit)
+    stepper.upperlimit = axissetting(config, 'upperlimit', stepper.upperlimit)
+    stepper.pulsewidth = axissetting(config, 'pulsewidth', stepper.pulsewidth)
+    stepper.estimator.voltsperstep = axissetting(config, 'voltsperstep', stepper.estimator.voltsperstep)
+    loadcalibration(stepper, config)
+    return stepper
+
+
+def savestate():
+    """
+    Saves the state of every axis, the coil sequence index, step count, whether the axis is
+    homed, the learned volts and millimetres per step and the last position, to the
+    'statefile' setting so a restart can carry on where the controller stopped. During a
+    raster scan the state is saved once when the scan ends rather than at every point. The file
+    is written to a temporary file that replaces the old one, so a crash or power cut part
+    way through leaves the previous state intact.
+    """
+    if not steppers or positions is None or (raster is not None and raster.running):
+        return
+    state = {'saved': datetime.now().isoformat(timespec='seconds'), 'axes': {}}
+    for stepper in list(steppers.values()):
+        state['axes'][stepper.axis] = {'sequenceindex': stepper.sequenceindex, 'stepcount': stepper.stepcount,
+                                       'homed': stepper.homed, 'voltsperstep': stepper.estimator.voltsperstep,
+                                       'mmperstep': stepper.estimator.mmperstep,
+                                       'position': positions.location(stepper.axis)}
+    temporary = settings['statefile'] + '.tmp'
+    with statelock:
+        try:
+            with open(temporary, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, settings['statefile'])
+        except OSError as err:
+            logger.error('Cannot save the stage state to %s: %s', settings['statefile'], err)
+
+
+def loadstate(reader):
+    """
+    Restores the state saved by savestate() into the steppers and the position reader
+    being set up by start(), before either is published. The coil sequence index is always restored so
+    the first step energises the coils next to where the rotor stopped. The ADC is read
+    straight away and if an axis is within STATE_POSITION_TOLERANCE of its saved position
+    the step count and homed flag are restored too and the position is available before the
+    first sample from the position thread, otherwise the axis has been moved while the
+    controller was stopped and has to be homed again.
+
+    Args:
+        reader (PositionClass): The position reader start() has created for the axes.
+    """
+    try:
+        with open(settings['statefile'], 'r', encoding='utf-8') as f:
+            state = json.load(f)['axes']
+    except FileNotFoundError:
+        logger.info('No saved stage state, starting from the home position')
+        return
+    except (OSError, ValueError, KeyError) as err:
+        logger.error('Saved stage state in %s ignored: %s', settings['statefile'], err)
+        return
+    for stepper in steppers.values():
+        saved = state.get(stepper.axis)
+        if saved is None:
+            continue
+        try:
+            stepper.sequenceindex = int(saved['sequenceindex']) % len(stepper.seq)
+            stepper.estimator.voltsperstep = float(saved['voltsperstep'])
+            stepper.estimator.mmperstep = float(saved['mmperstep'])
+            try:
+                position = adcbus.read(reader.channels[stepper.axis]) - 2.5
+            except (TimeoutError, OSError):
+                position = None
+            if position is not None and abs(position - saved['position']) <= STATE_POSITION_TOLERANCE:
+                stepper.stepcount = int(saved['stepcount'])
+                stepper.homed = bool(saved['homed'])
+                reader.values[stepper.axis] = position
+                reader.lastsample = monotonic()
+                logger.info('%s state restored, position %.4f, %s steps from home', stepper.axis, position,
+                            stepper.stepcount)
+            else:
+                logger.warning('%s has moved since the state was saved (%s, now %s), home the axis',
+                               stepper.axis, round(saved['position'], 4), position if position is None
+                               else round(position, 4))
+        except (KeyError, TypeError, ValueError) as err:
+            logger.error('Saved %s state ignored: %s', stepper.axis, err)
+
+
+def start():
+    """
+    Initialises the hardware: configures the GPIO pins of each axis in the 'axes' setting,
+    opens the ADC on the I2C bus, starts the motion clock shared by every axis and the position
+    thread, restores the saved stage state and de-energises every stepper. If 'positionshare' is set,
+    or in motion process mode, the positions are also published in shared memory. If 'commandlog' is
+    set every command is recorded to that file for replay.py. Nothing is done at import
+    time, start() is called from the gunicorn post_worker_init hook or lazily by the
+    first API or web request. Calling it again once the controller is running returns
+    immediately. The time taken to start is written to the log.
+    """
+    global adc, positions, steppers, motionclock, scanner, commandlog
+    if positions is not None:
+        return
+    with startlock:
+        if positions is not None:
+            return
+        starttime = monotonic()
+        logger.info("xy controller started")
+        GPIO.setwarnings(False)
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(12, GPIO.OUT)
+        GPIO.output(12, 0)
+        if openadc() is None:
+            logger.error('Error: No ADCPi Board Found')
+        axes, rejected = checkedaxes()
+        for config, reason in rejected:
+            logger.error('Axis %s in settings.json ignored: %s', config, reason)
+        motionclock = SchedulerClass('Motion Clock', settings['motionpriority'], settings['motioncpu'])
+        motionclock.start()
+        steppers = {}
+        reader = PositionClass({config['name']: config['channel'] for config in axes}, adcbus, steppers, openadc,
+                               notifymotion)
+        steppers.update((config['name'], newstepper(config, reader)) for config in axes)
+        scanner = ScanClass(adcbus, settings['adcscan'], settings['positionbuffer'], reader.nextread,
+                            {config['channel']: config['name'] for config in axes})
+        reader.scanner = scanner
+        if settings['positionshare'] or settings['motionprocess']:
+            reader.share = PositionShareClass(settings['positionshm'], create=True, count=len(axes))
+        loadstate(reader)
+        if settings['commandlog']:
+            commandlog = CommandLogClass(settings['commandlog'])
+        for stepper in steppers.values():
+            stepper.output([0, 0, 0, 0])
+        reader.start()
+        # positions is published last, callers that find it set skip the lock and use the controller
+        positions = reader
+        logger.info("xy controller ready, startup took %.3f seconds", monotonic() - starttime)
+        GPIO.output(12, 1)  # Set ready LED
+
+
+def shutdown():
+    """
+    Stops and de-energises every stepper, stops the motion clock and the position
+    thread, clears the ready LED and releases the GPIO pins. Called from the gunicorn worker_exit hook so that the worker exits
+    cleanly instead of leaving the position thread running forever.
+    """
+    global adc, positions, steppers, scanner, commandlog
+    with startlock:
+        if positions is None:
+            return
+        logger.info('xy controller shutting down')
+        if raster is not None and raster.running:
+            raster.stop()
+        for stepper in steppers.values():
+            stepper.estop()
+        savestate()
+        motionclock.shutdown()
+        scanner.shutdown()
+        scanner = None
+        positions.shutdown()
+        if positions.share is not None:
+            positions.share.close()
+        positions = None
+        steppers = {}
+        adc = None
+        if commandlog is not None:
+            commandlog.close()
+            commandlog = None
+        GPIO.output(12, 0)  # Clear ready LED
+        GPIO.cleanup()
+        logger.info('xy controller shut down')
+
+
+STATE_POSITION_TOLERANCE = 0.02
+MOTION_DELAY = 1
+# set by start() and cleared by shutdown(), so not constants
+# pylint: disable=invalid-name
+adc = None
+adcbus = None
+scanner = None
+raster = None
+commandlog = None
+positions = None
+motionclock = None
+# pylint: enable=invalid-name
+steppers = {}  # axis name -> StepperClass, in the order of the 'axes' setting, filled in by start()
+startlock = Lock()
+statelock = Lock()
+motionchanged = Condition()